@@ -28,6 +28,10 @@ import re
 
 import torch
 
+## Our imports
+from common_utils import load_checkpoint
+##
+
 
 def average_checkpoints(args):
     """Loads checkpoints from inputs and returns a model with averaged weights.
@@ -47,12 +51,7 @@ def average_checkpoints(args):
 
     for fpath in args.inputs:
         print("Loading: ", fpath)
-        state = torch.load(
-            fpath,
-            map_location=(
-                lambda s, _: torch.serialization.default_restore_location(s, "cpu")
-            ),
-        )
+        state = load_checkpoint(fpath, "cpu") ## Handles both the regular and the flat checkpoints.
         # Copies over the settings from the first checkpoint
         if new_state is None:
             new_state = state
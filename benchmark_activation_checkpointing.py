@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import time
+##
+
+## Huggingface imports
+from transformers import MBartForConditionalGeneration, MBartConfig
+##
+
+## Pytorch imports
+import torch
+##
+
+## Our imports
+from common_utils import *
+##
+
+
+def benchmark_configuration(model, encoder_layers, decoder_layers, offload, args):
+    """Runs a few training steps on random data with the given layers checkpointed and returns the tokens processed per second and the peak GPU memory in MB."""
+    configure_activation_checkpointing(model, encoder_layers, decoder_layers, offload)
+    model.zero_grad()
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(args.device)
+    generator = torch.Generator().manual_seed(args.seed)
+    elapsed = 0.0
+    for step in range(args.warmup_steps + args.steps):
+        input_ids = torch.randint(1, args.vocab_size, (args.batch_size, args.sequence_length), generator=generator).to(args.device)
+        labels = torch.randint(1, args.vocab_size, (args.batch_size, args.sequence_length), generator=generator).to(args.device)
+        torch.cuda.synchronize(args.device)
+        start = time.time()
+        with torch.cuda.amp.autocast(enabled=args.fp16):
+            logits = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), decoder_input_ids=labels).logits
+            loss = torch.nn.functional.cross_entropy(logits.view(-1, args.vocab_size).float(), labels.view(-1))
+        loss.backward()
+        model.zero_grad()
+        torch.cuda.synchronize(args.device)
+        if step >= args.warmup_steps:
+            elapsed += time.time() - start
+        del logits, loss
+    tokens_per_second = args.steps*args.batch_size*args.sequence_length*2/elapsed ## Source and target tokens.
+    return tokens_per_second, torch.cuda.max_memory_allocated(args.device)/(1024*1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to measure the training throughput and peak GPU memory with different activation checkpointing settings (--activation_checkpointing and related flags of train_nmt.py and pretrain_nmt.py) and to pick the fastest setting that fits a memory budget. A randomly initialized model is trained on random data so no checkpoint or data is needed.",
+    )
+    parser.add_argument('--encoder_layers', default=6, type=int,
+                        help='The number of encoder layers.')
+    parser.add_argument('--decoder_layers', default=6, type=int,
+                        help='The number of decoder layers.')
+    parser.add_argument('--d_model', default=512, type=int,
+                        help='The size of the hidden layers.')
+    parser.add_argument('--ffn_dim', default=2048, type=int,
+                        help='The size of the feed forward layers.')
+    parser.add_argument('--heads', default=8, type=int,
+                        help='The number of attention heads.')
+    parser.add_argument('--vocab_size', default=64000, type=int,
+                        help='The size of the vocabulary.')
+    parser.add_argument('--batch_size', default=32, type=int,
+                        help='The number of sentences per batch.')
+    parser.add_argument('--sequence_length', default=128, type=int,
+                        help='The length of the source and target sentences.')
+    parser.add_argument('--every_k_values', default='1,2,3', type=str,
+                        help='Comma separated values of k for which checkpointing every k-th layer is benchmarked. 1 means all layers.')
+    parser.add_argument('--memory_budget_mb', default=0, type=float,
+                        help='If more than 0 then the fastest setting whose peak memory is within this budget is recommended.')
+    parser.add_argument('--fp16', action='store_true',
+                        help='Should mixed precision be used like with --fp16 during training?')
+    parser.add_argument('--warmup_steps', default=2, type=int,
+                        help='Steps that are not measured.')
+    parser.add_argument('--steps', default=5, type=int,
+                        help='The number of steps to measure.')
+    parser.add_argument('--device', default='cuda:0', type=str,
+                        help='The GPU to run the benchmark on.')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='The random seed.')
+    args = parser.parse_args()
+    print(args)
+
+    config = MBartConfig(vocab_size=args.vocab_size, encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, encoder_attention_heads=args.heads, decoder_attention_heads=args.heads, encoder_ffn_dim=args.ffn_dim, decoder_ffn_dim=args.ffn_dim, d_model=args.d_model, max_position_embeddings=max(1024, args.sequence_length), pad_token_id=0)
+    model = MBartForConditionalGeneration(config).to(args.device)
+    model.train()
+
+    settings = [("no checkpointing", "", [], [], False)]
+    for every_k in [int(k) for k in args.every_k_values.strip().split(",")]:
+        encoder_layers = get_checkpointed_layer_indices("", args.encoder_layers, every_k)
+        decoder_layers = get_checkpointed_layer_indices("", args.decoder_layers, every_k)
+        settings.append(("every %d layer(s)" % every_k, "--activation_checkpointing --activation_checkpointing_every_k %d" % every_k, encoder_layers, decoder_layers, False))
+        settings.append(("every %d layer(s) with offloading" % every_k, "--activation_checkpointing --activation_checkpointing_every_k %d --activation_checkpointing_offload" % every_k, encoder_layers, decoder_layers, True))
+    settings.append(("decoder only", "--activation_checkpointing --activation_checkpointing_encoder_layers none", [], get_checkpointed_layer_indices("", args.decoder_layers), False)) ## The decoder keeps more activations per layer because of cross attention.
+    
+    results = []
+    for name, flags, encoder_layers, decoder_layers, offload in settings:
+        try:
+            tokens_per_second, peak_memory = benchmark_configuration(model, encoder_layers, decoder_layers, offload, args)
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            print("Setting:", name, "Out of memory")
+            model.zero_grad()
+            torch.cuda.empty_cache()
+            continue
+        results.append((name, flags, tokens_per_second, peak_memory))
+        print("Setting:", name, "Tokens per second:", tokens_per_second, "Peak memory:", peak_memory, "MB")
+    
+    if args.memory_budget_mb > 0:
+        fitting_results = [result for result in results if result[3] <= args.memory_budget_mb]
+        if len(fitting_results) == 0:
+            print("Nothing fits in", args.memory_budget_mb, "MB. Reduce the batch size.")
+        else:
+            name, flags, tokens_per_second, peak_memory = max(fitting_results, key=lambda x: x[2])
+            print("The fastest setting within", args.memory_budget_mb, "MB is:", name, "with", tokens_per_second, "tokens per second and", peak_memory, "MB. Use the flags:", flags if flags != "" else "(none)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import time
+import functools
+from types import SimpleNamespace
+##
+
+## Huggingface imports
+from transformers import MBartForConditionalGeneration, MBartConfig
+##
+
+## Pytorch imports
+import torch
+import torch.multiprocessing as mp
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+##
+
+## Our imports
+from common_utils import *
+##
+
+
+def count_communicated_bytes(collective, counter):
+    """Wraps a torch.distributed collective so that the bytes of the tensors passed to it are counted. The communication hooks call the collectives through torch.distributed so this sees the compressed tensors."""
+    @functools.wraps(collective)
+    def wrapper(tensor_or_tensors, *args, **kwargs):
+        tensors = tensor_or_tensors if isinstance(tensor_or_tensors, (list, tuple)) else [tensor_or_tensors]
+        counter[0] += sum([tensor.numel()*tensor.element_size() for tensor in tensors])
+        return collective(tensor_or_tensors, *args, **kwargs)
+    return wrapper
+
+
+def benchmark_hook(rank, hook, args, results):
+    """Trains a randomly initialized model for a few steps with the given communication hook on the CPU with the gloo backend and reports the bytes sent per process and the time per step."""
+    dist.init_process_group(backend='gloo', init_method='tcp://127.0.0.1:%d' % args.port, world_size=args.processes, rank=rank)
+    torch.manual_seed(args.seed) ## Same initialization on all processes.
+    torch.set_num_threads(args.threads_per_process)
+    try:
+        counter = [0]
+        dist.all_reduce = count_communicated_bytes(dist.all_reduce, counter) ## The hooks look these up at call time.
+        dist.all_gather = count_communicated_bytes(dist.all_gather, counter)
+        config = MBartConfig(vocab_size=args.vocab_size, encoder_layers=args.layers, decoder_layers=args.layers, encoder_attention_heads=args.heads, decoder_attention_heads=args.heads, encoder_ffn_dim=args.ffn_dim, decoder_ffn_dim=args.ffn_dim, d_model=args.d_model, dropout=0.0, pad_token_id=0)
+        model = DistributedDataParallel(MBartForConditionalGeneration(config), bucket_cap_mb=args.ddp_bucket_cap_mb)
+        if hook == "none": ## The regular all-reduce happens in C++ where we cant count bytes. This hook does the same thing from python.
+            from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+            model.register_comm_hook(None, default_hooks.allreduce_hook)
+        else:
+            register_ddp_comm_hook(model, SimpleNamespace(ddp_comm_hook=hook, powersgd_rank=args.powersgd_rank, powersgd_start_iteration=args.warmup_steps))
+        generator = torch.Generator().manual_seed(args.seed + rank) ## Different data on each process.
+        step_times = []
+        bytes_per_step = []
+        for step in range(args.warmup_steps + args.steps):
+            input_ids = torch.randint(1, args.vocab_size, (args.batch_size, args.sequence_length), generator=generator)
+            labels = torch.randint(1, args.vocab_size, (args.batch_size, args.sequence_length), generator=generator)
+            model.zero_grad()
+            dist.barrier()
+            counter[0] = 0
+            start = time.time()
+            logits = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), decoder_input_ids=labels).logits
+            loss = torch.nn.functional.cross_entropy(logits.view(-1, args.vocab_size), labels.view(-1))
+            loss.backward()
+            step_time = time.time() - start
+            if step >= args.warmup_steps: ## PowerSGD only starts compressing after the warmup steps.
+                step_times.append(step_time)
+                bytes_per_step.append(counter[0])
+        if rank == 0:
+            results[hook] = (sum(bytes_per_step)/len(bytes_per_step), sum(step_times)/len(step_times))
+    except Exception as e: ## Some hooks are not supported by older versions of pytorch or by gloo.
+        if rank == 0:
+            results[hook] = str(e)
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to measure the bytes communicated and the time per training step for each DDP communication hook (--ddp_comm_hook) using several processes on the CPU with the gloo backend. The savings in bytes carry over to NCCL on GPUs. The times on a single machine only show the compression overhead and not what you gain on a slow network.",
+    )
+    parser.add_argument('--hooks', default='none,fp16,bf16,powersgd,batched_powersgd', type=str,
+                        help='Comma separated list of communication hooks to benchmark.')
+    parser.add_argument('--processes', default=2, type=int,
+                        help='The number of processes to simulate GPUs with.')
+    parser.add_argument('--threads_per_process', default=1, type=int,
+                        help='The number of CPU threads used by each process.')
+    parser.add_argument('--port', default=26500, type=int,
+                        help='Port for the processes to communicate over. Each hook uses the next port.')
+    parser.add_argument('--vocab_size', default=64000, type=int,
+                        help='The size of the vocabulary. The shared embedding is usually the biggest gradient.')
+    parser.add_argument('--d_model', default=512, type=int,
+                        help='The size of the hidden layers.')
+    parser.add_argument('--ffn_dim', default=2048, type=int,
+                        help='The size of the feed forward layers.')
+    parser.add_argument('--layers', default=2, type=int,
+                        help='The number of encoder and decoder layers.')
+    parser.add_argument('--heads', default=8, type=int,
+                        help='The number of attention heads.')
+    parser.add_argument('--batch_size', default=8, type=int,
+                        help='The number of sentences per process per step.')
+    parser.add_argument('--sequence_length', default=32, type=int,
+                        help='The length of the source and target sentences.')
+    parser.add_argument('--ddp_bucket_cap_mb', default=25, type=int,
+                        help='The size in MB of the DDP gradient buckets.')
+    parser.add_argument('--powersgd_rank', default=1, type=int,
+                        help='The rank of the PowerSGD approximation.')
+    parser.add_argument('--warmup_steps', default=3, type=int,
+                        help='Steps that are not measured. PowerSGD starts compressing after these.')
+    parser.add_argument('--steps', default=10, type=int,
+                        help='The number of steps to measure.')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='The random seed.')
+    args = parser.parse_args()
+    print(args)
+
+    manager = mp.Manager()
+    results = manager.dict()
+    hooks = args.hooks.strip().split(",")
+    for hook_idx, hook in enumerate(hooks):
+        hook_args = argparse.Namespace(**vars(args))
+        hook_args.port = args.port + hook_idx
+        mp.spawn(benchmark_hook, nprocs=args.processes, args=(hook, hook_args, results))
+    baseline_bytes = results["none"][0] if "none" in results and type(results["none"]) != str else None
+    for hook in hooks:
+        if type(results.get(hook)) != tuple:
+            print("Hook:", hook, "Failed:", results.get(hook))
+            continue
+        bytes_per_step, seconds_per_step = results[hook]
+        print("Hook:", hook, "MB sent per process per step:", bytes_per_step/(1024*1024), "Compression ratio:", baseline_bytes/bytes_per_step if baseline_bytes is not None and bytes_per_step > 0 else "NA", "Seconds per step:", seconds_per_step)
+
+
+if __name__ == "__main__":
+    main()
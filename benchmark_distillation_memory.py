@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import time
+from types import SimpleNamespace
+##
+
+## Pytorch imports
+import torch
+##
+
+## Our imports
+from common_utils import *
+##
+
+
+def distillation_step_fits(batch_size, chunked, top_k, args):
+    """Runs the forward and backward pass of the cross_entropy distillation loss on random logits for the given batch size and returns whether it fit in memory along with the peak memory used."""
+    child_logits, parent_logits, loss = None, None, None
+    try:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(args.device)
+        dtype = torch.float16 if args.fp16 else torch.float32
+        child_logits = torch.randn(batch_size, args.target_length, args.vocab_size, device=args.device, dtype=dtype, requires_grad=True) ## Stands in for the logits of the child which require gradients.
+        parent_logits = torch.randn(batch_size, args.target_length, args.vocab_size, device=args.device, dtype=dtype)
+        labels = torch.randint(1, args.vocab_size, (batch_size, args.target_length), device=args.device)
+        labels[:, args.target_length*3//4:] = 0 ## Some padding.
+        distillation_args = SimpleNamespace(distillation_styles="cross_entropy", distillation_temperature=args.distillation_temperature, chunked_distillation=chunked, distillation_top_k=top_k, distillation_chunk_size=args.distillation_chunk_size)
+        loss = compute_distillation_losses(SimpleNamespace(logits=child_logits), SimpleNamespace(logits=parent_logits), labels, 0, distillation_args)
+        loss.backward()
+        torch.cuda.synchronize(args.device)
+        return True, torch.cuda.max_memory_allocated(args.device)/(1024*1024)
+    except RuntimeError as e:
+        if "out of memory" not in str(e):
+            raise
+        return False, None
+    finally:
+        del child_logits, parent_logits, loss
+        torch.cuda.empty_cache()
+
+
+def find_max_batch_size(chunked, top_k, args):
+    """Doubles the batch size until the distillation step no longer fits and then does a binary search between the last two batch sizes."""
+    low, high, peak_memory = 0, 1, None
+    while high <= args.max_batch_size:
+        fits, memory = distillation_step_fits(high, chunked, top_k, args)
+        if not fits:
+            break
+        low, high, peak_memory = high, high*2, memory
+    high = min(high, args.max_batch_size+1)
+    while high - low > 1:
+        mid = (low + high)//2
+        fits, memory = distillation_step_fits(mid, chunked, top_k, args)
+        if fits:
+            low, peak_memory = mid, memory
+        else:
+            high = mid
+    return low, peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to find the maximum batch size for the cross_entropy distillation loss with and without --chunked_distillation and --distillation_top_k.",
+    )
+    parser.add_argument('--vocab_size', default=64000, type=int,
+                        help='The size of the vocabulary.')
+    parser.add_argument('--target_length', default=64, type=int,
+                        help='The length of the target sentences.')
+    parser.add_argument('--distillation_temperature', default=1.0, type=float,
+                        help='The softmax temperature during distillation.')
+    parser.add_argument('--distillation_chunk_size', default=1024, type=int,
+                        help='The number of target tokens processed at a time by the chunked loss.')
+    parser.add_argument('--distillation_top_k', default=0, type=int,
+                        help='If more than 0 then the top-k variant of the chunked loss is benchmarked as well.')
+    parser.add_argument('--max_batch_size', default=4096, type=int,
+                        help='The search for the maximum batch size stops here.')
+    parser.add_argument('--fp16', action='store_true',
+                        help='Should the logits be in half precision like they are with mixed precision training?')
+    parser.add_argument('--device', default='cuda:0', type=str,
+                        help='The GPU to run the benchmark on.')
+    args = parser.parse_args()
+    print(args)
+
+    settings = [("regular", False, 0), ("chunked", True, 0)]
+    if args.distillation_top_k > 0:
+        settings.append(("chunked top-%d" % args.distillation_top_k, True, args.distillation_top_k))
+    for name, chunked, top_k in settings:
+        start = time.time()
+        max_batch_size, peak_memory = find_max_batch_size(chunked, top_k, args)
+        print("Loss:", name, "Maximum batch size:", max_batch_size, "sentences or", max_batch_size*args.target_length, "target tokens. Peak memory at that batch size:", peak_memory, "MB. The search took", time.time()-start, "seconds.")
+
+
+if __name__ == "__main__":
+    main()
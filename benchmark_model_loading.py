@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import time
+##
+
+## Huggingface imports
+from transformers import AutoTokenizer, MBartForConditionalGeneration, MBartConfig
+##
+
+## Pytorch imports
+import torch
+##
+
+## Our imports
+from common_utils import *
+##
+
+
+def benchmark_model_loading(args):
+    """Times the stages of the model initialization done at the start of training and decoding: model construction, checkpoint loading, layer remapping, embedding remapping and loading the state dict. Everything runs in a single process on the CPU so that the numbers are not affected by the GPU or other ranks."""
+    timings = {}
+    tok = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
+    
+    start = time.time()
+    config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, pad_token_id=tok.pad_token_id, encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config) ## Configuration.
+    with skip_weight_initialization(args.skip_weight_initialization):
+        model = MBartForConditionalGeneration(config)
+    timings["model construction"] = time.time() - start
+
+    start = time.time()
+    checkpoint_dict = load_checkpoint(args.model_path, map_location="cpu") ## Flat checkpoints are memory mapped.
+    if type(checkpoint_dict) == dict:
+        checkpoint_dict = checkpoint_dict["model"]
+    timings["checkpoint loading"] = time.time() - start
+
+    if any([key.startswith("module.") for key in checkpoint_dict]): ## The model here is not wrapped in DDP.
+        checkpoint_dict = {key[len("module."):] if key.startswith("module.") else key: value for key, value in checkpoint_dict.items()}
+    
+    start = time.time()
+    checkpoint_dict = remap_layers(checkpoint_dict, 3, args)
+    timings["layer remapping"] = time.time() - start
+
+    start = time.time()
+    checkpoint_dict = remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), checkpoint_dict, args)
+    timings["embedding remapping and mismatch elimination"] = time.time() - start
+
+    start = time.time()
+    model.load_state_dict(checkpoint_dict, strict=False)
+    timings["state dict loading"] = time.time() - start
+
+    print("Startup time breakdown:")
+    for stage, timing in timings.items():
+        print(stage, ":", timing, "seconds")
+    print("Total :", sum(timings.values()), "seconds")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark for the startup time of training and decoding. It measures how long it takes to construct a model and initialize it from a checkpoint with layer and embedding remapping.",
+    )
+    parser.add_argument('-m', '--model_path', required=True, type=str,
+                        help='Path to the checkpoint to load. This can be a full checkpoint or a pure_model one.')
+    parser.add_argument('--tokenizer_name_or_path', default='ai4bharat/indic-bert', type=str,
+                        help='Name of or path to the tokenizer of the current model')
+    parser.add_argument('--pretrained_tokenizer_name_or_path', default=None, type=str,
+                        help='Name of or path to the tokenizer of the pretrained model if its different from the current model. Specify this to benchmark embedding remapping.')
+    parser.add_argument('--encoder_layers', default=6, type=int, help="The value for number of encoder layers")
+    parser.add_argument('--decoder_layers', default=6, type=int, help="The value for number of decoder layers")
+    parser.add_argument('--encoder_attention_heads', default=8, type=int, help="The value for number of encoder attention heads")
+    parser.add_argument('--decoder_attention_heads', default=8, type=int, help="The value for number of decoder attention heads")
+    parser.add_argument('--decoder_ffn_dim', default=2048, type=int, help="The value for decoder ff hidden dim")
+    parser.add_argument('--encoder_ffn_dim', default=2048, type=int, help="The value for encoder ff hidden dim")
+    parser.add_argument('--d_model', default=512, type=int, help="The value for model hidden size")
+    parser.add_argument('--encoder_tying_config', default=None, type=str,
+                        help='What should be the parameter tying configuration? See train_nmt.py for details.')
+    parser.add_argument('--decoder_tying_config', default=None, type=str,
+                        help='What should be the parameter tying configuration? See train_nmt.py for details.')
+    parser.add_argument('--remap_encoder', default='', type=str,
+                        help='This indicates the remappings for the encoder layers. Example: 1-2,2-4,3-6. See train_nmt.py for details.')
+    parser.add_argument('--remap_decoder', default='', type=str,
+                        help='This indicates the remappings for the decoder layers. Example: 1-2,2-4,3-6. See train_nmt.py for details.')
+    parser.add_argument('--eliminate_encoder_before_initialization', action='store_true',
+                        help='Lets wipe out the encoder params from the pretrained model before we use it to initialize the current model.')
+    parser.add_argument('--eliminate_decoder_before_initialization', action='store_true',
+                        help='Lets wipe out the decoder params from the pretrained model before we use it to initialize the current model.')
+    parser.add_argument('--eliminate_embeddings_before_initialization', action='store_true',
+                        help='Lets wipe out the embedding params from the pretrained model before we use it to initialize the current model.')
+    parser.add_argument('--skip_weight_initialization', action='store_true',
+                        help='Should we skip the random initialization of the model like --fast_checkpoint_loading does when the checkpoint overwrites all the parameters?')
+    args = parser.parse_args()
+    print(args)
+
+    benchmark_model_loading(args)
+
+
+if __name__ == "__main__":
+    main()
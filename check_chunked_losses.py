@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+from types import SimpleNamespace
+##
+
+## Pytorch imports
+import torch
+##
+
+## Our imports
+from common_utils import *
+##
+
+
+def compare_gradients(name, chunked_gradient, regular_gradient, args):
+    """Prints how far the chunked gradient is from the regular one and how many of its entries are zero where the regular one is not. Returns whether the relative error is within the tolerance."""
+    chunked_gradient, regular_gradient = chunked_gradient.float(), regular_gradient.float()
+    relative_error = ((chunked_gradient - regular_gradient).norm()/regular_gradient.norm().clamp(min=1e-30)).item()
+    flushed_to_zero = (chunked_gradient.eq(0) & regular_gradient.ne(0)).float().mean().item()
+    within_tolerance = relative_error <= args.tolerance
+    print(name, "Relative error:", relative_error, "Fraction of entries flushed to zero:", flushed_to_zero, "OK" if within_tolerance else "MISMATCH")
+    return within_tolerance
+
+
+def scaled_gradients(loss, tensors, args):
+    """Backpropagates the loss multiplied by the loss scale like the GradScaler does and returns the unscaled gradients of the given tensors."""
+    gradients = torch.autograd.grad(loss*args.loss_scale, tensors)
+    return [gradient.float()/args.loss_scale for gradient in gradients]
+
+
+def check_chunked_cross_entropy(args):
+    """Compares the gradients of chunked_label_smoothed_nll_loss with those of label_smoothed_nll_loss on random hidden states."""
+    dtype = torch.float16 if args.fp16 else torch.float32
+    hidden_states = torch.randn(args.batch_size, args.target_length, args.d_model, device=args.device, dtype=dtype, requires_grad=True)
+    weight = (torch.randn(args.vocab_size, args.d_model, device=args.device)*args.d_model**-0.5).requires_grad_()
+    bias = torch.zeros(1, args.vocab_size, device=args.device)
+    labels = torch.randint(1, args.vocab_size, (args.batch_size, args.target_length), device=args.device)
+    labels[:, args.target_length*3//4:] = 0 ## Some padding.
+    with torch.cuda.amp.autocast(enabled=args.fp16):
+        logits = torch.nn.functional.linear(hidden_states, weight) + bias
+        regular_loss = label_smoothed_nll_loss(torch.nn.functional.log_softmax(logits.float(), dim=-1), labels, args.label_smoothing, ignore_index=0)
+    regular_gradients = scaled_gradients(regular_loss, [hidden_states, weight], args)
+    with torch.cuda.amp.autocast(enabled=args.fp16):
+        chunked_loss = chunked_label_smoothed_nll_loss(hidden_states, weight, bias, labels, args.label_smoothing, 0, chunk_size=args.chunk_size)
+    chunked_gradients = scaled_gradients(chunked_loss, [hidden_states, weight], args)
+    print("Chunked cross entropy loss:", chunked_loss.item(), "Regular loss:", regular_loss.item())
+    return all([compare_gradients("Gradient of the hidden states.", chunked_gradients[0], regular_gradients[0], args), compare_gradients("Gradient of the lm_head weight.", chunked_gradients[1], regular_gradients[1], args)])
+
+
+def check_chunked_distillation(args):
+    """Compares the gradients of the chunked cross_entropy distillation loss with those of the regular one on random logits."""
+    dtype = torch.float16 if args.fp16 else torch.float32
+    child_logits = torch.randn(args.batch_size, args.target_length, args.vocab_size, device=args.device, dtype=dtype, requires_grad=True)
+    parent_logits = torch.randn(args.batch_size, args.target_length, args.vocab_size, device=args.device, dtype=dtype)
+    labels = torch.randint(1, args.vocab_size, (args.batch_size, args.target_length), device=args.device)
+    labels[:, args.target_length*3//4:] = 0 ## Some padding.
+    losses, gradients = [], []
+    for chunked in [False, True]:
+        distillation_args = SimpleNamespace(distillation_styles="cross_entropy", distillation_temperature=args.distillation_temperature, chunked_distillation=chunked, distillation_top_k=0, distillation_chunk_size=args.chunk_size)
+        with torch.cuda.amp.autocast(enabled=args.fp16):
+            loss = compute_distillation_losses(SimpleNamespace(logits=child_logits), SimpleNamespace(logits=parent_logits), labels, 0, distillation_args)
+        losses.append(loss.item())
+        gradients.append(scaled_gradients(loss, [child_logits], args)[0])
+    print("Chunked distillation loss:", losses[1], "Regular loss:", losses[0])
+    return compare_gradients("Gradient of the child logits.", gradients[1], gradients[0], args)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to check that the gradients of the chunked losses (--chunked_cross_entropy and --chunked_distillation) match those of the regular losses, especially with --fp16 where the chunked gradients are computed before the loss scale of the GradScaler is applied. It runs the losses on random inputs so no model or data is needed.",
+    )
+    parser.add_argument('--vocab_size', default=64000, type=int,
+                        help='The size of the vocabulary.')
+    parser.add_argument('--d_model', default=512, type=int,
+                        help='The size of the hidden states.')
+    parser.add_argument('--batch_size', default=32, type=int,
+                        help='The number of target sentences.')
+    parser.add_argument('--target_length', default=64, type=int,
+                        help='The length of the target sentences. The more target tokens there are, the smaller each gradient entry is, which is what makes half precision underflow.')
+    parser.add_argument('--chunk_size', default=1024, type=int,
+                        help='The number of target tokens processed at a time by the chunked losses.')
+    parser.add_argument('--label_smoothing', default=0.1, type=float,
+                        help='The label smoothing of the cross entropy loss.')
+    parser.add_argument('--distillation_temperature', default=1.0, type=float,
+                        help='The softmax temperature of the distillation loss.')
+    parser.add_argument('--loss_scale', default=65536.0, type=float,
+                        help='The loss scale which the GradScaler would apply. 65536 is its initial value.')
+    parser.add_argument('--tolerance', default=1e-2, type=float,
+                        help='The largest acceptable relative error between the chunked and the regular gradients.')
+    parser.add_argument('--fp16', action='store_true',
+                        help='Should the losses be computed under autocast like they are with mixed precision training?')
+    parser.add_argument('--device', default='cuda:0', type=str,
+                        help='The device to run the check on. Use cpu to check the fp32 losses without a GPU.')
+    args = parser.parse_args()
+    print(args)
+    assert not args.fp16 or args.device.startswith("cuda"), "Mixed precision needs a GPU."
+
+    all_match = check_chunked_cross_entropy(args)
+    all_match = check_chunked_distillation(args) and all_match
+    print("All the gradients match." if all_match else "Some of the gradients do not match.")
+    if not all_match:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,22 @@ import os
 import argparse
 import time
 import sys
+import io
+import resource
+import contextlib
+import json
+import struct
+import mmap
+import collections
+import collections.abc
+import hashlib
+import threading
+import queue
+import inspect
+import copy
+import shutil
+import zipfile
+from multiprocessing.pool import ThreadPool
 os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"   # see issue #152
 ##
 
@@ -34,6 +50,7 @@ import transformers
 from transformers import AutoTokenizer, MBartTokenizer, MBart50Tokenizer, BartTokenizer
 from transformers import MBartForConditionalGeneration, MBartConfig, get_linear_schedule_with_warmup
 from transformers import AdamW
+from transformers.models.mbart.modeling_mbart import MBartPreTrainedModel
 ##
 
 
@@ -99,10 +116,136 @@ def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=None):
     loss = loss/denominator
     return loss
 
+class ChunkedLabelSmoothedCrossEntropy(torch.autograd.Function):
+    """Computes the same loss as label_smoothed_nll_loss on log_softmax(lm_head(hidden_states)+bias) without ever materializing the [tokens, vocab] logits. The tokens are processed in chunks and the gradients for each chunk are computed right away in the forward pass so that the chunk logits can be freed immediately. The backward pass only scales the stored gradients."""
+    @staticmethod
+    def forward(ctx, hidden_states, weight, bias, temperature, target, epsilon, chunk_size):
+        num_tokens, vocab_size = hidden_states.size(0), weight.size(0)
+        matmul_weight = weight.to(hidden_states.dtype) ## In case of mixed precision the hidden states are in half precision. Cast once instead of once per chunk.
+        grad_matmul_weight = weight.float() ## The gradients are computed in fp32 because they are not multiplied by the loss scale of the GradScaler until the backward pass and would underflow in half precision.
+        temperature_value = temperature.float()
+        grad_hidden_states = torch.zeros_like(hidden_states, dtype=torch.float32) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32) if ctx.needs_input_grad[1] else None
+        grad_temperature = torch.zeros_like(temperature, dtype=torch.float32) if ctx.needs_input_grad[3] else None
+        loss = torch.zeros((), dtype=torch.float32, device=hidden_states.device)
+        for start in range(0, num_tokens, chunk_size):
+            hidden_chunk = hidden_states[start:start+chunk_size]
+            target_chunk = target[start:start+chunk_size].unsqueeze(-1)
+            logits = torch.matmul(hidden_chunk, matmul_weight.t()).float()
+            if bias is not None:
+                logits += bias.float()
+            logits /= temperature_value
+            lse = torch.logsumexp(logits, dim=-1)
+            target_logits = logits.gather(-1, target_chunk).squeeze(-1)
+            logits_sum = logits.sum(dim=-1)
+            loss += (lse - (1.0-epsilon)*target_logits - (epsilon/vocab_size)*logits_sum).sum() ## -(1-eps)*log p(target) - eps/V * sum of log p over the vocabulary.
+            if grad_hidden_states is None and grad_weight is None and grad_temperature is None:
+                continue
+            grad_logits = torch.softmax(logits, dim=-1) ## d loss/d logits = softmax - (1-eps)*onehot(target) - eps/V
+            if grad_temperature is not None: ## The logits are divided by the temperature so d logits/d temperature = -logits/temperature.
+                grad_temperature -= ((grad_logits*logits).sum() - (1.0-epsilon)*target_logits.sum() - (epsilon/vocab_size)*logits_sum.sum())/(temperature_value*num_tokens)
+            del logits
+            grad_logits -= epsilon/vocab_size
+            grad_logits.scatter_add_(-1, target_chunk, grad_logits.new_full(target_chunk.size(), -(1.0-epsilon)))
+            grad_logits /= temperature_value*num_tokens ## Gradient with respect to the logits before the temperature division and the averaging over the tokens.
+            with torch.cuda.amp.autocast(enabled=False): ## Otherwise the autocast would run these matmuls in half precision.
+                if grad_hidden_states is not None:
+                    grad_hidden_states[start:start+chunk_size] = torch.matmul(grad_logits, grad_matmul_weight)
+                if grad_weight is not None:
+                    grad_weight += torch.matmul(grad_logits.t(), hidden_chunk.float())
+            del grad_logits
+        ctx.grads = (grad_hidden_states, grad_weight, grad_temperature)
+        ctx.dtypes = (hidden_states.dtype, weight.dtype, temperature.dtype)
+        return loss/num_tokens
+    
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_hidden_states, grad_weight, grad_temperature = ctx.grads
+        ctx.grads = None ## Free the stored gradients as soon as possible.
+        if grad_hidden_states is not None:
+            grad_hidden_states = (grad_hidden_states*grad_output).to(ctx.dtypes[0]) ## grad_output carries the loss scale so only now is it safe to cast to half precision.
+        if grad_weight is not None:
+            grad_weight = (grad_weight*grad_output).to(ctx.dtypes[1])
+        if grad_temperature is not None:
+            grad_temperature = (grad_temperature*grad_output).to(ctx.dtypes[2])
+        return grad_hidden_states, grad_weight, None, grad_temperature, None, None, None
+
+def chunked_label_smoothed_nll_loss(hidden_states, lm_head_weight, final_logits_bias, target, epsilon, ignore_index, temperature=1.0, chunk_size=1024):
+    """A memory efficient version of label_smoothed_nll_loss which takes the decoder hidden states and the lm_head weight instead of the log probabilities. The padding positions are dropped first and the rest are processed chunk_size tokens at a time so the memory needed is chunk_size*vocab_size instead of batch_size*target_length*vocab_size. The loss and gradients are the same as those of the regular loss up to floating point error."""
+    hidden_states = hidden_states.reshape(-1, hidden_states.size(-1))
+    target = target.reshape(-1)
+    non_pad_positions = target.ne(ignore_index).nonzero(as_tuple=True)[0]
+    hidden_states = hidden_states.index_select(0, non_pad_positions)
+    target = target.index_select(0, non_pad_positions)
+    if not torch.is_tensor(temperature):
+        temperature = torch.tensor(float(temperature), device=hidden_states.device)
+    return ChunkedLabelSmoothedCrossEntropy.apply(hidden_states, lm_head_weight, final_logits_bias.view(-1) if final_logits_bias is not None else None, temperature, target, epsilon, chunk_size)
+
+def compute_lm_loss(model, mod_compute, logits, hidden_states, labels, ignore_index, args):
+    """Computes the label smoothed cross entropy loss for the main softmax or one of the multilayer softmaxes. With --chunked_cross_entropy the logits are never used and the loss is computed from the hidden states instead."""
+    if not args.chunked_cross_entropy:
+        lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
+        return label_smoothed_nll_loss(lprobs, labels, args.label_smoothing, ignore_index=ignore_index) ## Label smoothed cross entropy loss.
+    module = model.module if isinstance(model, DistributedDataParallel) else model ## The batch size probe runs before the model is wrapped.
+    temperature = module.config.softmax_temperature ## The model divides the logits by this and the calibrated temperature.
+    if args.temperature_calibration:
+        temperature = mod_compute.softmax_temperature*temperature
+    return chunked_label_smoothed_nll_loss(hidden_states, module.lm_head.weight, module.final_logits_bias, labels, args.label_smoothing, ignore_index, temperature, args.cross_entropy_chunk_size)
+
 def lmap(f, x):
     """list(map(f, x)). Converts a map into a list containing (key,value) pairs."""
     return list(map(f, x))
 
+class ChunkedDistillationCrossEntropy(torch.autograd.Function):
+    """Computes the cross_entropy distillation loss sum(p_parent*log(p_child)) a chunk of tokens at a time so that only chunk_size*vocab_size temporary tensors exist instead of several [batch, length, vocab] ones. The gradient with respect to the child logits is computed in the forward pass for each chunk. If top_k > 0 then the parent distribution is restricted to its top-k tokens and renormalized."""
+    @staticmethod
+    def forward(ctx, child_logits, parent_logits, non_pad_mask, temperature, top_k, chunk_size):
+        vocab_size = child_logits.size(-1)
+        child_logits_flat = child_logits.reshape(-1, vocab_size)
+        parent_logits_flat = parent_logits.reshape(-1, vocab_size)
+        non_pad_mask = non_pad_mask.reshape(-1).float()
+        num_positions = child_logits_flat.size(0) ## The original loss averages over all the positions, including the padding ones.
+        grad_child_logits = torch.zeros_like(child_logits_flat, dtype=torch.float32) if ctx.needs_input_grad[0] else None ## Kept in fp32 since the loss scale of the GradScaler is only applied in the backward pass and half precision would underflow.
+        loss = torch.zeros((), dtype=torch.float32, device=child_logits.device)
+        for start in range(0, num_positions, chunk_size):
+            chunk_mask = non_pad_mask[start:start+chunk_size].unsqueeze(-1)
+            child_lprobs = torch.log_softmax(child_logits_flat[start:start+chunk_size].float()/temperature, dim=-1)
+            parent_logits_chunk = parent_logits_flat[start:start+chunk_size].float()/temperature
+            if top_k > 0:
+                parent_top_logits, parent_top_ids = parent_logits_chunk.topk(top_k, dim=-1)
+                del parent_logits_chunk
+                parent_probs = torch.softmax(parent_top_logits, dim=-1) ## Renormalized over the top-k tokens.
+                loss += (parent_probs*child_lprobs.gather(-1, parent_top_ids)*chunk_mask).sum()
+            else:
+                parent_probs = torch.softmax(parent_logits_chunk, dim=-1)
+                del parent_logits_chunk
+                loss += (parent_probs*child_lprobs*chunk_mask).sum()
+            if grad_child_logits is None:
+                continue
+            grad_chunk = child_lprobs.exp_().neg_() ## d/d child logits of sum(p*log(q)) is p-q since p sums to 1.
+            if top_k > 0:
+                grad_chunk.scatter_add_(-1, parent_top_ids, parent_probs)
+            else:
+                grad_chunk += parent_probs
+            grad_chunk *= chunk_mask*(temperature/num_positions) ## The logits are divided by the temperature and the loss is multiplied by its square.
+            grad_child_logits[start:start+chunk_size] = grad_chunk
+            del grad_chunk, parent_probs
+        ctx.grad_child_logits = grad_child_logits.view(child_logits.size()) if grad_child_logits is not None else None
+        ctx.child_logits_dtype = child_logits.dtype
+        return loss*(temperature**2)/num_positions
+    
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_child_logits = ctx.grad_child_logits
+        ctx.grad_child_logits = None
+        if grad_child_logits is not None:
+            grad_child_logits = (grad_child_logits*grad_output.float()).to(ctx.child_logits_dtype) ## grad_output carries the loss scale so only now is it safe to cast to half precision.
+        return grad_child_logits, None, None, None, None, None
+
+def chunked_distillation_cross_entropy(child_logits, parent_logits, pad_mask, temperature, top_k=0, chunk_size=1024):
+    """A memory efficient version of the cross_entropy distillation loss computed by compute_distillation_losses. With top_k=0 the value and gradients are the same as those of the regular loss."""
+    return ChunkedDistillationCrossEntropy.apply(child_logits, parent_logits.detach(), ~pad_mask, float(temperature), top_k, chunk_size)
+
 def compute_distillation_losses(child_mod_compute, parent_mod_compute, target, ignore_index, args):
     """Implemented by me. This is based on distill bert, distill mbart etc. This method is run when the 'distillation' argument is passed.
     There are 3 types of distillation losses for now: cross_entropy, hidden_layer_regression and attention_distillation.
@@ -116,7 +259,10 @@ def compute_distillation_losses(child_mod_compute, parent_mod_compute, target, i
     pad_mask = target.eq(ignore_index)
             
     for distillation_loss_to_compute in distillation_losses_to_compute:
-        if distillation_loss_to_compute == "cross_entropy":
+        if distillation_loss_to_compute == "cross_entropy" and (args.chunked_distillation or args.distillation_top_k > 0):
+            distillation_cross_entropy = chunked_distillation_cross_entropy(child_mod_compute.logits, parent_mod_compute.logits, pad_mask, args.distillation_temperature, args.distillation_top_k, args.distillation_chunk_size)
+            all_distillation_losses.append(distillation_cross_entropy)
+        elif distillation_loss_to_compute == "cross_entropy":
             parent_logits = parent_mod_compute.logits
             parent_lprobs = torch.nn.functional.log_softmax(parent_logits/args.distillation_temperature, dim=-1)
             child_logits = child_mod_compute.logits
@@ -172,81 +318,792 @@ def compute_distillation_losses(child_mod_compute, parent_mod_compute, target, i
         
     return -torch.mean(torch.stack(all_distillation_losses), dim=0)
 
+def teacher_cache_key(input_ids, decoder_input_ids, pad_token_id):
+    """Hashes the non padding tokens of the parent's source and the decoder input of one example. This identifies the example irrespective of the batch it ends up in."""
+    input_ids = input_ids[input_ids != pad_token_id].numpy().astype(np.int32)
+    decoder_input_ids = decoder_input_ids[decoder_input_ids != pad_token_id].numpy().astype(np.int32)
+    return int.from_bytes(hashlib.blake2b(input_ids.tobytes() + b"|" + decoder_input_ids.tobytes(), digest_size=8).digest(), "little")
+
+class TeacherOutputCache:
+    """Stores the top-k token ids and log probabilities of the parent for every target token of every training example, and optionally the parent's decoder hidden states, in flat files that are memory mapped when training the child. Each process has its own files for its own shard of the training data. The examples are found via teacher_cache_key so the order of the training batches does not matter."""
+    def __init__(self, path, rank, pad_token_id, write=False, top_k=None, hidden_size=None, num_hidden_layers=0):
+        self.prefix = path+"."+"%02d" % rank
+        self.pad_token_id = pad_token_id
+        self.write = write
+        if write:
+            self.top_k, self.hidden_size, self.num_hidden_layers = top_k, hidden_size, num_hidden_layers
+            self.ids_file = open(self.prefix+".ids", "wb")
+            self.lprobs_file = open(self.prefix+".lprobs", "wb")
+            self.hidden_file = open(self.prefix+".hidden", "wb") if num_hidden_layers > 0 else None
+            self.keys, self.offsets, self.lengths = [], [], []
+            self.num_tokens = 0
+            return
+        meta = json.load(open(self.prefix+".json"))
+        self.top_k, self.hidden_size, self.num_hidden_layers, self.num_tokens = meta["top_k"], meta["hidden_size"], meta["num_hidden_layers"], meta["num_tokens"]
+        self.ids = np.memmap(self.prefix+".ids", dtype=np.int32, mode="r", shape=(self.num_tokens, self.top_k))
+        self.lprobs = np.memmap(self.prefix+".lprobs", dtype=np.float16, mode="r", shape=(self.num_tokens, self.top_k))
+        self.hidden = np.memmap(self.prefix+".hidden", dtype=np.float16, mode="r", shape=(self.num_tokens, self.num_hidden_layers, self.hidden_size)) if self.num_hidden_layers > 0 else None
+        index = np.load(self.prefix+".index.npz")
+        self.index = dict(zip(index["keys"].tolist(), zip(index["offsets"].tolist(), index["lengths"].tolist())))
+        self.lookups, self.misses = 0, 0
+        print("Loaded the parent outputs for", len(self.index), "examples and", self.num_tokens, "tokens from", self.prefix)
+    
+    def add(self, input_ids, decoder_input_ids, top_ids, top_lprobs, hidden_states=None):
+        """Appends the outputs of the parent for a batch. top_ids and top_lprobs are [batch, length, k] and hidden_states, if any, is [batch, length, layers, hidden size]. All of them should be on the CPU."""
+        lengths = decoder_input_ids.ne(self.pad_token_id).sum(dim=1).tolist() ## The padding is always at the end.
+        for row, length in enumerate(lengths):
+            self.keys.append(teacher_cache_key(input_ids[row], decoder_input_ids[row], self.pad_token_id))
+            self.offsets.append(self.num_tokens)
+            self.lengths.append(length)
+            self.ids_file.write(top_ids[row, :length].numpy().astype(np.int32).tobytes())
+            self.lprobs_file.write(top_lprobs[row, :length].numpy().astype(np.float16).tobytes())
+            if self.hidden_file is not None:
+                self.hidden_file.write(hidden_states[row, :length].numpy().astype(np.float16).tobytes())
+            self.num_tokens += length
+    
+    def close(self):
+        """Writes the index and the metadata once all the examples have been added."""
+        for f in [self.ids_file, self.lprobs_file, self.hidden_file]:
+            if f is not None:
+                f.close()
+        np.savez(self.prefix+".index.npz", keys=np.array(self.keys, dtype=np.uint64), offsets=np.array(self.offsets, dtype=np.int64), lengths=np.array(self.lengths, dtype=np.int64))
+        json.dump({"top_k": self.top_k, "hidden_size": self.hidden_size, "num_hidden_layers": self.num_hidden_layers, "num_tokens": self.num_tokens}, open(self.prefix+".json", "w"))
+        print("Cached the parent outputs for", len(self.keys), "examples and", self.num_tokens, "tokens in", self.prefix)
+    
+    def lookup(self, input_ids, decoder_input_ids):
+        """Returns the cached parent outputs for a training batch as [batch, length, k] top-k ids and log probabilities, the [batch, length, layers, hidden size] hidden states if they were cached and a [batch] mask of the examples that were found. Examples not in the cache are left out of the distillation loss."""
+        input_ids, decoder_input_ids = input_ids.cpu(), decoder_input_ids.cpu()
+        batch_size, length = decoder_input_ids.size()
+        top_ids = np.zeros((batch_size, length, self.top_k), dtype=np.int64)
+        top_lprobs = np.zeros((batch_size, length, self.top_k), dtype=np.float32)
+        hidden_states = np.zeros((batch_size, length, self.num_hidden_layers, self.hidden_size), dtype=np.float16) if self.hidden is not None else None
+        found = np.zeros(batch_size, dtype=bool)
+        for row in range(batch_size):
+            self.lookups += 1
+            entry = self.index.get(teacher_cache_key(input_ids[row], decoder_input_ids[row], self.pad_token_id))
+            if entry is None:
+                self.misses += 1
+                continue
+            offset, cached_length = entry
+            found[row] = True
+            top_ids[row, :cached_length] = self.ids[offset:offset+cached_length]
+            top_lprobs[row, :cached_length] = self.lprobs[offset:offset+cached_length]
+            if hidden_states is not None:
+                hidden_states[row, :cached_length] = self.hidden[offset:offset+cached_length]
+        if self.misses > 0 and self.lookups % 100000 < batch_size:
+            print("So far", self.misses, "out of", self.lookups, "training examples were not found in the teacher cache.")
+        return {"top_ids": torch.from_numpy(top_ids), "top_lprobs": torch.from_numpy(top_lprobs), "hidden_states": torch.from_numpy(hidden_states) if hidden_states is not None else None, "found": torch.from_numpy(found)}
+
+class FrozenTeacher:
+    """Runs the parent model for distillation. The parent is never trained so it is not wrapped in DDP, its parameters are frozen, it runs without dropout and without keeping any autograd state and it can be kept in half precision. It only returns the hidden states and attentions if the distillation styles need them. Dynamic int8 quantization only works on the CPU so an int8 parent runs on the CPU which frees GPU memory for the child at the cost of speed."""
+    def __init__(self, model, args, gpu):
+        distillation_styles = args.distillation_styles.split(",")
+        self.output_hidden_states = "hidden_layer_regression" in distillation_styles
+        self.output_attentions = "attention_distillation" in distillation_styles
+        self.precision = args.parent_precision
+        self.gpu = gpu
+        self.device = "cpu" if self.precision == "int8" else gpu
+        freeze_params(model)
+        model.eval()
+        if self.precision == "fp16":
+            model.half()
+        elif self.precision == "bf16":
+            model.to(torch.bfloat16)
+        elif self.precision == "int8":
+            quantize_model_dynamic_int8(model)
+        self.model = model.to(self.device)
+        self.config = model.config
+        print("The parent model runs on", self.device, "in", self.precision, "and returns", "hidden states," if self.output_hidden_states else "", "attentions," if self.output_attentions else "", "logits.")
+    
+    def move_to_child(self, obj):
+        """Moves the parent outputs to the GPU of the child in float32 since the distillation losses mix them with the child outputs."""
+        if torch.is_tensor(obj):
+            return obj.to(self.gpu, torch.float32 if obj.is_floating_point() else obj.dtype)
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.move_to_child(value) for value in obj)
+        return obj
+    
+    def __call__(self, input_ids, attention_mask, decoder_input_ids, output_hidden_states=None, output_attentions=None):
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=torch.is_autocast_enabled() and self.precision == "fp32"): ## A half precision parent should not be cast again by the autocast of the child.
+            parent_mod_compute = self.model(input_ids=input_ids.to(self.device), attention_mask=attention_mask.to(self.device), decoder_input_ids=decoder_input_ids.to(self.device), output_hidden_states=self.output_hidden_states if output_hidden_states is None else output_hidden_states, output_attentions=self.output_attentions if output_attentions is None else output_attentions)
+            for key in list(parent_mod_compute.keys()):
+                if key in ["logits", "encoder_hidden_states", "decoder_hidden_states", "encoder_attentions", "decoder_attentions", "cross_attentions"]:
+                    parent_mod_compute[key] = self.move_to_child(parent_mod_compute[key])
+        return parent_mod_compute
+
+def dump_teacher_outputs(parent_model, tok, args, files, rank):
+    """This is the first phase of offline distillation. The parent, a FrozenTeacher, is run once over the training shard of this process and its outputs are cached so that the child can later be trained without the parent. The decoder hidden states of the parent layers in distillation_layer_mapping are cached too if hidden_layer_regression is among the distillation styles."""
+    parent_layers = []
+    if "hidden_layer_regression" in args.distillation_styles.split(","):
+        parent_layers = [int(layer_mapping.split("-")[0])-1 for layer_mapping in args.distillation_layer_mapping.strip().split(",")]
+    teacher_cache = TeacherOutputCache(args.teacher_cache_path, rank, tok.pad_token_id, write=True, top_k=args.teacher_cache_top_k, hidden_size=parent_model.config.d_model, num_hidden_layers=len(parent_layers))
+    start = time.time()
+    num_batches = 0
+    with torch.no_grad():
+        for input_ids, input_masks, decoder_input_ids in generate_batches_for_teacher_cache(tok, args, files, rank):
+            parent_mod_compute = parent_model(input_ids, input_masks, decoder_input_ids, output_hidden_states=len(parent_layers) > 0, output_attentions=False) ## The parent is a FrozenTeacher.
+            top_lprobs, top_ids = torch.nn.functional.log_softmax(parent_mod_compute.logits, dim=-1).topk(args.teacher_cache_top_k, dim=-1)
+            hidden_states = torch.stack([parent_mod_compute.decoder_hidden_states[layer] for layer in parent_layers], dim=2).cpu() if len(parent_layers) > 0 else None
+            teacher_cache.add(input_ids, decoder_input_ids, top_ids.cpu(), top_lprobs.cpu(), hidden_states)
+            num_batches += 1
+            if num_batches % 100 == 0:
+                print("Cached the parent outputs for", num_batches, "batches in", time.time()-start, "seconds.")
+                sys.stdout.flush()
+    teacher_cache.close()
+
+def compute_cached_distillation_losses(child_mod_compute, cached_teacher_outputs, target, ignore_index, args):
+    """The counterpart of compute_distillation_losses when the parent outputs come from a TeacherOutputCache. cross_entropy uses the parent's top-k distribution renormalized over the top-k tokens. hidden_layer_regression only uses the decoder hidden states since those of the encoder are not cached. attention_distillation is not supported."""
+    all_distillation_losses = []
+    device = child_mod_compute.logits.device if child_mod_compute.logits is not None else target.device
+    pad_mask = target.eq(ignore_index) | ~cached_teacher_outputs["found"].to(device).unsqueeze(1) ## Examples missing from the cache are treated like padding.
+    pad_mask = pad_mask.unsqueeze(-1)
+    for distillation_loss_to_compute in args.distillation_styles.split(","):
+        if distillation_loss_to_compute == "cross_entropy":
+            child_logits = child_mod_compute.logits/args.distillation_temperature
+            child_top_lprobs = child_logits.gather(-1, cached_teacher_outputs["top_ids"].to(device)) - torch.logsumexp(child_logits.float(), dim=-1, keepdim=True)
+            parent_top_probs = torch.softmax(cached_teacher_outputs["top_lprobs"].to(device)/args.distillation_temperature, dim=-1)
+            distillation_cross_entropy = (parent_top_probs*child_top_lprobs).masked_fill(pad_mask, 0.0).sum(dim=-1)
+            distillation_cross_entropy = distillation_cross_entropy.mean() * args.distillation_temperature**2
+            all_distillation_losses.append(distillation_cross_entropy)
+        elif distillation_loss_to_compute == "hidden_layer_regression":
+            if cached_teacher_outputs["hidden_states"] is None:
+                raise ValueError("The teacher cache has no hidden states. Dump it again with hidden_layer_regression among the distillation styles.")
+            parent_hidden_states = cached_teacher_outputs["hidden_states"].to(device)
+            all_regression_losses = []
+            for layer_idx, layer_mapping in enumerate(args.distillation_layer_mapping.strip().split(",")):
+                child_layer_idx = int(layer_mapping.split("-")[1])-1
+                child_decoder_layer_state = child_mod_compute.decoder_hidden_states[child_layer_idx]
+                decoder_l2_loss = (parent_hidden_states[:, :, layer_idx].to(child_decoder_layer_state.dtype)-child_decoder_layer_state)**2
+                decoder_l2_loss = decoder_l2_loss.masked_fill(pad_mask, 0.0)
+                all_regression_losses.append(decoder_l2_loss.sum(dim=-1).mean())
+            regression_loss = torch.mean(torch.stack(all_regression_losses), dim=0)
+            all_distillation_losses.append(-regression_loss) ## We will take a negative later so this minus sign here is to negate its effect. We want to minimize the L2 loss after all.
+        else:
+            raise ValueError("The %s distillation loss cannot be computed from the teacher cache." % distillation_loss_to_compute)
+    return -torch.mean(torch.stack(all_distillation_losses), dim=0)
+
+def register_ddp_comm_hook(model, args, process_group=None):
+    """Registers a DDP communication hook that compresses gradients before they are all-reduced. fp16 and bf16 halve the bytes sent. PowerSGD sends low rank approximations of the gradient matrices and keeps the approximation error to add to the next step's gradients (error feedback)."""
+    if args.ddp_comm_hook == "none":
+        return None
+    try:
+        from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+    except ImportError:
+        raise ValueError("DDP communication hooks need pytorch 1.7 or above.")
+    if args.ddp_comm_hook == "fp16":
+        model.register_comm_hook(process_group, default_hooks.fp16_compress_hook)
+        return None
+    elif args.ddp_comm_hook == "bf16":
+        if not hasattr(default_hooks, "bf16_compress_hook"):
+            raise ValueError("The bf16 communication hook needs pytorch 1.10 or above. Use fp16 instead.")
+        model.register_comm_hook(process_group, default_hooks.bf16_compress_hook)
+        return None
+    elif args.ddp_comm_hook in ["powersgd", "batched_powersgd"]:
+        try:
+            from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook as powerSGD
+        except ImportError:
+            raise ValueError("The PowerSGD communication hook needs pytorch 1.8 or above.")
+        state_kwargs = {"process_group": process_group, "matrix_approximation_rank": args.powersgd_rank, "start_powerSGD_iter": args.powersgd_start_iteration, "use_error_feedback": True} ## Plain all-reduce is used for the first few iterations since compressing noisy early gradients hurts convergence.
+        if "warm_start" in inspect.signature(powerSGD.PowerSGDState).parameters: ## Reusing the low rank factors of the previous step is only possible from pytorch 1.9.
+            state_kwargs["warm_start"] = True
+        state = powerSGD.PowerSGDState(**state_kwargs)
+        model.register_comm_hook(state, powerSGD.powerSGD_hook if args.ddp_comm_hook == "powersgd" else powerSGD.batched_powerSGD_hook)
+        return state
+    else:
+        raise ValueError("Unknown DDP communication hook: " + args.ddp_comm_hook)
+
+class TrainingMetrics:
+    """Keeps running sums of losses and batch statistics on the GPU and hands them to a background thread every log_every optimizer steps. The thread waits for the GPU, writes the averages to tensorboard and prints the loss, so the training loop itself never waits for the GPU just to log something. The forward, backward and optimizer times are host side times, which is how long the CPU took to launch the work. The step time and throughputs are averaged over the whole interval so they are exact."""
+    def __init__(self, writer, log_every, device, enabled=True):
+        self.writer = writer
+        self.log_every = log_every
+        self.device = device
+        self.enabled = enabled
+        self.reset()
+        if self.enabled:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.write_worker, daemon=True)
+            self.thread.start()
+    
+    def reset(self):
+        """Starts a new logging interval."""
+        self.sums = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.times = collections.OrderedDict()
+        self.totals = collections.Counter()
+        self.num_steps = 0
+        self.interval_start = time.time()
+    
+    def add(self, name, value):
+        """Adds a value whose average over the interval will be logged. Tensors are summed on their device without waiting for them."""
+        if not self.enabled:
+            return
+        value = value.detach().float() if torch.is_tensor(value) else float(value)
+        self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.counts[name] += 1
+    
+    def add_time(self, name, seconds):
+        """Adds to the time spent on a part of the training step."""
+        if self.enabled:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+    
+    def add_batch(self, input_ids, input_masks, labels, pad_token_id):
+        """Counts the sentences, tokens and padding of a batch. The token counts stay on the GPU."""
+        if not self.enabled:
+            return
+        self.totals["sentences"] += input_ids.size(0)
+        self.totals["positions"] += input_ids.numel() + labels.numel()
+        tokens = input_masks.sum() + labels.ne(pad_token_id).sum()
+        self.sums["tokens"] = self.sums["tokens"] + tokens if "tokens" in self.sums else tokens
+    
+    def timed_batches(self, batch_generator):
+        """Yields the batches of a generator while keeping track of the time spent waiting for them."""
+        while True:
+            start = time.time()
+            try:
+                batch = next(batch_generator)
+            except StopIteration:
+                return
+            self.add_time("data wait", time.time() - start)
+            yield batch
+    
+    def step(self, ctr):
+        """Call after every optimizer step. Every log_every steps the sums are copied to the CPU asynchronously and passed to the background thread."""
+        if not self.enabled:
+            return
+        self.num_steps += 1
+        if self.num_steps < self.log_every:
+            return
+        tensor_names = [name for name in self.sums if torch.is_tensor(self.sums[name])]
+        event = None
+        cpu_values = None
+        if len(tensor_names) > 0:
+            values = torch.stack([self.sums[name].to(self.device).reshape(()) for name in tensor_names])
+            cpu_values = torch.empty(values.size(), dtype=values.dtype, pin_memory=values.is_cuda)
+            cpu_values.copy_(values, non_blocking=True)
+            if values.is_cuda:
+                event = torch.cuda.Event()
+                event.record()
+        python_values = {name: value for name, value in self.sums.items() if not torch.is_tensor(value)}
+        self.queue.put((ctr, tensor_names, cpu_values, event, python_values, dict(self.counts), dict(self.times), dict(self.totals), self.num_steps, time.time() - self.interval_start))
+        self.reset()
+    
+    def write_worker(self):
+        """Waits for the values of each interval to reach the CPU and then logs them."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            ctr, tensor_names, cpu_values, event, python_values, counts, times, totals, num_steps, elapsed = item
+            if event is not None:
+                event.synchronize()
+            values = dict(python_values)
+            if cpu_values is not None:
+                values.update({name: value for name, value in zip(tensor_names, cpu_values.tolist())})
+            scalars = {name: value/counts[name] for name, value in values.items() if name != "tokens"}
+            tokens = values.get("tokens", 0)
+            scalars["tokens per second"] = tokens/elapsed
+            scalars["sentences per second"] = totals.get("sentences", 0)/elapsed
+            scalars["padding ratio"] = 1.0 - tokens/totals["positions"] if totals.get("positions", 0) > 0 else 0.0
+            scalars["step time"] = elapsed/num_steps
+            for name, seconds in times.items():
+                scalars[name + " time"] = seconds/num_steps
+            if self.writer is not None:
+                for name, value in scalars.items():
+                    writer_name = "time/" + name if name.endswith(" time") else name
+                    self.writer.add_scalar(writer_name, value, ctr)
+                self.writer.flush()
+            print(ctr, scalars.get("training loss", "NA"), elapsed, "seconds for", num_steps, "batches.", "Tokens per second:", scalars["tokens per second"], "Padding ratio:", scalars["padding ratio"])
+            sys.stdout.flush()
+    
+    def close(self):
+        """Waits for everything queued so far to be logged."""
+        if self.enabled:
+            self.queue.put(None)
+            self.thread.join()
+
+class StepProfiler:
+    """Profiles a range of steps with the pytorch profiler and keeps track of the time spent in named spans of a step like the forward pass or evaluation. The spans show up as labelled blocks in the trace. Outside the profiled range a span costs two calls to time.time(). Works with and without GPUs."""
+    def __init__(self, args, rank, use_cuda, output_dir, writer=None):
+        self.enabled = args.profile_steps > 0 and rank == args.profile_rank
+        self.start_step = args.profile_start_step
+        self.end_step = args.profile_start_step + args.profile_steps
+        self.use_cuda = use_cuda and torch.cuda.is_available()
+        self.record_shapes = args.profile_record_shapes
+        self.profile_memory = args.profile_memory
+        self.with_stack = args.profile_with_stack
+        self.output_dir = output_dir
+        self.writer = writer
+        self.rank = rank
+        self.step_num = 0
+        self.profiler = None
+        self.open_spans = {}
+        self.span_times = collections.OrderedDict()
+        self.span_counts = collections.Counter()
+        if self.enabled and self.start_step == 0:
+            self.start()
+    
+    def start(self):
+        """Starts the profiler. The new profiler API (torch >= 1.8.1) is used if it is there since its traces can be viewed in tensorboard. Otherwise we fall back to the autograd profiler whose traces can only be viewed in chrome://tracing."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        if hasattr(torch, "profiler") and hasattr(torch.profiler, "tensorboard_trace_handler"):
+            activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if self.use_cuda else [])
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=self.record_shapes, profile_memory=self.profile_memory, with_stack=self.with_stack)
+            self.profiler.start()
+        else:
+            supported_options = inspect.signature(torch.autograd.profiler.profile.__init__).parameters ## Older versions dont support all the options.
+            options = {option: value for option, value in [("record_shapes", self.record_shapes), ("profile_memory", self.profile_memory), ("with_stack", self.with_stack)] if option in supported_options}
+            self.profiler = torch.autograd.profiler.profile(use_cuda=self.use_cuda, **options)
+            self.profiler.__enter__()
+        print("Profiling steps", self.start_step, "to", self.end_step-1, "on rank", self.rank)
+    
+    def stop(self):
+        """Stops the profiler and writes the chrome trace, the tensorboard trace if possible and a table of the most expensive operators."""
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        if hasattr(self.profiler, "stop"):
+            self.profiler.stop()
+            torch.profiler.tensorboard_trace_handler(self.output_dir, worker_name="rank"+str(self.rank))(self.profiler) ## Point tensorboard to the profile directory to see this trace.
+        else:
+            self.profiler.__exit__(None, None, None)
+        trace_path = os.path.join(self.output_dir, "trace.rank"+str(self.rank)+".json")
+        self.profiler.export_chrome_trace(trace_path)
+        sort_by = "self_cuda_time_total" if self.use_cuda else "self_cpu_time_total"
+        table = self.profiler.key_averages(group_by_input_shape=self.record_shapes).table(sort_by=sort_by, row_limit=30)
+        with open(os.path.join(self.output_dir, "operators.rank"+str(self.rank)+".txt"), "w") as f:
+            f.write(table)
+        if self.writer is not None:
+            self.writer.add_text("profile/operators", "<pre>"+table+"</pre>", self.step_num)
+        print(table)
+        print("The chrome trace was saved to", trace_path, "Open it via chrome://tracing or https://ui.perfetto.dev")
+        sys.stdout.flush()
+        self.profiler = None
+    
+    def step(self):
+        """Call after every step. Starts and stops the profiler when we enter and leave the step range."""
+        if not self.enabled:
+            return
+        self.step_num += 1
+        if self.step_num == self.start_step:
+            self.start()
+        elif self.step_num == self.end_step and self.profiler is not None:
+            self.stop()
+    
+    def begin(self, name):
+        """Opens a span. Spans of different names may be nested."""
+        if self.profiler is not None:
+            if self.use_cuda:
+                torch.cuda.synchronize() ## Only while profiling so that the span times are the times of the GPU work.
+            record = torch.autograd.profiler.record_function(name)
+            record.__enter__()
+        else:
+            record = None
+        self.open_spans[name] = (time.time(), record)
+    
+    def end(self, name):
+        """Closes a span and returns the seconds spent in it."""
+        start, record = self.open_spans.pop(name)
+        if record is not None:
+            if self.use_cuda:
+                torch.cuda.synchronize()
+            record.__exit__(None, None, None)
+        elapsed = time.time() - start
+        self.span_times[name] = self.span_times.get(name, 0.0) + elapsed
+        self.span_counts[name] += 1
+        return elapsed
+    
+    @contextlib.contextmanager
+    def span(self, name):
+        """Same as begin and end but as a context manager."""
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+    
+    def close_open_spans(self):
+        """Closes all open spans without counting them. Needed when a step is abandoned midway, say due to running out of memory."""
+        for start, record in self.open_spans.values():
+            if record is not None:
+                record.__exit__(None, None, None)
+        self.open_spans = {}
+    
+    def spanned_batches(self, batch_generator, name="data"):
+        """Yields the batches of a generator where the time taken to generate each batch is a span."""
+        while True:
+            self.begin(name)
+            try:
+                batch = next(batch_generator)
+            except StopIteration:
+                self.end(name)
+                return
+            self.end(name)
+            yield batch
+    
+    def close(self):
+        """Stops the profiler if the step range was not over and prints the average time of each span."""
+        if self.profiler is not None:
+            self.stop()
+        if self.enabled:
+            for name, seconds in self.span_times.items():
+                print("Span", name, "took", seconds, "seconds in total and", seconds/self.span_counts[name], "seconds on average over", self.span_counts[name], "calls.")
+            sys.stdout.flush()
+
+def get_checkpointed_layer_indices(layer_spec, num_layers, every_k=1):
+    """Returns the indices of the layers to checkpoint. The spec is either a comma separated list of layer indices, "none" or empty in which case every k-th layer is checkpointed."""
+    if layer_spec.strip() == "none":
+        return []
+    if layer_spec.strip() != "":
+        return sorted([int(idx) for idx in layer_spec.strip().split(",")])
+    return list(range(every_k-1, num_layers, every_k)) ## Every k-th layer counting from 1.
+
+def configure_activation_checkpointing(model, encoder_layers, decoder_layers, offload=False):
+    """Makes the model recompute the activations of the given encoder and decoder layers in the backward pass instead of keeping them. Only the inputs of those layers are kept and, with offloading, they are kept in pinned CPU memory."""
+    model.config.gradient_checkpointing = len(encoder_layers) + len(decoder_layers) > 0
+    model.config.use_cache = False ## Caching is for decoding and is incompatible with checkpointing.
+    model.get_encoder().checkpointed_layers = set(encoder_layers)
+    model.get_decoder().checkpointed_layers = set(decoder_layers)
+    model.get_encoder().offload_checkpointed_activations = offload
+    model.get_decoder().offload_checkpointed_activations = offload
+
+def count_target_tokens(labels, pad_token_id):
+    """Returns the number of non padding target tokens in this batch for this process and summed over all processes. All processes have to agree on when to stop accumulating gradients so this needs one tiny all-reduce per batch."""
+    local_tokens = labels.ne(pad_token_id).sum()
+    global_tokens = local_tokens.clone()
+    dist.all_reduce(global_tokens)
+    return local_tokens, global_tokens.item()
+
+def set_gradient_synchronization(model, synchronize):
+    """Turns the DDP gradient all-reduce on or off for the next forward and backward pass. This is what DistributedDataParallel.no_sync does without having to wrap the whole forward and backward in a with block. Unsynchronized gradients stay in .grad and are all-reduced along with those of the next synchronized batch."""
+    model.require_backward_grad_sync = synchronize
+
+def scale_gradients(model, factor):
+    """Multiplies the gradients of all parameters by a factor."""
+    for param in model.parameters():
+        if param.grad is not None:
+            param.grad.mul_(factor)
+
+def allreduce_gradients(model, world_size, bucket_cap_mb=25):
+    """Averages the gradients over all processes the way DDP does but as a separate step. The gradients are flattened into buckets of about bucket_cap_mb MB so that there are only a few all-reduce calls. Parameters without gradients get zero gradients so that all processes all-reduce the same buckets."""
+    params = [param for param in model.parameters() if param.requires_grad]
+    for param in params:
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+    bucket, bucket_bytes = [], 0
+    for idx, param in enumerate(params):
+        bucket.append(param.grad)
+        bucket_bytes += param.grad.numel()*param.grad.element_size()
+        if bucket_bytes >= bucket_cap_mb*1024*1024 or idx == len(params)-1 or params[idx+1].grad.dtype != param.grad.dtype:
+            flat_grads = torch._utils._flatten_dense_tensors(bucket)
+            dist.all_reduce(flat_grads)
+            flat_grads.div_(world_size)
+            for grad, reduced_grad in zip(bucket, torch._utils._unflatten_dense_tensors(flat_grads, bucket)):
+                grad.copy_(reduced_grad)
+            bucket, bucket_bytes = [], 0
+
+def is_out_of_memory_error(error):
+    """Checks if a RuntimeError was raised because the GPU ran out of memory."""
+    return "out of memory" in str(error)
+
+def split_batch(batch, num_parts):
+    """Splits a (possibly nested) batch into at most num_parts parts along the first dimension. Tensors are split with torch.chunk and lists of python values (like domain labels) in the same way. Anything else, like a flag, is repeated in every part."""
+    if torch.is_tensor(batch):
+        return list(torch.chunk(batch, num_parts))
+    if isinstance(batch, (list, tuple)) and len(batch) > 0 and not any(torch.is_tensor(item) or isinstance(item, (list, tuple)) for item in batch):
+        part_size = -(-len(batch)//num_parts) ## Same as the part size torch.chunk uses.
+        return [batch[start:start+part_size] for start in range(0, len(batch), part_size)]
+    if isinstance(batch, (list, tuple)):
+        return [type(batch)(parts) for parts in zip(*[split_batch(item, num_parts) for item in batch])]
+    return [batch]*num_parts
+
+class BatchSizeGovernor:
+    """Adapts the batch size (args.batch_size which the batch generators read for every batch) to the GPU memory. At the start the largest batch size for which a worst case batch, where every sentence has the maximum length, survives a forward and backward pass is found. If a batch still runs out of memory during training it is split into micro batches whose gradients are accumulated so that the optimizer step is the same as for the whole batch and the batch size is lowered a little. If no batch ran out of memory for a while and the peak memory usage was low then the batch size is raised again."""
+    shrink_factor = 0.9 ## The batch size is multiplied by this after running out of memory.
+    growth_factor = 1.1 ## The batch size is multiplied by this when there is enough free memory.
+    
+    def __init__(self, args, device, enabled=True):
+        self.args = args
+        self.device = device
+        self.enabled = enabled
+        self.max_budget = args.adaptive_batch_size_max if args.adaptive_batch_size_max > 0 else 8*args.batch_size
+        self.pending = collections.deque()
+        self.current_batch = None
+        self.is_micro_batch = False
+        self.is_last_micro_batch = False
+        self.split_batch_tokens = 0
+        self.split_batch_was_last = False
+        self.num_ooms = 0
+        self.ooms_since_check = 0
+        self.steps_since_check = 0
+        self.lost_gradients = False ## Did this process throw away gradients of the current optimizer step?
+    
+    def batches(self, batch_generator):
+        """Yields the micro batches of batches which ran out of memory before getting the next batch from the generator."""
+        while True:
+            if len(self.pending) > 0:
+                self.current_batch, self.is_last_micro_batch = self.pending.popleft()
+                self.is_micro_batch = True
+            else:
+                try:
+                    self.current_batch = next(batch_generator)
+                except StopIteration:
+                    return
+                self.is_micro_batch = False
+                self.is_last_micro_batch = False
+            yield self.current_batch
+    
+    def try_batch_size(self, model, budget, sequence_length, vocab_size, pad_token_id, optimizer_state_numel):
+        """Runs a forward and backward pass on a random worst case batch and tells if it fit in memory. Memory for the optimizer state is set aside as well."""
+        args = self.args
+        rows = budget if args.batch_size_indicates_lines else max(1, budget//sequence_length)
+        reserved = input_ids = decoder_input_ids = mod_compute = loss = None
+        try:
+            reserved = torch.empty(optimizer_state_numel, dtype=torch.float32, device=self.device)
+            input_ids = torch.randint(0, vocab_size, (rows, sequence_length), device=self.device)
+            input_ids.masked_fill_(input_ids.eq(pad_token_id), (pad_token_id+1) % vocab_size) ## No padding in a worst case batch.
+            decoder_input_ids = torch.randint(0, vocab_size, (rows, sequence_length), device=self.device)
+            decoder_input_ids.masked_fill_(decoder_input_ids.eq(pad_token_id), (pad_token_id+1) % vocab_size)
+            with torch.cuda.amp.autocast(enabled=args.fp16):
+                mod_compute = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), decoder_input_ids=decoder_input_ids)
+                loss = compute_lm_loss(model, mod_compute, mod_compute.logits, mod_compute.lm_hidden_states, decoder_input_ids, pad_token_id, args)
+            loss.backward()
+            torch.cuda.synchronize(self.device)
+            fits = True
+        except RuntimeError as e:
+            if not is_out_of_memory_error(e):
+                raise
+            fits = False
+        reserved = input_ids = decoder_input_ids = mod_compute = loss = None
+        for param in model.parameters():
+            param.grad = None
+        torch.cuda.empty_cache()
+        print("A batch size of", budget, "with", rows, "sentences of length", sequence_length, "fits in memory." if fits else "does not fit in memory.")
+        return fits
+    
+    def probe(self, model, sequence_length, vocab_size, pad_token_id):
+        """Finds the largest batch size for which a worst case batch fits in memory. The batch size is doubled till it does not fit and then a binary search is done. The result is multiplied by a safety margin and the smallest value over all processes is used. Call this before wrapping the model with DDP since these passes must not all-reduce anything."""
+        args = self.args
+        model.train()
+        num_params = sum(param.numel() for param in model.parameters() if param.requires_grad)
+        optimizer_state_numel = (2*num_params)//(args.world_size if args.shard_optimizer_state else 1) + num_params ## The AdamW moments and the DDP gradient buckets.
+        min_budget = 1 if args.batch_size_indicates_lines else sequence_length
+        low, high = 0, None
+        budget = min(args.batch_size, self.max_budget)
+        while True: ## Go up till we run out of memory.
+            if self.try_batch_size(model, budget, sequence_length, vocab_size, pad_token_id, optimizer_state_numel):
+                low = budget
+                if budget >= self.max_budget:
+                    break
+                budget = min(2*budget, self.max_budget)
+            else:
+                high = budget
+                break
+        while low == 0: ## Go down till we fit.
+            budget = high//2
+            if budget < min_budget:
+                raise RuntimeError("Not even a single sentence of length %d fits in memory. Reduce the maximum sequence lengths or use activation checkpointing." % sequence_length)
+            if self.try_batch_size(model, budget, sequence_length, vocab_size, pad_token_id, optimizer_state_numel):
+                low = budget
+            else:
+                high = budget
+        while high is not None and high - low > max(min_budget, low//20): ## Binary search till we are within 5 percent.
+            budget = (low + high)//2
+            if self.try_batch_size(model, budget, sequence_length, vocab_size, pad_token_id, optimizer_state_numel):
+                low = budget
+            else:
+                high = budget
+        budget = torch.tensor(max(min_budget, int(low*args.adaptive_batch_size_safety_margin)), device=self.device)
+        dist.all_reduce(budget, op=dist.ReduceOp.MIN) ## Every process uses the same batch size.
+        args.batch_size = budget.item()
+        torch.cuda.reset_peak_memory_stats(self.device)
+        print("The largest batch size that safely fits in memory is", args.batch_size)
+        sys.stdout.flush()
+        return args.batch_size
+    
+    def recover_from_oom(self, optimizer, labels, pad_token_id, is_last_batch_of_optimizer_step, in_backward):
+        """Call after the current batch ran out of memory. The batch is split into 2 micro batches which will be yielded next. If the error happened in the backward pass then some gradients of this batch were already accumulated so the gradients of the current optimizer step are thrown away and, via skip_optimizer_step, the step is skipped by all processes."""
+        self.num_ooms += 1
+        self.ooms_since_check += 1
+        if in_backward:
+            optimizer.zero_grad()
+            self.lost_gradients = True
+            print("Ran out of memory in the backward pass. The gradients computed so far for this optimizer step are lost and the step will be skipped.")
+        torch.cuda.empty_cache()
+        if not self.is_micro_batch: ## Micro batches are weighed by their share of the tokens of the batch they came from.
+            self.split_batch_tokens = labels.ne(pad_token_id).sum().item()
+            self.split_batch_was_last = is_last_batch_of_optimizer_step
+        parts = split_batch(self.current_batch, 2)
+        if len(parts) < 2:
+            raise RuntimeError("A batch with a single sentence does not fit in memory. Reduce the maximum sequence lengths or use activation checkpointing.")
+        is_last_part = [False]*(len(parts)-1) + [self.is_last_micro_batch if self.is_micro_batch else True]
+        self.pending.extendleft(reversed(list(zip(parts, is_last_part))))
+        old_batch_size = self.args.batch_size
+        self.args.batch_size = max(1, int(self.args.batch_size*self.shrink_factor))
+        print("Ran out of memory. The batch will be processed as", len(self.pending), "micro batches and the batch size is lowered from", old_batch_size, "to", self.args.batch_size, "Total out of memory errors so far:", self.num_ooms)
+        sys.stdout.flush()
+    
+    def skip_optimizer_step(self):
+        """Call on all processes before every optimizer step. Returns True if any process lost gradients of this step by running out of memory in the backward pass. The accumulated token counts and losses of that process still include the lost batches so its gradients would be under-scaled and differ from those of the others. All processes then have to skip the step together, which needs one tiny all-reduce per optimizer step."""
+        if not self.enabled:
+            return False
+        lost_gradients = torch.tensor([1 if self.lost_gradients else 0], device=self.device)
+        dist.all_reduce(lost_gradients)
+        self.lost_gradients = False
+        return lost_gradients.item() > 0
+    
+    def step(self):
+        """Call after every optimizer step. Every adaptive_batch_size_check_every steps, the batch size is raised if no batch ran out of memory and the peak memory usage was below the target."""
+        if not self.enabled:
+            return
+        self.steps_since_check += 1
+        if self.steps_since_check < self.args.adaptive_batch_size_check_every:
+            return
+        peak_memory = torch.cuda.max_memory_allocated(self.device)
+        total_memory = torch.cuda.get_device_properties(self.device).total_memory
+        torch.cuda.reset_peak_memory_stats(self.device)
+        if self.ooms_since_check == 0 and peak_memory < self.args.adaptive_batch_size_memory_target*total_memory and self.args.batch_size < self.max_budget:
+            old_batch_size = self.args.batch_size
+            self.args.batch_size = min(self.max_budget, int(self.args.batch_size*self.growth_factor))
+            print("Peak memory usage was", peak_memory/(1024*1024), "MB out of", total_memory/(1024*1024), "MB so the batch size is raised from", old_batch_size, "to", self.args.batch_size)
+            sys.stdout.flush()
+        self.steps_since_check = 0
+        self.ooms_since_check = 0
+
+class ShardedAdamW(AdamW):
+    """AdamW where each process only keeps the moments of, and updates, its own share of the parameters (ZeRO stage 1). The owners broadcast the updated parameters after every step. The param groups still contain all parameters so schedulers, gradient clipping and the gradient scaler work as before. Call consolidate_state_dict on all processes before state_dict so that the full state can be saved in the usual AdamW format."""
+    def __init__(self, params, rank, world_size, **kwargs):
+        super().__init__(params, **kwargs)
+        self.rank = rank
+        self.world_size = world_size
+        self.consolidated_state_dict = None
+        all_params = [p for group in self.param_groups for p in group["params"]]
+        shard_sizes = [0]*world_size
+        self.param_owners = {}
+        for p in sorted(all_params, key=lambda p: p.numel(), reverse=True): ## Largest first to the least loaded process. This is the same on all processes since the parameter order is.
+            owner = shard_sizes.index(min(shard_sizes))
+            self.param_owners[p] = owner
+            shard_sizes[owner] += p.numel()
+        self.params_per_owner = [[p for p in all_params if self.param_owners[p] == owner] for owner in range(world_size)]
+        print("Optimizer state is sharded. This process owns", shard_sizes[rank], "of", sum(shard_sizes), "parameters.")
+    
+    @torch.no_grad()
+    def step(self, closure=None):
+        """Updates the parameters owned by this process and then gets the rest from their owners."""
+        self.consolidated_state_dict = None ## Rank 0 should not hold on to the full state.
+        hidden_grads = []
+        for p, owner in self.param_owners.items():
+            if owner != self.rank and p.grad is not None: ## AdamW skips parameters without gradients.
+                hidden_grads.append((p, p.grad))
+                p.grad = None
+        loss = super().step(closure)
+        for p, grad in hidden_grads:
+            p.grad = grad
+        for owner, params in enumerate(self.params_per_owner):
+            if len(params) == 0:
+                continue
+            flat_params = torch._utils._flatten_dense_tensors([p.data for p in params])
+            dist.broadcast(flat_params, src=owner)
+            for p, updated_p in zip(params, torch._utils._unflatten_dense_tensors(flat_params, [p.data for p in params])):
+                p.data.copy_(updated_p)
+        return loss
+    
+    def consolidate_state_dict(self, to=0):
+        """Gathers the state of all shards in the process with rank "to". All processes must call this."""
+        all_params = [p for group in self.param_groups for p in group["params"]]
+        device = all_params[0].device
+        steps = torch.zeros(len(all_params), dtype=torch.float64, device=device) ## 0 means no state yet.
+        for idx, p in enumerate(all_params):
+            if self.param_owners[p] == self.rank and len(self.state[p]) > 0:
+                steps[idx] = self.state[p]["step"]
+        dist.all_reduce(steps)
+        full_state = {}
+        for idx, p in enumerate(all_params):
+            if steps[idx].item() == 0:
+                continue
+            owner = self.param_owners[p]
+            if owner == self.rank:
+                exp_avg, exp_avg_sq = self.state[p]["exp_avg"].clone(), self.state[p]["exp_avg_sq"].clone()
+            else:
+                exp_avg, exp_avg_sq = torch.empty_like(p), torch.empty_like(p)
+            dist.broadcast(exp_avg, src=owner)
+            dist.broadcast(exp_avg_sq, src=owner)
+            if self.rank == to:
+                full_state[idx] = {"step": int(steps[idx].item()), "exp_avg": exp_avg.cpu(), "exp_avg_sq": exp_avg_sq.cpu()} ## Kept on the CPU so that the GPU of rank 0 does not have to hold the full state. Loading moves it back to the GPU.
+        if self.rank == to:
+            self.consolidated_state_dict = super().state_dict()
+            self.consolidated_state_dict["state"] = full_state
+    
+    def state_dict(self):
+        """Returns the full optimizer state in the usual AdamW format. Only valid after consolidate_state_dict."""
+        if self.consolidated_state_dict is None:
+            raise RuntimeError("Call consolidate_state_dict on all processes before saving a sharded optimizer.")
+        return self.consolidated_state_dict
+    
+    def load_state_dict(self, state_dict):
+        """Loads a full AdamW state, which may come from an unsharded optimizer, but keeps only the state of the parameters owned by this process."""
+        all_params = [p for group in self.param_groups for p in group["params"]]
+        state_dict = {"state": {idx: param_state for idx, param_state in state_dict["state"].items() if self.param_owners[all_params[idx]] == self.rank}, "param_groups": state_dict["param_groups"]}
+        super().load_state_dict(state_dict)
+
 def remap_layers(model, idx, args): ### Cut this code into half.
-    """This method is used to remap the layers from a pretrained model to the current model. The remapping info comes in the form of 2-1,... which means, map the second layer of the pretrained model to the first layer of the current model."""
+    """This method is used to remap the layers from a pretrained model to the current model. The remapping info comes in the form of 2-1,... which means, map the second layer of the pretrained model to the first layer of the current model. Each key is split only once and the parameters are moved around by reference so no tensors are copied."""
     print("Remapping layers from parent to child.")
-    model_copy = model.copy()
-    if args.remap_encoder != "":
-        keys_to_consider = [key for key in model.keys() if ".encoder.layers" in key]
-        keys_to_keep = set() ## Keys to keep in the model dict once remapping is done as we assume that the user always specifies ALL desired target model keys to be remapped.
-        for mapping in args.remap_encoder.split(","):
-            slayer, tlayer = mapping.split("-")
-            slayer = str(int(slayer)-1) # Zero indexing
-            tlayer = str(int(tlayer)-1) # Zero indexing
-            keys_to_keep.add(slayer) ## Key remapped so it should not be deleted
-            for key in keys_to_consider:
-                key = key.strip().split(".")
-                key_copy = list(key)
-                if key[idx] == slayer:
-                    print("Remapping", key)
-                    key_copy[idx] =tlayer
-                    key = ".".join(key)
-                    key_copy = ".".join(key_copy)
-                    model[key] = model_copy[key_copy]
-        for key in keys_to_consider: ## Purge all unspecified keys.
-            key = key.strip().split(".")
-            if key[idx] not in keys_to_keep:
-                key = ".".join(key)
-                print("Deleting", key)
-                del model[key]
-
-    if args.remap_decoder != "":
-        keys_to_consider = [key for key in model.keys() if ".decoder.layers" in key]
-        keys_to_keep = set() ## Keys to keep in the model dict once remapping is done as we assume that the user always specifies ALL desired target model keys to be remapped.
-        for mapping in args.remap_encoder.split(","):
+    start = time.time()
+    for component, remappings in [("encoder", args.remap_encoder), ("decoder", args.remap_decoder)]:
+        if remappings == "":
+            continue
+        child_layers_for_parent_layer = {} ## A parent layer may be copied into several child layers.
+        for mapping in remappings.split(","):
             slayer, tlayer = mapping.split("-")
             slayer = str(int(slayer)-1) # Zero indexing
             tlayer = str(int(tlayer)-1) # Zero indexing
-            keys_to_keep.add(slayer) ## Key remapped so it should not be deleted
-            for key in keys_to_consider:
-                key = key.strip().split(".")
-                key_copy = list(key)
-                if key[idx] == slayer:
-                    print("Remapping", key)
-                    key_copy[idx] =tlayer
-                    key = ".".join(key)
-                    key_copy = ".".join(key_copy)
-                    model[key] = model_copy[key_copy]
-        for key in keys_to_consider: ## Purge all unspecified keys.
-            key = key.strip().split(".")
-            if key[idx] not in keys_to_keep:
-                key = ".".join(key)
-                print("Deleting", key)
-                del model[key]
+            child_layers_for_parent_layer.setdefault(tlayer, []).append(slayer)
+        keys_to_consider = [key for key in model.keys() if "."+component+".layers" in key]
+        remapped_params = {}
+        for key in keys_to_consider:
+            key_split = key.split(".")
+            for child_layer in child_layers_for_parent_layer.get(key_split[idx], []):
+                key_split[idx] = child_layer
+                remapped_params[".".join(key_split)] = model[key]
+        for key in keys_to_consider: ## Purge all the old keys. The ones the user asked for are added back below as we assume that the user always specifies ALL desired target model keys to be remapped.
+            del model[key]
+        model.update(remapped_params)
+        print("Remapped", len(remapped_params), component, "parameters according to", remappings)
+    print("Remapping layers took", time.time()-start, "seconds.")
     print("Final model dictionary after remapping is:", model.keys())
     return model
 
+def get_embedding_remapping_indices(args):
+    """This method will match the vocabularies of the tokenizer of the current model and that of the pretrained model. It returns two index tensors such that token our_ids[i] of the current model is the same as token pretrained_ids[i] of the pretrained model. Loading the tokenizers and matching the vocabularies is slow for large vocabularies so only the first process does it and the result is broadcast to the rest."""
+    indices = [None, None]
+    if not dist.is_initialized() or dist.get_rank() == 0:
+        tok = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True).get_vocab()
+        tok_pre = AutoTokenizer.from_pretrained(args.pretrained_tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True).get_vocab()
+        common_tokens = [token for token in tok if token in tok_pre]
+        indices = [torch.tensor([tok[token] for token in common_tokens], dtype=torch.long), torch.tensor([tok_pre[token] for token in common_tokens], dtype=torch.long)]
+        print("Found", len(common_tokens), "tokens common to both the tokenizers.")
+    if dist.is_initialized():
+        dist.broadcast_object_list(indices, src=0)
+    return indices
+
 def remap_embeddings(our_model_dict, model_to_load_dict, args):
-    """This method will consider two tokenizers, one for the pretrained model and one for the current model. It will then remap the embeddings. When we remapt embeddings we not only remap input embeddings to the encoder and decoder but also the lm head parameters which is a kind of embedding consisting of a weight matrix and biases. Note that embed positions remapping makes no sense."""
+    """This method will consider two tokenizers, one for the pretrained model and one for the current model. It will then remap the embeddings. When we remapt embeddings we not only remap input embeddings to the encoder and decoder but also the lm head parameters which is a kind of embedding consisting of a weight matrix and biases. Note that embed positions remapping makes no sense. The rows are copied in bulk using the index tensors."""
     if args.pretrained_tokenizer_name_or_path is None:
         return model_to_load_dict
     
-    tok = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True).get_vocab()
-    tok_pre = AutoTokenizer.from_pretrained(args.pretrained_tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True).get_vocab()
-    for token in tok:
-        tok_idx = tok[token]
-        if token in tok_pre:
-            pre_tok_idx = tok_pre[token]
-            our_model_dict["module.model.shared.weight"][tok_idx] = model_to_load_dict["module.model.shared.weight"][pre_tok_idx]
-            our_model_dict["module.model.encoder.embed_tokens.weight"][tok_idx] = model_to_load_dict["module.model.encoder.embed_tokens.weight"][pre_tok_idx]
-            our_model_dict["module.model.decoder.embed_tokens.weight"][tok_idx] = model_to_load_dict["module.model.decoder.embed_tokens.weight"][pre_tok_idx]
-            our_model_dict["module.lm_head.weight"][tok_idx] = model_to_load_dict["module.lm_head.weight"][pre_tok_idx]
-            our_model_dict["module.final_logits_bias"][tok_idx] = model_to_load_dict["module.final_logits_bias"][pre_tok_idx]
-    model_to_load_dict["module.model.shared.weight"] = our_model_dict["module.model.shared.weight"]
-    model_to_load_dict["module.model.encoder.embed_tokens.weight"] = our_model_dict["module.model.encoder.embed_tokens.weight"]
-    model_to_load_dict["module.model.decoder.embed_tokens.weight"] = our_model_dict["module.model.decoder.embed_tokens.weight"]
-    model_to_load_dict["module.lm_head.weight"] = our_model_dict["module.lm_head.weight"]
-    model_to_load_dict["module.final_logits_bias"] = our_model_dict["module.final_logits_bias"]
+    start = time.time()
+    our_ids, pretrained_ids = get_embedding_remapping_indices(args)
+    prefix = "module." if "module.model.shared.weight" in our_model_dict else "" ## The keys have the DDP prefix except when we work with an unwrapped model.
+    for key in ["model.shared.weight", "model.encoder.embed_tokens.weight", "model.decoder.embed_tokens.weight", "lm_head.weight"]:
+        key = prefix + key
+        our_param = our_model_dict[key]
+        our_param.index_copy_(0, our_ids.to(our_param.device), model_to_load_dict[key].index_select(0, pretrained_ids.to(model_to_load_dict[key].device)).to(our_param.device, our_param.dtype))
+        model_to_load_dict[key] = our_param
+    key = prefix + "final_logits_bias" ## The bias has the shape (1, vocab size).
+    our_param = our_model_dict[key]
+    our_param.index_copy_(1, our_ids.to(our_param.device), model_to_load_dict[key].index_select(1, pretrained_ids.to(model_to_load_dict[key].device)).to(our_param.device, our_param.dtype))
+    model_to_load_dict[key] = our_param
+    print("Remapping embeddings took", time.time()-start, "seconds.")
     return model_to_load_dict
 
 def remap_embeddings_eliminate_components_and_eliminate_mismatches(our_model_dict, model_to_load_dict, args):
@@ -256,17 +1113,17 @@ def remap_embeddings_eliminate_components_and_eliminate_mismatches(our_model_dic
     
     if args.eliminate_encoder_before_initialization:
         print("Eliminating encoder from the model to load")
-        for load_model_key in model_to_load_dict:
+        for load_model_key in list(model_to_load_dict.keys()): ## We delete keys while iterating.
             if "encoder" in load_model_key:
                 del model_to_load_dict[load_model_key]
     if args.eliminate_decoder_before_initialization:
         print("Eliminating decoder from the model to load")
-        for load_model_key in model_to_load_dict:
+        for load_model_key in list(model_to_load_dict.keys()): ## We delete keys while iterating.
             if "decoder" in load_model_key:
                 del model_to_load_dict[load_model_key]
     if args.eliminate_embeddings_before_initialization:
         print("Eliminating embeddings from the model to load")
-        for load_model_key in model_to_load_dict:
+        for load_model_key in list(model_to_load_dict.keys()): ## We delete keys while iterating.
             if "embed" in load_model_key:
                 del model_to_load_dict[load_model_key]            
     
@@ -279,6 +1136,237 @@ def remap_embeddings_eliminate_components_and_eliminate_mismatches(our_model_dic
                 del model_to_load_dict[our_model_key]
     return model_to_load_dict
 
+def checkpoint_overwrites_all_parameters(args):
+    """Returns True if loading the checkpoint will overwrite every parameter of the model. This is not the case when layers are remapped, components are eliminated or embeddings are remapped since the rows of tokens missing from the pretrained vocabulary keep their random initialization."""
+    return args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization and args.pretrained_tokenizer_name_or_path is None
+
+@contextlib.contextmanager
+def skip_weight_initialization(skip=True):
+    """Within this context the torch layers and MBart do not initialize their weights. The parameters are still allocated but are left uninitialized like torch.empty would. This is fine when a checkpoint will overwrite all of them right after. Torch 1.7 has no meta device so this is the closest we can get to constructing an empty model."""
+    if not skip:
+        yield
+        return
+    print("Skipping the random initialization of the model since the checkpoint will overwrite it.")
+    saved_reset_parameters = {layer_class: layer_class.reset_parameters for layer_class in [nn.Linear, nn.Embedding, nn.LayerNorm]}
+    saved_init_weights = MBartPreTrainedModel._init_weights
+    for layer_class in saved_reset_parameters:
+        layer_class.reset_parameters = lambda self: None
+    MBartPreTrainedModel._init_weights = lambda self, module: None
+    try:
+        yield
+    finally:
+        for layer_class in saved_reset_parameters:
+            layer_class.reset_parameters = saved_reset_parameters[layer_class]
+        MBartPreTrainedModel._init_weights = saved_init_weights
+
+def move_tensors_to_shared_memory(obj):
+    """Recursively moves all the tensors in a checkpoint (which may contain nested dictionaries and lists like the optimizer state) to shared memory."""
+    if torch.is_tensor(obj):
+        obj.share_memory_()
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            move_tensors_to_shared_memory(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            move_tensors_to_shared_memory(value)
+
+def load_checkpoints_in_shared_memory(checkpoint_paths):
+    """Loads the checkpoints on the CPU in the launching process and moves their tensors to shared memory. The returned dictionary should be passed to the processes launched by mp.spawn. They receive handles to the shared memory instead of copies so all the local ranks use one host copy of each checkpoint."""
+    shared_checkpoint_dicts = {}
+    for checkpoint_path in checkpoint_paths:
+        if is_flat_checkpoint(checkpoint_path): ## All the processes mapping a flat checkpoint already share the pages of the file.
+            continue
+        start = time.time()
+        checkpoint_dict = torch.load(checkpoint_path, map_location="cpu")
+        move_tensors_to_shared_memory(checkpoint_dict)
+        shared_checkpoint_dicts[checkpoint_path] = checkpoint_dict
+        print("Loaded", checkpoint_path, "into shared memory in", time.time()-start, "seconds.")
+    return shared_checkpoint_dicts
+
+def load_checkpoint(checkpoint_path, map_location, shared_checkpoint_dicts=None):
+    """Returns the shared host copy of the checkpoint if the launching process loaded it and loads it from the disk otherwise. The shared copy lives on the CPU and load_state_dict copies it straight into the parameters on the GPU so we never have two copies of the model on the GPU."""
+    if shared_checkpoint_dicts is not None and checkpoint_path in shared_checkpoint_dicts:
+        print("Using the shared host copy of", checkpoint_path)
+        return shared_checkpoint_dicts[checkpoint_path]
+    if is_flat_checkpoint(checkpoint_path): ## Memory mapped on the CPU. load_state_dict copies the parameters to the right device.
+        print("Memory mapping the flat checkpoint", checkpoint_path)
+        return load_flat_checkpoint(checkpoint_path)
+    return torch.load(checkpoint_path, map_location=map_location)
+
+flat_checkpoint_magic = b"YANMTTFC" ## A flat checkpoint starts with these 8 bytes followed by the length of the JSON header as an 8 byte little endian integer, the header and finally the tensor data.
+flat_checkpoint_alignment = 64 ## Every tensor starts at a multiple of this many bytes so that the memory mapped arrays are aligned.
+flat_checkpoint_numpy_dtypes = {torch.float32: "float32", torch.float16: "float16", torch.float64: "float64", torch.int64: "int64", torch.int32: "int32", torch.int16: "int16", torch.int8: "int8", torch.uint8: "uint8", torch.bool: "bool"}
+
+def is_flat_checkpoint(checkpoint_path):
+    """Checks whether the file is a flat checkpoint or a regular pickled one."""
+    if not os.path.isfile(checkpoint_path):
+        return False
+    with open(checkpoint_path, "rb") as f:
+        return f.read(len(flat_checkpoint_magic)) == flat_checkpoint_magic
+
+def flat_checkpoint_tensor_bytes(tensor, storage_dtype):
+    """Returns the raw bytes of the tensor in the dtype it should be stored in. Torch 1.7 cannot hand bfloat16 tensors to numpy so we round the float32 values to the nearest bfloat16 ourselves and keep the upper 16 bits."""
+    tensor = tensor.detach().cpu().contiguous()
+    if storage_dtype == "bfloat16":
+        bits = tensor.float().numpy().view(np.uint32).astype(np.uint64)
+        bits = (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16 ## Round to nearest even.
+        return bits.astype(np.uint16).tobytes()
+    if storage_dtype == "float16":
+        tensor = tensor.half()
+    return tensor.numpy().tobytes()
+
+def flatten_checkpoint_structure(obj, name, tensors):
+    """Replaces every tensor in a (possibly nested) checkpoint by a reference to its name and collects the tensors. The names are the dotted paths to the tensors so for a model they are simply the parameter names. Dictionaries are kept as lists of key value pairs since the optimizer state uses integer keys which JSON would turn into strings."""
+    if torch.is_tensor(obj):
+        tensors[name] = obj
+        return {"__tensor__": name}
+    if isinstance(obj, collections.abc.Mapping): ## Also covers a LazyStateDict so flat checkpoints can be converted again.
+        return {"__dict__": [[key, flatten_checkpoint_structure(value, str(key) if name == "" else name+"."+str(key), tensors)] for key, value in obj.items()]}
+    if isinstance(obj, tuple):
+        return {"__tuple__": [flatten_checkpoint_structure(value, name+"."+str(idx), tensors) for idx, value in enumerate(obj)]}
+    if isinstance(obj, list):
+        return [flatten_checkpoint_structure(value, name+"."+str(idx), tensors) for idx, value in enumerate(obj)]
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    raise ValueError("Cannot store an object of type %s in a flat checkpoint." % type(obj))
+
+def save_flat_checkpoint(checkpoint_dict, checkpoint_path, storage_dtype=None):
+    """Saves a full checkpoint or a pure model as a JSON header followed by the raw tensor data. Such a file can be memory mapped and its tensors used without unpickling or copying anything. The floating point model parameters can be stored as float16 or bfloat16 to halve the size of the file but the optimizer state, if any, is always stored as it is. Tensors sharing their memory, like tied embeddings, are stored once."""
+    tensors = collections.OrderedDict()
+    structure = flatten_checkpoint_structure(checkpoint_dict, "", tensors)
+    is_full_checkpoint = type(checkpoint_dict) == dict and "model" in checkpoint_dict
+    model_dict = checkpoint_dict["model"] if is_full_checkpoint else checkpoint_dict
+    header = {"format_version": 1, "structure": structure, "tensors": collections.OrderedDict(), "state_dict_metadata": None}
+    if getattr(model_dict, "_metadata", None) is not None: ## The module versions which load_state_dict passes to the modules.
+        header["state_dict_metadata"] = [[prefix, dict(value)] for prefix, value in model_dict._metadata.items()]
+    stored_tensors = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        tensor_key = (tensor.data_ptr(), tensor.storage_offset(), tuple(tensor.size()), tuple(tensor.stride()), tensor.dtype)
+        if tensor.numel() > 0 and tensor_key in stored_tensors:
+            header["tensors"][name] = {"alias_of": stored_tensors[tensor_key]}
+            continue
+        stored_tensors[tensor_key] = name
+        tensor_dtype = flat_checkpoint_numpy_dtypes[tensor.dtype]
+        if storage_dtype is not None and tensor.is_floating_point() and (not is_full_checkpoint or name.startswith("model.")):
+            tensor_dtype = storage_dtype
+        nbytes = tensor.numel() * (2 if tensor_dtype in ["float16", "bfloat16"] else tensor.element_size())
+        header["tensors"][name] = {"dtype": tensor_dtype, "shape": list(tensor.size()), "offset": offset, "nbytes": nbytes}
+        offset += int(math.ceil(nbytes/flat_checkpoint_alignment))*flat_checkpoint_alignment
+    header = json.dumps(header).encode("utf-8")
+    data_start = int(math.ceil((len(flat_checkpoint_magic)+8+len(header))/flat_checkpoint_alignment))*flat_checkpoint_alignment
+    header = header + b" "*(data_start-len(flat_checkpoint_magic)-8-len(header)) ## JSON ignores trailing spaces.
+    header_tensors = json.loads(header.decode("utf-8"))["tensors"]
+    with open(checkpoint_path, "wb") as f:
+        f.write(flat_checkpoint_magic)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, tensor in tensors.items():
+            tensor_info = header_tensors[name]
+            if "alias_of" in tensor_info:
+                continue
+            f.seek(data_start+tensor_info["offset"])
+            f.write(flat_checkpoint_tensor_bytes(tensor, tensor_info["dtype"]))
+        f.truncate(data_start+offset)
+
+class FlatCheckpointReader:
+    """Memory maps a flat checkpoint and creates tensors on top of the mapped file. Nothing is read from the disk until a tensor is actually used and the pages are shared with all the other processes mapping the same file. The mapping is copy on write so modifying the tensors in place never modifies the file."""
+    def __init__(self, checkpoint_path):
+        with open(checkpoint_path, "rb") as f:
+            if f.read(len(flat_checkpoint_magic)) != flat_checkpoint_magic:
+                raise ValueError("%s is not a flat checkpoint." % checkpoint_path)
+            header_length = struct.unpack("<Q", f.read(8))[0]
+            self.header = json.loads(f.read(header_length).decode("utf-8"))
+            self.data_start = len(flat_checkpoint_magic)+8+header_length
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.tensors = self.header["tensors"]
+        self.cache = {}
+    
+    def get_tensor(self, name):
+        """Returns the tensor with this name. Tensors stored as bfloat16 are converted to float32 on access since torch 1.7 cannot view memory as bfloat16. Everything else is zero copy."""
+        tensor_info = self.tensors[name]
+        if "alias_of" in tensor_info:
+            return self.get_tensor(tensor_info["alias_of"])
+        if name in self.cache:
+            return self.cache[name]
+        if tensor_info["dtype"] == "bfloat16":
+            bits = np.frombuffer(self.buffer, dtype=np.uint16, count=tensor_info["nbytes"]//2, offset=self.data_start+tensor_info["offset"])
+            array = (bits.astype(np.uint32) << 16).view(np.float32)
+        elif tensor_info["nbytes"] == 0:
+            array = np.zeros(0, dtype=tensor_info["dtype"])
+        else:
+            dtype = np.dtype(tensor_info["dtype"])
+            array = np.frombuffer(self.buffer, dtype=dtype, count=tensor_info["nbytes"]//dtype.itemsize, offset=self.data_start+tensor_info["offset"])
+        tensor = torch.from_numpy(array).view(tensor_info["shape"])
+        self.cache[name] = tensor ## Tied tensors must remain the same tensor.
+        return tensor
+    
+    def unflatten(self, structure):
+        """Rebuilds the (possibly nested) object from its structure."""
+        if isinstance(structure, dict) and "__tensor__" in structure:
+            return self.get_tensor(structure["__tensor__"])
+        if isinstance(structure, dict) and "__dict__" in structure:
+            return {key: self.unflatten(value) for key, value in structure["__dict__"]}
+        if isinstance(structure, dict) and "__tuple__" in structure:
+            return tuple(self.unflatten(value) for value in structure["__tuple__"])
+        if isinstance(structure, list):
+            return [self.unflatten(value) for value in structure]
+        return structure
+    
+    def lazy_state_dict(self, structure):
+        """Returns the model dictionary as a LazyStateDict so that only the parameters which are looked up are ever touched."""
+        return LazyStateDict(self, [(key, value["__tensor__"]) for key, value in structure["__dict__"]], self.header["state_dict_metadata"])
+
+class LazyStateDict(collections.abc.MutableMapping):
+    """A state dictionary whose tensors are created from the memory mapped checkpoint when they are first looked up. It supports everything load_state_dict, remap_layers and remap_embeddings do with a state dictionary, including assigning and deleting keys, so it can be used wherever a loaded model dictionary is used."""
+    def __init__(self, reader, names, metadata=None):
+        self.reader = reader
+        self.entries = collections.OrderedDict(names) ## Maps a key to the name of its tensor in the file or to a tensor if it was assigned.
+        if metadata is not None:
+            self._metadata = collections.OrderedDict((prefix, value) for prefix, value in metadata)
+    
+    def __getitem__(self, key):
+        value = self.entries[key]
+        return self.reader.get_tensor(value) if isinstance(value, str) else value
+    
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+    
+    def __delitem__(self, key):
+        del self.entries[key]
+    
+    def __iter__(self):
+        return iter(self.entries)
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, key):
+        return key in self.entries
+    
+    def keys(self):
+        return self.entries.keys()
+    
+    def copy(self):
+        new_dict = LazyStateDict(self.reader, self.entries.items())
+        if hasattr(self, "_metadata"):
+            new_dict._metadata = self._metadata
+        return new_dict
+    
+    def __reduce__(self): ## The memory map cannot be pickled so we save the materialized tensors.
+        return (collections.OrderedDict, (list(self.items()),))
+
+def load_flat_checkpoint(checkpoint_path):
+    """Memory maps a flat checkpoint and returns it in the same form as torch.load would. The tensors live on the CPU and are only read from the disk when they are used."""
+    reader = FlatCheckpointReader(checkpoint_path)
+    structure = reader.header["structure"]
+    if all(isinstance(value, dict) and "__tensor__" in value for _, value in structure["__dict__"]): ## A pure model.
+        return reader.lazy_state_dict(structure)
+    checkpoint_dict = {}
+    for key, value in structure["__dict__"]:
+        checkpoint_dict[key] = reader.lazy_state_dict(value) if key == "model" else reader.unflatten(value)
+    return checkpoint_dict
+
 def init_weights(module, in_features, out_features):
     """Method to initialize model weights. Not used for now but might be used in the future. Tries to mimic t2t initialization.
     TODO: Incorporate this into the flow so as to give users an option to do their own initialization."""
@@ -353,6 +1441,239 @@ def get_sacrebleu(refs, hyp):
     bleu = sacrebleu.corpus_bleu(hyp, refs)
     return bleu.score
 
+def get_dev_pair_languages(dev_pair, args):
+    """Returns the source and target language of a dev pair. For multi-source NMT the pair is a triplet and the source is the first two languages joined by a hyphen which generate_batches_eval_bilingual splits again."""
+    slangtlang = dev_pair.strip().split("-")
+    if args.multi_source:
+        return slangtlang[0]+"-"+slangtlang[1], slangtlang[2]
+    return slangtlang[0], slangtlang[1]
+
+def cache_eval_batches(tok, args, sentences, slang):
+    """Tokenizes and batches a dev set once so that every evaluation can reuse the batches. The sentences are sorted by their length in tokens, longest first, so that each batch has sentences of similar length and very little padding. Returns the batches and the index of each sentence in the original order so that the translations can be put back in that order."""
+    lengths = [len(tok(sentence.split("\t")[-1].strip(), add_special_tokens=False).input_ids) for sentence in sentences] ## For multi-source NMT the length of the main source is used.
+    order = sorted(range(len(sentences)), key=lambda idx: lengths[idx], reverse=True)
+    batches = list(generate_batches_eval_bilingual(tok, args, [sentences[idx] for idx in order], slang))
+    return batches, order
+
+def score_hypotheses(task):
+    """Scores the translations of a dev pair, or a part of them for Rouge which is a sentence level metric. Returns the score and its weight so that the scores of the parts can be averaged. This runs in the scoring processes."""
+    metric, hyp, refs = task
+    if metric == "Rouge":
+        scorer = rouge_scorer.RougeScorer(['rouge1', 'rougeL'], use_stemmer=False)
+        return sum(scorer.score(curr_ref, curr_pred)['rougeL'].fmeasure for curr_ref, curr_pred in zip(refs[0], hyp)), len(hyp)
+    if metric == "chrF":
+        return sacrebleu.corpus_chrf(hyp, refs).score, 1
+    return get_sacrebleu(refs, hyp), 1
+
+class DevSetScorer:
+    """Scores the translations of all dev pairs with BLEU, chrF or Rouge-L. With num_workers > 0 the pairs are scored in parallel by a pool of processes and Rouge, being a sentence level metric, is additionally split into num_workers parts per pair."""
+    def __init__(self, args, num_workers=0):
+        self.metric = "Rouge" if args.use_rouge else ("chrF" if args.use_chrf else "BLEU")
+        self.num_workers = num_workers
+        self.pool = mp.get_context("spawn").Pool(num_workers) if num_workers > 0 else None ## The pool is created once since starting processes is slow.
+    
+    def score(self, hyps, refs):
+        """Returns the score of each dev pair."""
+        tasks, task_pairs = [], []
+        for dev_pair, hyp in hyps.items():
+            num_parts = max(1, self.num_workers) if self.metric == "Rouge" else 1
+            part_size = -(-len(hyp)//num_parts)
+            for part_start in range(0, len(hyp), part_size):
+                tasks.append((self.metric, hyp[part_start:part_start+part_size], [ref[part_start:part_start+part_size] for ref in refs[dev_pair]]))
+                task_pairs.append(dev_pair)
+        task_scores = self.pool.map(score_hypotheses, tasks) if self.pool is not None else [score_hypotheses(task) for task in tasks]
+        totals = collections.defaultdict(float)
+        weights = collections.defaultdict(float)
+        for dev_pair, (score, weight) in zip(task_pairs, task_scores):
+            totals[dev_pair] += score
+            weights[dev_pair] += weight
+        return {dev_pair: totals[dev_pair]/weights[dev_pair] if weights[dev_pair] > 0 else 0.0 for dev_pair in hyps}
+    
+    def close(self):
+        """Stops the scoring processes."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+_detokenization_tokenizer = None
+
+def init_detokenization_worker(tok):
+    """Gives the detokenization workers their copy of the tokenizer."""
+    global _detokenization_tokenizer
+    _detokenization_tokenizer = tok
+
+def detokenize_ids(ids, skip_special_tokens):
+    """Converts a batch of generated ids into strings. This runs in the detokenization workers."""
+    return [_detokenization_tokenizer.decode(sequence, skip_special_tokens=skip_special_tokens, clean_up_tokenization_spaces=False) for sequence in ids]
+
+class DetokenizationPipeline:
+    """Detokenizes generated ids in the background so that the next batch can be generated right away. The batches are detokenized by a pool of num_workers processes, or by a background thread if num_workers is 0, and a writer thread collects the strings in the order in which the batches were submitted. The strings are kept for collect and, if outf is given, written to it without flushing after every line. At most max_pending batches are in flight so that submit waits if detokenization cannot keep up."""
+    def __init__(self, tok, skip_special_tokens, num_workers=0, outf=None, max_pending=16):
+        self.skip_special_tokens = skip_special_tokens
+        self.outf = outf
+        self.pool = mp.get_context("spawn").Pool(num_workers, initializer=init_detokenization_worker, initargs=(tok,)) if num_workers > 0 else ThreadPool(1, initializer=init_detokenization_worker, initargs=(tok,))
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.hypotheses = []
+        self.error = None
+        self.writer = threading.Thread(target=self.write_results, daemon=True)
+        self.writer.start()
+    
+    def write_results(self):
+        """The writer thread."""
+        while True:
+            result = self.pending.get()
+            if result is None:
+                self.pending.task_done()
+                return
+            try:
+                translations = result.get()
+                self.hypotheses.extend(translations)
+                if self.outf is not None:
+                    self.outf.write("".join([translation+"\n" for translation in translations]))
+            except Exception as e: ## Raised again by collect so that the main process does not wait forever.
+                self.error = e
+            self.pending.task_done()
+    
+    def submit(self, ids):
+        """Queues a batch of generated ids (a tensor on any device or a list of lists) for detokenization."""
+        if torch.is_tensor(ids):
+            ids = ids.cpu().tolist()
+        self.pending.put(self.pool.apply_async(detokenize_ids, (ids, self.skip_special_tokens)))
+    
+    def collect(self):
+        """Waits until all the submitted batches are done and returns their strings in order. The strings are forgotten afterwards."""
+        self.pending.join()
+        if self.error is not None:
+            raise self.error
+        if self.outf is not None:
+            self.outf.flush()
+        hypotheses = self.hypotheses
+        self.hypotheses = []
+        return hypotheses
+    
+    def close(self):
+        """Stops the writer thread and the workers."""
+        self.pending.put(None)
+        self.writer.join()
+        self.pool.close()
+        self.pool.join()
+        if self.outf is not None:
+            self.outf.flush()
+
+def decode_and_score_dev_sets(model, tok, args, dev_files, eval_batches, refs, device, scorer, detokenizer):
+    """Greedily decodes the cached batches of every dev pair and returns the score of each pair along with the name of the metric. The translations are detokenized by the detokenizer pipeline while the next batch is being decoded. The model should not be wrapped in DDP."""
+    hyps = {}
+    for dev_pair in dev_files: ## For each evaluation pair we will decode and later compute scores.
+        slang, tlang = get_dev_pair_languages(dev_pair, args)
+        batches, order = eval_batches[dev_pair]
+        for dev_input_ids, dev_input_masks in batches:
+            if args.multi_source:
+                dev_input_ids_parent = dev_input_ids[1].to(device) ## Move to the device.
+                dev_input_ids = dev_input_ids[0]
+                dev_input_masks_parent = dev_input_masks[1].to(device) ## Move to the device.
+                dev_input_masks = dev_input_masks[0]
+            dev_input_ids = dev_input_ids.to(device) ## Move to the device.
+            dev_input_masks = dev_input_masks.to(device) ## Move to the device.
+            if args.is_summarization: ## Things can be slow so best show progress
+                print("Decoding batch from a pool of", len(order), "examples")
+            with torch.no_grad(): ## torch.no_grad is apparently known to prevent the code from allocating memory for gradient computation in addition to making things faster. I have not verified this but have kept it as a safety measure to ensure that my model is not being directly tuned on the development set.
+                translations = model.generate(dev_input_ids, use_cache=True, num_beams=1, max_length=int((len(dev_input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(dev_input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=dev_input_masks, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([tlang if args.use_official_pretrained else "<2"+tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, additional_input_ids=dev_input_ids_parent if args.multi_source else None, additional_input_ids_mask=dev_input_masks_parent if args.multi_source else None) ## We translate the batch.
+            detokenizer.submit(translations) ## Get the raw sentences in the background.
+        sorted_hyp = detokenizer.collect()
+        hyp = [None]*len(order) ## Undo the sorting by length.
+        for position, idx in enumerate(order):
+            hyp[idx] = sorted_hyp[position]
+        hyps[dev_pair] = hyp
+    return scorer.score(hyps, refs), scorer.metric
+
+def async_evaluation_worker(config, tok, args, dev_files, eval_batches, refs, tasks, results):
+    """The evaluator process. It receives paths to snapshots of the model, decodes and scores the dev sets with them and sends the scores back. It stops when it receives None. Scoring is done in this process since a daemonic process cannot have a pool of its own."""
+    device = torch.device(args.async_evaluation_device)
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    elif args.async_evaluation_threads > 0:
+        torch.set_num_threads(args.async_evaluation_threads)
+    with skip_weight_initialization(): ## Every snapshot overwrites all the weights.
+        model = MBartForConditionalGeneration(config)
+    model.to(device)
+    model.eval()
+    scorer = DevSetScorer(args)
+    detokenizer = DetokenizationPipeline(tok, args.no_skip_special_tokens) ## A daemonic process cannot have a pool of its own so a background thread is used.
+    while True:
+        task = tasks.get()
+        if task is None:
+            detokenizer.close()
+            return
+        ctr, snapshot_path = task
+        model.load_state_dict(torch.load(snapshot_path, map_location=device))
+        start = time.time()
+        sbleus, metric = decode_and_score_dev_sets(model, tok, args, dev_files, eval_batches, refs, device, scorer, detokenizer)
+        results.put((ctr, sbleus, metric, snapshot_path, time.time()-start))
+
+def save_best_checkpoint(checkpoint_dict, model, snapshot_path, checkpoint_path):
+    """Saves a copy of the model that got the best dev score. With asynchronous evaluation the evaluated model is the snapshot that was handed to the evaluator so only the pure model can be saved. Otherwise both the full checkpoint and the pure model are saved."""
+    if snapshot_path is not None:
+        shutil.copyfile(snapshot_path, checkpoint_path+".pure_model")
+    else:
+        torch.save(checkpoint_dict, checkpoint_path)
+        torch.save(model.module.state_dict(), checkpoint_path+".pure_model") ## Pure model without any ddp markers or optimizer info.
+
+class AsyncEvaluator:
+    """Evaluates snapshots of the model in a separate process, on a spare GPU or on the CPU, so that training does not have to stop for evaluation. Results come back in the order the snapshots were submitted. To keep early stopping and annealing decisions from being based on very old results, submit waits once more than max_lag evaluations are pending."""
+    def __init__(self, model, tok, args, dev_files, eval_batches, refs):
+        config = copy.deepcopy(model.config)
+        if args.mixed_wait_k: ## Evaluation is always done with the maximum wait-k.
+            config.wait_k = args.wait_k
+        context = mp.get_context("spawn") ## CUDA cannot be used in forked processes.
+        self.tasks = context.Queue()
+        self.results_queue = context.Queue()
+        self.process = context.Process(target=async_evaluation_worker, args=(config, tok, args, dev_files, eval_batches, refs, self.tasks, self.results_queue), daemon=True)
+        self.process.start()
+        self.max_lag = args.async_evaluation_max_lag
+        self.num_pending = 0
+    
+    def get_result(self, block):
+        """Gets the next result from the evaluator process. While waiting it checks every few seconds whether the process is still alive so that training does not hang forever if it died, for example due to running out of memory on the evaluation device."""
+        while True:
+            try:
+                return self.results_queue.get(timeout=5) if block else self.results_queue.get(block=False)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("The asynchronous evaluator process exited with code %s with %d evaluations pending." % (self.process.exitcode, self.num_pending))
+                if not block:
+                    raise
+    
+    def submit(self, ctr, snapshot_path):
+        """Hands a snapshot over to the evaluator process."""
+        self.tasks.put((ctr, snapshot_path))
+        self.num_pending += 1
+    
+    def results(self):
+        """Returns the results that have arrived so far as a list of (ctr, scores, metric, snapshot_path, seconds taken) tuples. Waits for the oldest results if too many evaluations are pending."""
+        arrived = []
+        while self.num_pending > 0:
+            try:
+                arrived.append(self.get_result(block=self.num_pending > self.max_lag))
+            except queue.Empty:
+                break
+            self.num_pending -= 1
+        return arrived
+    
+    def close(self):
+        """Waits for all pending evaluations to finish, stops the evaluator process and returns the remaining results. If the evaluator process died then the results that arrived before that are returned with a warning."""
+        arrived = []
+        try:
+            while self.num_pending > 0:
+                arrived.append(self.get_result(block=True))
+                self.num_pending -= 1
+        except RuntimeError as e:
+            print("WARNING:", e, "Their results are lost.")
+            self.num_pending = 0
+            return arrived
+        self.tasks.put(None)
+        self.process.join()
+        return arrived
+
 def yield_corpus_indefinitely_mono(corpus, lang):
     """This shuffles the corpus or corpus shard at the beginning of each epoch and returns sentences indefinitely."""
     epoch_counter = 0
@@ -405,6 +1726,55 @@ def sub_sample_and_permute_document(sentence, document_level_sentence_delimiter,
     return sentence_split_shuffled, sentence, sent_len
 
     
+def pack_sequences(tok, args, encoder_input_batch, decoder_input_batch, decoder_label_batch):
+    """Tokenizes the examples of a batch and packs them into rows of at most args.packed_sequence_length tokens on both the encoder and decoder side. Returns the input ids, segment ids for the encoder and decoder, decoder input ids and labels. Segment ids start from 1 in each row and 0 is for padding."""
+    is_official_bart = args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model
+    capacity = args.packed_sequence_length if args.hard_truncate_length <= 0 else min(args.packed_sequence_length, args.hard_truncate_length)
+    if is_official_bart: ## The bart tokenizer is wacky so we need to tweak the inputs a bit.
+        encoder_ids = tok(encoder_input_batch).input_ids
+        decoder_ids = tok(decoder_input_batch).input_ids
+    else:
+        encoder_ids = tok(encoder_input_batch, add_special_tokens=False, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+        decoder_ids = tok(decoder_input_batch, add_special_tokens=False, sample=args.tokenization_sampling, nbest=args.tokenization_nbest_list_size, alpha_or_dropout=args.tokenization_alpha_or_dropout).input_ids
+    if is_official_bart or args.tokenization_sampling: ## Labels are the decoder inputs shifted by one just like in the unpacked case.
+        label_ids = [ids[1:] for ids in decoder_ids]
+        decoder_ids = [ids[:-1] for ids in decoder_ids]
+    else:
+        label_ids = tok(decoder_label_batch, add_special_tokens=False).input_ids
+    examples = []
+    for enc, dec, lab in zip(encoder_ids, decoder_ids, label_ids):
+        dec_len = min(len(dec), len(lab), capacity)
+        examples.append((enc[:capacity], dec[:dec_len], lab[:dec_len]))
+    examples.sort(key=lambda x: max(len(x[0]), len(x[1])), reverse=True)
+    rows = [] ## First fit decreasing. Each row is a list of examples and the encoder and decoder lengths used so far.
+    for example in examples:
+        for row in rows:
+            if row[1] + len(example[0]) <= capacity and row[2] + len(example[1]) <= capacity:
+                row[0].append(example)
+                row[1] += len(example[0])
+                row[2] += len(example[1])
+                break
+        else:
+            rows.append([[example], len(example[0]), len(example[1])])
+    max_src_len = max(row[1] for row in rows)
+    max_tgt_len = max(row[2] for row in rows)
+    input_ids = torch.full((len(rows), max_src_len), tok.pad_token_id, dtype=torch.long)
+    input_segment_ids = torch.zeros(len(rows), max_src_len, dtype=torch.long)
+    decoder_input_ids = torch.full((len(rows), max_tgt_len), tok.pad_token_id, dtype=torch.long)
+    decoder_segment_ids = torch.zeros(len(rows), max_tgt_len, dtype=torch.long)
+    labels = torch.full((len(rows), max_tgt_len), tok.pad_token_id, dtype=torch.long)
+    for row_idx, row in enumerate(rows):
+        src_pos, tgt_pos = 0, 0
+        for segment_idx, (enc, dec, lab) in enumerate(row[0]):
+            input_ids[row_idx, src_pos:src_pos+len(enc)] = torch.tensor(enc, dtype=torch.long)
+            input_segment_ids[row_idx, src_pos:src_pos+len(enc)] = segment_idx+1
+            decoder_input_ids[row_idx, tgt_pos:tgt_pos+len(dec)] = torch.tensor(dec, dtype=torch.long)
+            decoder_segment_ids[row_idx, tgt_pos:tgt_pos+len(dec)] = segment_idx+1
+            labels[row_idx, tgt_pos:tgt_pos+len(lab)] = torch.tensor(lab, dtype=torch.long)
+            src_pos += len(enc)
+            tgt_pos += len(dec)
+    return input_ids, input_segment_ids, decoder_input_ids, decoder_segment_ids, labels
+
 def generate_batches_monolingual_masked(tok, args, files, rank):
     """Generates the source, target and source attention masks for denoising. Long sequences are truncated and short sequences are ignored."""
     
@@ -451,6 +1821,7 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
         prev_max_tgt_sent_len = 0
         start = time.time()
         sents_in_batch = 0
+        tokens_in_batch = 0 ## Used to fill batches when packing sequences.
         dropped_sentence = "" ## We will save the sentence to be dropped this batch and add it to the next batch.
         if args.num_domains_for_domain_classifier > 1:
             domain_classifier_labels = []
@@ -536,7 +1907,10 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
                 if sents_in_batch == args.batch_size:
                     break
             else:
-                potential_batch_count = max(max_src_sent_len, max_tgt_sent_len)*(sents_in_batch+1) ## Note that this will be unreliable when we do stochastic subword segmentation.
+                if args.pack_sequences: ## Packed rows have very little padding so we count the actual tokens instead of the padded size.
+                    potential_batch_count = tokens_in_batch + max(curr_src_sent_len, curr_tgt_sent_len)
+                else:
+                    potential_batch_count = max(max_src_sent_len, max_tgt_sent_len)*(sents_in_batch+1) ## Note that this will be unreliable when we do stochastic subword segmentation.
                 if potential_batch_count > args.batch_size: ## We will drop this sentence for now because we may go over the limit of what the GPU can handle. It may be used in a future iteration. Note that this will be unreliable when we do stochastic subword segmentation.
                     dropped_sentence = sentence
                     max_src_sent_len = prev_max_src_sent_len
@@ -554,10 +1928,16 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
                 if args.num_domains_for_domain_classifier > 1:
                     domain_classifier_labels.append(files[language][1])
                 sents_in_batch += 1
+                tokens_in_batch += max(curr_src_sent_len, curr_tgt_sent_len)
         
         if len(encoder_input_batch) == 0:
             print("Zero size batch due to an abnormal example. Skipping empty batch.")
             continue
+        if args.pack_sequences: ## Several examples share a row. The segment ids tell the model where each example starts and ends.
+            input_ids, input_segment_ids, decoder_input_ids, decoder_segment_ids, labels = pack_sequences(tok, args, encoder_input_batch, decoder_input_batch, decoder_label_batch)
+            input_masks = (input_segment_ids != 0).int()
+            yield input_ids, [input_masks, input_segment_ids, decoder_segment_ids], decoder_input_ids, labels
+            continue
         if args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model: ## The bart tokenizer is wacky so we need to tweak the inputs a bit. No support for stochastic tokenizer because the roberta tokenizer which is inherited from GPT2 tokenizer does its onw weird BPE and I dont want to mess with it.
             input_ids = tok(encoder_input_batch, return_tensors="pt", padding=True).input_ids
         else:
@@ -1047,6 +2427,64 @@ def generate_batches_bilingual(tok, args, files, rank):
                 yield input_ids, input_masks, decoder_input_ids, labels
 
             
+def generate_batches_for_teacher_cache(tok, args, files, rank):
+    """Goes over the training shard of this process exactly once and generates the inputs the parent sees during distillation, that is, the parent's source (the additional source in case of cross distillation) and the decoder input. The sentences are preprocessed exactly like in generate_batches_bilingual so that the cached parent outputs can be matched with the training batches later. Source masking and stochastic tokenization make the inputs random so pairs with them are skipped."""
+    if args.use_official_pretrained and "bart" in args.pretrained_model and "mbart" not in args.pretrained_model: ## The decoder inputs of bart depend on the padding of the batch so they cannot be matched.
+        raise ValueError("The parent outputs cannot be cached for official BART models.")
+    for language in files:
+        slangtlang = language.strip().split("-")
+        if args.cross_distillation:
+            slang = slangtlang[0] if args.use_official_pretrained else "<2"+slangtlang[0]+">" ## The parent source language.
+            tlang = slangtlang[2] if args.use_official_pretrained else "<2"+slangtlang[2]+">"
+        else:
+            slang = slangtlang[0] if args.use_official_pretrained else "<2"+slangtlang[0]+">"
+            tlang = slangtlang[1] if args.use_official_pretrained else "<2"+slangtlang[1]+">"
+        if (slangtlang[-2] == slangtlang[-1] and not args.is_summarization) or args.source_masking_for_bilingual or args.tokenization_sampling:
+            print("Skipping", language, "since its inputs are randomly masked or segmented during training so the parent outputs cannot be cached.")
+            continue
+        print("Caching the parent outputs for", language)
+        encoder_input_batch = []
+        decoder_input_batch = []
+        for src_sent, tgt_sent in zip(open(files[language][0]+"."+"%02d" % rank), open(files[language][1]+"."+"%02d" % rank)):
+            if args.cross_distillation: ## The source is X[tab]Y and the parent gets Y.
+                src_sent = src_sent.split("\t")
+                src_sent_parent = src_sent[0].strip()
+                src_sent = src_sent[1]
+            src_sent = src_sent.strip()
+            tgt_sent = tgt_sent.strip()
+            src_sent_split = src_sent.split(" ")
+            tgt_sent_split = tgt_sent.split(" ")
+            if len(src_sent_split) <= 1 or len(tgt_sent_split) <= 1:
+                continue
+            if len(tgt_sent_split) >= args.max_tgt_length:
+                tgt_sent = " ".join(tgt_sent_split[:args.max_tgt_length])
+            if args.cross_distillation:
+                src_sent_split = src_sent_parent.split(" ")
+                if len(src_sent_split) <= 1:
+                    continue
+            if len(src_sent_split) >= args.max_src_length: ## The same length constraint applies to the parent source.
+                src_sent_split = src_sent_split[:args.max_src_length]
+            src_sent = " ".join(src_sent_split)
+            encoder_input_batch.append(src_sent + " </s> " + slang)
+            decoder_input_batch.append(tlang + " " + tgt_sent)
+            if len(encoder_input_batch) == args.teacher_cache_dump_batch_size:
+                yield get_teacher_cache_batch_tensors(tok, args, encoder_input_batch, decoder_input_batch)
+                encoder_input_batch = []
+                decoder_input_batch = []
+        if len(encoder_input_batch) > 0:
+            yield get_teacher_cache_batch_tensors(tok, args, encoder_input_batch, decoder_input_batch)
+
+def get_teacher_cache_batch_tensors(tok, args, encoder_input_batch, decoder_input_batch):
+    """Tokenizes a batch for generate_batches_for_teacher_cache the same way generate_batches_bilingual does."""
+    input_ids = tok(encoder_input_batch, add_special_tokens=False, return_tensors="pt", padding=True).input_ids
+    if args.hard_truncate_length > 0 and len(input_ids[0]) > args.hard_truncate_length: ## Truncate again if we exceed the maximum sequence length.
+        input_ids = input_ids[:,:args.hard_truncate_length]
+    input_masks = (input_ids != tok.pad_token_id).int()
+    decoder_input_ids = tok(decoder_input_batch, add_special_tokens=False, return_tensors="pt", padding=True).input_ids
+    if args.hard_truncate_length > 0 and len(decoder_input_ids[0]) > args.hard_truncate_length: ## Truncate again if we exceed the maximum sequence length.
+        decoder_input_ids = decoder_input_ids[:,:args.hard_truncate_length]
+    return input_ids, input_masks, decoder_input_ids
+
 def generate_batches_pair(tok, args):
     """Generates the source, target and source attention masks for the training set."""
     src_file = open(args.test_src)
@@ -1125,64 +2563,6 @@ def generate_batches_pair(tok, args):
         decoder_masks = (decoder_input_ids != tok.pad_token_id).int()
         yield input_ids, input_masks, decoder_input_ids, decoder_masks, labels
 
-def generate_batches_pair_masked(tok, args): ## TODO: Implement hard truncation logic here if something bugs out. In general dont use this its highly untested.
-    """Generates the source, target and source attention masks for the training set."""
-    if args.use_official_pretrained:
-        mask_tok = "<mask>"
-    else:
-        mask_tok = "[MASK]"
-    src_file = open(args.test_src)
-    tgt_file = open(args.test_ref)
-    corpus = [(src_line, tgt_line) for src_line, tgt_line in zip(src_file, tgt_file)]
-    epoch_counter = 0
-    curr_batch_count = 0
-    for src_sent, tgt_sent in corpus:
-        src_sent = src_sent.strip()
-        tgt_sent = tgt_sent.strip()
-        start = time.time()
-        slang = args.slang if args.use_official_pretrained else "<2"+args.slang+">"
-        tlang = args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"
-        src_sent_split = src_sent.split(" ")
-        tgt_sent_split = tgt_sent.split(" ")
-        tgt_sent_len = len(tgt_sent_split)
-        src_sent_len = len(src_sent_split)
-        if src_sent_len <=1 or src_sent_len >= 100 or tgt_sent_len <=1 or tgt_sent_len >= 100:
-            continue
-        
-        for pos_src in range(src_sent_len):
-            encoder_input_batch = []
-            decoder_input_batch = []
-            decoder_label_batch = []
-            dec_pos = []
-            enc_pos = pos_src
-            new_src_sent_split = list(src_sent_split)
-            new_src_sent_split[pos_src] = mask_tok
-            new_src_sent = " ".join(new_src_sent_split)
-            for pos_tgt in range(tgt_sent_len):
-                dec_pos.append(pos_tgt)
-                new_tgt_sent_split = list(tgt_sent_split)
-                new_tgt_sent_split[pos_tgt] = mask_tok
-                new_tgt_sent = " ".join(new_tgt_sent_split)
-                encoder_input_batch.append(new_src_sent + " </s> " + slang)
-                decoder_input_batch.append(tlang + " " + new_tgt_sent)
-                decoder_label_batch.append(new_tgt_sent + " </s>")
-            input_ids = tok(encoder_input_batch, add_special_tokens=False, return_tensors="pt", padding=True).input_ids
-            if args.hard_truncate_length > 0 and len(input_ids[0]) > args.hard_truncate_length:
-                input_ids = input_ids[:,:args.hard_truncate_length]
-            input_masks = (input_ids != tok.pad_token_id).int()
-            decoder_input_ids = tok(decoder_input_batch, add_special_tokens=False, return_tensors="pt", padding=True).input_ids
-            if args.hard_truncate_length > 0 and len(decoder_input_ids[0]) > args.hard_truncate_length:
-                decoder_input_ids = decoder_input_ids[:,:args.hard_truncate_length]
-            tgt_masks = (decoder_input_ids != tok.pad_token_id).int()
-            labels = tok(decoder_label_batch, add_special_tokens=False, return_tensors="pt", padding=True).input_ids
-            if args.hard_truncate_length > 0 and len(labels[0]) > args.hard_truncate_length:
-                labels = labels[:,:args.hard_truncate_length]
-            end = time.time()
-
-            yield input_ids, input_masks, decoder_input_ids, tgt_masks, labels, src_sent_split, tgt_sent_split, enc_pos, dec_pos
-            
-
-
 def generate_batches_for_decoding(tok, args):
     """Generates the source sentences for the test set."""
     if args.tokenization_sampling:
@@ -1325,7 +2705,419 @@ def generate_batches_for_decoding_lm(tok, args):
         end = time.time()
         
         yield input_ids
-        
+
+
+def load_output_shortlist(args, tok):
+    """Loads the shortlist created by create_shortlist.py and trims it to the sizes we want to use during decoding. The shortlist must have been created with the same tokenizer as the one used for decoding since it stores token ids."""
+    shortlist = torch.load(args.shortlist_path)
+    assert shortlist["vocab_size"] == len(tok), "The shortlist %s was created with a tokenizer with %d tokens but the tokenizer used for decoding has %d tokens. Create the shortlist again with the tokenizer of this model." % (args.shortlist_path, shortlist["vocab_size"], len(tok))
+    assert args.shortlist_top_frequent <= len(shortlist["top_frequent"]), "The shortlist file only has %d frequent tokens." % len(shortlist["top_frequent"])
+    assert args.shortlist_top_k_per_source <= shortlist["shortlist"].size(1), "The shortlist file only has %d tokens per source token." % shortlist["shortlist"].size(1)
+    shortlist["shortlist"] = shortlist["shortlist"][:, :args.shortlist_top_k_per_source].long()
+    shortlist["top_frequent"] = shortlist["top_frequent"][:args.shortlist_top_frequent].long()
+    print("Loaded a shortlist with", shortlist["shortlist"].size(1), "target tokens per source token and", len(shortlist["top_frequent"]), "frequent target tokens.")
+    return shortlist
+
+
+def get_output_shortlist_ids(input_ids, shortlist, tok):
+    """Returns the sorted target vocabulary ids which the output projection should be restricted to for this batch. This is the union of the shortlists of all source tokens in the batch, the frequent target tokens and the special tokens (the language tokens are special tokens so the decoder start token is also covered)."""
+    shortlist_ids = torch.cat([shortlist["shortlist"][input_ids.view(-1)].view(-1), shortlist["top_frequent"], torch.tensor(tok.all_special_ids, dtype=torch.long)])
+    return torch.unique(shortlist_ids) ## Sorted by default.
+
+
+def get_scoring_columns(args):
+    """Returns the names of the columns written for every pair by the bulk_score decode type. The normalized score is the log probability divided by the number of target tokens raised to --score_length_normalization_alpha. The dual conditional cross-entropy is the filtering score of Junczys-Dowmunt (2018) where lower is better."""
+    columns = ["forward_logprob", "forward_tokens", "forward_normalized_logprob"]
+    if args.score_both_directions:
+        columns += ["backward_logprob", "backward_tokens", "backward_normalized_logprob", "dual_cross_entropy"]
+    return columns
+
+
+def read_corpus_chunks(files, chunk_size, rank, world_size):
+    """Reads one or more line aligned files in chunks of chunk_size lines so that we never hold the whole corpus in memory. The chunks are distributed across the processes in a round robin fashion. Yields the index of the chunk and its lines (a tuple with one line per file) for the chunks of this process."""
+    chunk_idx = 0
+    chunk = []
+    chunk_length = 0
+    input_files = [open(file) for file in files]
+    for lines in zip(*input_files):
+        if chunk_idx % world_size == rank: ## We only keep the lines of our own chunks but we have to read everything to know where the chunks start.
+            chunk.append(tuple([line.strip() for line in lines]))
+        chunk_length += 1
+        if chunk_length == chunk_size:
+            if chunk_idx % world_size == rank:
+                yield chunk_idx, chunk
+            chunk_idx += 1
+            chunk = []
+            chunk_length = 0
+    for input_file in input_files:
+        input_file.close()
+    if chunk_length > 0 and chunk_idx % world_size == rank:
+        yield chunk_idx, chunk
+
+
+def count_lines(path):
+    """Returns the number of lines in a file."""
+    with open(path) as input_file:
+        return sum(1 for _ in input_file)
+
+
+def tokenize_parallel_pairs(tok, args, pairs, slang):
+    """Tokenizes a list of (source, target) pairs. Returns the encoder input ids and the target ids without the language token and the </s> token. Truncation is the same as in generate_batches_pair."""
+    slang = slang if args.use_official_pretrained else "<2"+slang+">"
+    src_sents = [" ".join(src_sent.split(" ")[:args.max_src_length]) + " </s> " + slang for src_sent, _ in pairs]
+    tgt_sents = [" ".join(tgt_sent.split(" ")[:args.max_tgt_length]) for _, tgt_sent in pairs]
+    src_ids = tok(src_sents, add_special_tokens=False).input_ids
+    tgt_ids = tok(tgt_sents, add_special_tokens=False).input_ids
+    if args.hard_truncate_length > 0:
+        src_ids = [ids[:args.hard_truncate_length] for ids in src_ids]
+        tgt_ids = [ids[:args.hard_truncate_length-1] for ids in tgt_ids] ## The decoder input gets a language token prepended and the labels get a </s> token appended.
+    return src_ids, tgt_ids
+
+
+def make_length_sorted_batches(lengths, max_tokens):
+    """Sorts the examples by length and groups them into batches whose padded size does not exceed max_tokens tokens. Sorting keeps the padding, and thus the wasted computation, to a minimum. Returns lists of indices into the examples."""
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True)
+    batches = []
+    batch = []
+    max_length = 0
+    for idx in order:
+        if len(batch) > 0 and max(max_length, lengths[idx])*(len(batch)+1) > max_tokens:
+            batches.append(batch)
+            batch = []
+            max_length = 0
+        batch.append(idx)
+        max_length = max(max_length, lengths[idx])
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def pad_sequences(sequences, pad_id):
+    """Pads a list of lists of ids into a tensor."""
+    padded = torch.full((len(sequences), max([len(sequence) for sequence in sequences])), pad_id, dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        padded[row, :len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+    return padded
+
+
+def make_pair_batch_tensors(src_ids, tgt_ids, batch, tlang_id, eos_id, pad_id):
+    """Pads the pairs in the batch and returns the encoder input ids, the encoder attention masks, the decoder input ids (the target language token followed by the target) and the labels (the target followed by </s>)."""
+    input_ids = pad_sequences([src_ids[idx] for idx in batch], pad_id)
+    input_masks = (input_ids != pad_id).int()
+    decoder_input_ids = pad_sequences([[tlang_id] + tgt_ids[idx] for idx in batch], pad_id)
+    labels = pad_sequences([tgt_ids[idx] + [eos_id] for idx in batch], pad_id)
+    return input_ids, input_masks, decoder_input_ids, labels
+
+
+def score_pairs_batch(model, input_ids, input_masks, decoder_input_ids, labels, pad_id, device):
+    """Returns the sum of the log probabilities of the target tokens (including </s>) and the number of target tokens for every pair in the batch. This is the true log-likelihood of the target so no label smoothing is involved. The log-softmax is computed in fp32 even if the model runs in half precision."""
+    labels = labels.to(device)
+    with torch.no_grad():
+        logits = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device), use_cache=False).logits
+        logprobs = logits.gather(-1, labels.unsqueeze(-1)).squeeze(-1).float() - torch.logsumexp(logits.float(), dim=-1)
+        label_masks = (labels != pad_id)
+        logprobs = logprobs.masked_fill(~label_masks, 0.0)
+    return logprobs.sum(dim=-1).cpu(), label_masks.sum(dim=-1).cpu()
+
+
+def score_corpus_chunk(model, tok, args, pairs, device):
+    """Scores a chunk of (source, target) pairs in one or both directions. Returns a float32 array with one row per pair in the original order and the columns given by get_scoring_columns."""
+    pad_id = tok.pad_token_id
+    eos_id = tok(["</s>"], add_special_tokens=False).input_ids[0][0]
+    directions = [(args.slang, args.tlang, pairs)]
+    if args.score_both_directions:
+        directions.append((args.tlang, args.slang, [(tgt_sent, src_sent) for src_sent, tgt_sent in pairs]))
+    scores = np.zeros((len(pairs), len(get_scoring_columns(args))), dtype=np.float32)
+    for direction, (slang, tlang, direction_pairs) in enumerate(directions):
+        tlang_id = tok([tlang if args.use_official_pretrained else "<2"+tlang+">"], add_special_tokens=False).input_ids[0][0]
+        src_ids, tgt_ids = tokenize_parallel_pairs(tok, args, direction_pairs, slang)
+        for batch in make_length_sorted_batches([max(len(src), len(tgt)+1) for src, tgt in zip(src_ids, tgt_ids)], args.score_batch_tokens):
+            input_ids, input_masks, decoder_input_ids, labels = make_pair_batch_tensors(src_ids, tgt_ids, batch, tlang_id, eos_id, pad_id)
+            logprob_sums, token_counts = score_pairs_batch(model, input_ids, input_masks, decoder_input_ids, labels, pad_id, device)
+            scores[batch, 3*direction] = logprob_sums.numpy()
+            scores[batch, 3*direction+1] = token_counts.numpy()
+        scores[:, 3*direction+2] = scores[:, 3*direction] / np.power(scores[:, 3*direction+1], args.score_length_normalization_alpha)
+    if args.score_both_directions: ## Penalizes pairs whose two directions disagree as well as pairs which are unlikely in both directions.
+        forward_xent = -scores[:, 2]
+        backward_xent = -scores[:, 5]
+        scores[:, 6] = np.abs(forward_xent - backward_xent) + 0.5*(forward_xent + backward_xent)
+    return scores
+
+
+def format_scores(args, scores):
+    """Converts the scores of a chunk into the bytes which are written to the output file. The binary format is a flat array of little endian float32 values with one row of len(get_scoring_columns(args)) values per pair and can be read with numpy.fromfile(path, dtype='<f4').reshape(-1, num_columns)."""
+    if args.score_output_format == "binary":
+        return scores.astype("<f4").tobytes()
+    return "".join(["\t".join(["%.6g" % value for value in row]) + "\n" for row in scores.tolist()]).encode("utf-8")
+
+
+class OrderedChunkWriter:
+    """Writes the scores of the chunks to the output file in the order of the corpus. Every process writes the scores of its chunks to a temporary file next to the output file and the process of rank 0 appends them to the output file as soon as all the preceding chunks are done. A background thread of rank 0 keeps looking for finished chunks so the output is streamed even after rank 0 has run out of chunks of its own. With multiple nodes the output file must be on a shared filesystem."""
+    def __init__(self, path, rank, poll_interval=2.0):
+        self.path = path
+        self.rank = rank
+        self.next_chunk = 0
+        self.outf = open(path, 'wb') if rank == 0 else None
+        if rank == 0:
+            self.lock = threading.Lock() ## The polling thread and the main thread both append to the output file.
+            self.stop_polling = threading.Event()
+            self.poller = threading.Thread(target=self.poll, args=(poll_interval,), daemon=True)
+            self.poller.start()
+
+    def chunk_path(self, chunk_idx):
+        return self.path + ".chunk" + str(chunk_idx)
+
+    def poll(self, poll_interval):
+        while not self.stop_polling.wait(poll_interval):
+            self.flush_ready_chunks()
+
+    def write(self, chunk_idx, data):
+        if self.rank == 0:
+            with self.lock:
+                if chunk_idx == self.next_chunk:
+                    self.outf.write(data)
+                    self.next_chunk += 1
+                    data = None
+        if data is not None:
+            with open(self.chunk_path(chunk_idx) + ".tmp", 'wb') as chunk_file:
+                chunk_file.write(data)
+            os.replace(self.chunk_path(chunk_idx) + ".tmp", self.chunk_path(chunk_idx)) ## Atomic so that rank 0 never sees a partially written chunk.
+        self.flush_ready_chunks()
+
+    def flush_ready_chunks(self):
+        """Appends all the finished chunks which directly follow what has been written so far."""
+        if self.rank != 0:
+            return
+        with self.lock:
+            while os.path.exists(self.chunk_path(self.next_chunk)):
+                with open(self.chunk_path(self.next_chunk), 'rb') as chunk_file:
+                    shutil.copyfileobj(chunk_file, self.outf)
+                os.remove(self.chunk_path(self.next_chunk))
+                self.next_chunk += 1
+            self.outf.flush()
+
+    def close(self, num_chunks):
+        """Should be called after all processes are done (use a barrier)."""
+        if self.rank != 0:
+            return
+        self.stop_polling.set()
+        self.poller.join()
+        self.flush_ready_chunks()
+        assert self.next_chunk == num_chunks, "Only %d out of %d chunks were written." % (self.next_chunk, num_chunks)
+        self.outf.close()
+
+
+def tokenize_words(tok, words):
+    """Tokenizes every word separately and returns a list with the subword ids of each word. Concatenating them gives the tokenization of the whole sentence since the tokenizers split on spaces first, and it lets us mask words without tokenizing every masked variant again."""
+    if len(words) == 0:
+        return []
+    return tok(words, add_special_tokens=False).input_ids
+
+
+def get_alignment_sentences(args, pairs):
+    """Splits the (source, target) pairs into words and truncates them. Pairs which cannot be aligned are given as None."""
+    sentences = []
+    for src_sent, tgt_sent in pairs:
+        src_words = src_sent.split()[:args.max_src_length]
+        tgt_words = tgt_sent.split()[:args.max_tgt_length]
+        if len(src_words) == 0 or len(tgt_words) == 0 or (args.alignment_method == "masking" and (len(src_words) >= args.alignment_max_masking_length or len(tgt_words) >= args.alignment_max_masking_length)): ## Masking needs len(src_words)*len(tgt_words) forward passes so very long sentences are not aligned.
+            sentences.append(None)
+        else:
+            sentences.append((src_words, tgt_words))
+    return sentences
+
+
+def align_pairs_by_masking(model, tok, args, sentences, device):
+    """Aligns words by masking. Source is A B C and target is X Y Z. If B and Z are aligned then the lowest loss should be for the source A MASK C and target X Y MASK. For every source word we pick the target word whose masking gives the lowest loss. All the masked variants of all the sentences are put into length sorted batches and the encoder is run only once per masked source in a batch. Returns a list of (source word, target word) position pairs for every sentence."""
+    pad_id = tok.pad_token_id
+    eos_id = tok(["</s>"], add_special_tokens=False).input_ids[0][0]
+    mask_id = tok(["<mask>" if args.use_official_pretrained else "[MASK]"], add_special_tokens=False).input_ids[0][0]
+    slang_id = tok([args.slang if args.use_official_pretrained else "<2"+args.slang+">"], add_special_tokens=False).input_ids[0][0]
+    tlang_id = tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0]
+    word_ids = [None if sentence is None else (tokenize_words(tok, sentence[0]), tokenize_words(tok, sentence[1])) for sentence in sentences]
+    def masked_ids(words, position): ## Replaces all the subwords of the word at the position by one mask token.
+        return [subword for word_position, word in enumerate(words) for subword in ([mask_id] if word_position == position else word)]
+    variants = [] ## Sentence, masked source word and masked target word.
+    lengths = []
+    for sentence_idx, ids in enumerate(word_ids):
+        if ids is None:
+            continue
+        src_length = sum([len(word) for word in ids[0]])
+        tgt_length = sum([len(word) for word in ids[1]])
+        for src_position in range(len(ids[0])):
+            for tgt_position in range(len(ids[1])):
+                variants.append((sentence_idx, src_position, tgt_position))
+                lengths.append(max(src_length - len(ids[0][src_position]) + 3, tgt_length - len(ids[1][tgt_position]) + 2))
+    losses = {}
+    for batch in make_length_sorted_batches(lengths, args.alignment_batch_tokens):
+        encoder_rows = {} ## Masked sources which are shared by several variants in the batch are encoded once.
+        for idx in batch:
+            encoder_rows.setdefault(variants[idx][:2], len(encoder_rows))
+        src_ids = [masked_ids(word_ids[sentence_idx][0], src_position) + [eos_id, slang_id] for sentence_idx, src_position in encoder_rows]
+        tgt_ids = [masked_ids(word_ids[variants[idx][0]][1], variants[idx][2]) for idx in batch]
+        input_ids = pad_sequences(src_ids, pad_id)
+        input_masks = (input_ids != pad_id).int()
+        decoder_input_ids = pad_sequences([[tlang_id] + ids for ids in tgt_ids], pad_id)
+        labels = pad_sequences([ids + [eos_id] for ids in tgt_ids], pad_id)
+        encoder_index = torch.tensor([encoder_rows[variants[idx][:2]] for idx in batch], dtype=torch.long, device=device)
+        labels = labels.to(device)
+        with torch.no_grad():
+            encoder_hidden_states = model.get_encoder()(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), return_dict=True).last_hidden_state
+            logits = model(attention_mask=input_masks.to(device).index_select(0, encoder_index), encoder_outputs=(encoder_hidden_states.index_select(0, encoder_index),), decoder_input_ids=decoder_input_ids.to(device), use_cache=False).logits
+            nlls = -(logits.gather(-1, labels.unsqueeze(-1)).squeeze(-1).float() - torch.logsumexp(logits.float(), dim=-1))
+            label_masks = (labels != pad_id)
+            nlls = (nlls.masked_fill(~label_masks, 0.0).sum(dim=-1)/label_masks.sum(dim=-1)).tolist()
+        for idx, nll in zip(batch, nlls):
+            losses[variants[idx]] = nll
+    alignments = []
+    for sentence_idx, sentence in enumerate(sentences):
+        if sentence is None:
+            alignments.append([])
+            continue
+        alignments.append([(src_position, min(range(len(sentence[1])), key=lambda tgt_position: losses[(sentence_idx, src_position, tgt_position)])) for src_position in range(len(sentence[0]))])
+    return alignments
+
+
+def align_pairs_by_attention(model, tok, args, sentences, device):
+    """Aligns words using the cross attention of a single forward pass per sentence pair. The attention is averaged over the heads and the layers in --alignment_layers (all by default) and summed over the subwords of each word. Every target word is aligned to the source word it attends to the most. The attention of a decoder position is used for the target word it predicts. Returns a list of (source word, target word) position pairs for every sentence."""
+    pad_id = tok.pad_token_id
+    eos_id = tok(["</s>"], add_special_tokens=False).input_ids[0][0]
+    slang_id = tok([args.slang if args.use_official_pretrained else "<2"+args.slang+">"], add_special_tokens=False).input_ids[0][0]
+    tlang_id = tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0]
+    word_ids = [None if sentence is None else (tokenize_words(tok, sentence[0]), tokenize_words(tok, sentence[1])) for sentence in sentences]
+    valid = [sentence_idx for sentence_idx, ids in enumerate(word_ids) if ids is not None]
+    src_ids = [[subword for word in word_ids[sentence_idx][0] for subword in word] + [eos_id, slang_id] for sentence_idx in valid]
+    tgt_ids = [[subword for word in word_ids[sentence_idx][1] for subword in word] for sentence_idx in valid]
+    alignments = [[] for _ in sentences]
+    for batch in make_length_sorted_batches([max(len(src), len(tgt)+1) for src, tgt in zip(src_ids, tgt_ids)], args.alignment_batch_tokens):
+        input_ids, input_masks, decoder_input_ids, _ = make_pair_batch_tensors(src_ids, tgt_ids, batch, tlang_id, eos_id, pad_id)
+        with torch.no_grad():
+            cross_attentions = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device), output_attentions=True, use_cache=False).cross_attentions
+            layers = args.alignment_layers if args.alignment_layers is not None else range(len(cross_attentions))
+            attention = torch.stack([cross_attentions[layer_id].float() for layer_id in layers]).mean(dim=0).mean(dim=1).cpu().numpy() ## batch x target length x source length
+        for row, idx in enumerate(batch):
+            src_words, tgt_words = word_ids[valid[idx]]
+            src_word_positions = np.array([word_position for word_position, word in enumerate(src_words) for _ in word], dtype=np.int64)
+            tgt_word_positions = np.array([word_position for word_position, word in enumerate(tgt_words) for _ in word], dtype=np.int64)
+            word_attention = np.zeros((len(tgt_words), len(src_words)), dtype=np.float32)
+            np.add.at(word_attention, (tgt_word_positions[:, None], src_word_positions[None, :]), attention[row, :len(tgt_word_positions), :len(src_word_positions)])
+            alignments[valid[idx]] = sorted([(int(src_position), tgt_position) for tgt_position, src_position in enumerate(word_attention.argmax(axis=1))])
+    return alignments
+
+
+def format_alignments(args, sentences, alignments):
+    """Returns the lines to be written for the alignments of a chunk. The pharaoh format gives the 0 indexed source-target word position pairs separated by spaces. The verbose format also gives the source and target sentences and the aligned words separated by tabs. Pairs which were not aligned give empty lines so that the output stays parallel to the input."""
+    lines = []
+    for sentence, alignment in zip(sentences, alignments):
+        pharaoh = " ".join([str(src_position) + "-" + str(tgt_position) for src_position, tgt_position in alignment])
+        if args.alignment_output_format == "verbose" and sentence is not None:
+            lines.append(" ".join(sentence[0]) + "\t" + " ".join(sentence[1]) + "\t" + pharaoh + "\t" + " ".join([sentence[0][src_position] + "-" + sentence[1][tgt_position] for src_position, tgt_position in alignment]))
+        else:
+            lines.append(pharaoh)
+    return "".join([line + "\n" for line in lines]).encode("utf-8")
+
+
+def get_representation_name(layer_id, pooling):
+    """Returns the name under which the representations of a layer pooled in a particular way are saved."""
+    return "layer-" + str(layer_id) + "." + pooling
+
+
+def pool_hidden_states(hidden_state, masks, pooling):
+    """Pools the hidden states of a batch (batch x length x dim) into one vector per sentence while ignoring the padding. mean averages the tokens, max takes the elementwise maximum, first takes the first token and last takes the last non padding token."""
+    masks = masks.unsqueeze(2).to(hidden_state.dtype)
+    if pooling == "mean":
+        return (hidden_state*masks).sum(dim=1)/masks.sum(dim=1).clamp(min=1)
+    elif pooling == "max":
+        return hidden_state.masked_fill(masks == 0, float("-inf")).max(dim=1)[0]
+    elif pooling == "first":
+        return hidden_state[:, 0]
+    else:
+        last_positions = masks.squeeze(2).sum(dim=1).long() - 1
+        return hidden_state[torch.arange(hidden_state.size(0), device=hidden_state.device), last_positions]
+
+
+def extract_representations_chunk(model, tok, args, lines, layers_and_poolings, device):
+    """Extracts the pooled encoder or decoder representations of a chunk of sentences for several layers and pooling methods in a single pass. The sentences are sorted by length and batched using a token budget. Returns a dict from the representation name to an array with one row per sentence in the original order. For encoder representations only the encoder is run."""
+    encoder_only = args.decode_type == "get_enc_representations"
+    pad_id = tok.pad_token_id
+    eos_id = tok(["</s>"], add_special_tokens=False).input_ids[0][0]
+    tlang_id = tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0]
+    src_ids, tgt_ids = tokenize_parallel_pairs(tok, args, [(line[0], line[1] if len(line) > 1 else "") for line in lines], args.slang)
+    lengths = [len(src) if encoder_only else max(len(src), len(tgt)+1) for src, tgt in zip(src_ids, tgt_ids)]
+    dtype = np.float16 if args.representation_dtype == "float16" else np.float32
+    representations = {get_representation_name(layer_id, pooling): np.zeros((len(lines), model.config.d_model), dtype=dtype) for layer_id, pooling in layers_and_poolings}
+    for batch in make_length_sorted_batches(lengths, args.representation_batch_tokens):
+        input_ids, input_masks, decoder_input_ids, _ = make_pair_batch_tensors(src_ids, tgt_ids, batch, tlang_id, eos_id, pad_id)
+        with torch.no_grad():
+            if encoder_only:
+                hidden_states = model.get_encoder()(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), output_hidden_states=True, return_dict=True).hidden_states
+                masks = input_masks.to(device)
+            else:
+                hidden_states = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device), output_hidden_states=True, use_cache=False).decoder_hidden_states
+                masks = (decoder_input_ids != pad_id).int().to(device)
+            for layer_id, pooling in layers_and_poolings:
+                representations[get_representation_name(layer_id, pooling)][batch] = pool_hidden_states(hidden_states[layer_id], masks, pooling).cpu().numpy().astype(dtype)
+    return representations
+
+
+class RepresentationStore:
+    """Writes sentence representations to disk as float16 or float32 arrays with one array per representation name. The npy format writes a single memory mapped .npy file per name which every process fills in place. The sharded format writes one .npy file per chunk and name along with an index file listing the shards, so finished chunks can be used while the rest of the corpus is still being processed. Both can be loaded with numpy.load(path, mmap_mode='r'). With multiple nodes the output must be on a shared filesystem."""
+    def __init__(self, args, names, dim, num_sentences, rank):
+        self.prefix = args.test_tgt
+        self.output_format = args.representation_output_format
+        self.chunk_size = args.representation_chunk_size
+        self.names = names
+        self.rank = rank
+        dtype = np.float16 if args.representation_dtype == "float16" else np.float32
+        if self.output_format == "npy":
+            if rank == 0: ## Create the arrays once and let every process open them.
+                for name in names:
+                    np.lib.format.open_memmap(self.array_path(name), mode="w+", dtype=dtype, shape=(num_sentences, dim)).flush()
+            dist.barrier()
+            self.arrays = {name: np.lib.format.open_memmap(self.array_path(name), mode="r+") for name in names}
+        elif rank == 0:
+            num_shards = (num_sentences + self.chunk_size - 1) // self.chunk_size
+            index = {"dtype": args.representation_dtype, "dim": dim, "num_sentences": num_sentences, "shard_size": self.chunk_size, "shards": {name: [os.path.basename(self.array_path(name, shard_idx)) for shard_idx in range(num_shards)] for name in names}}
+            with open(self.prefix + ".index.json", "w") as index_file:
+                json.dump(index, index_file, indent=2)
+
+    def array_path(self, name, shard_idx=None):
+        if shard_idx is None:
+            return self.prefix + "." + name + ".npy"
+        return self.prefix + "." + name + ".shard-%05d.npy" % shard_idx
+
+    def write(self, chunk_idx, representations):
+        for name in self.names:
+            if self.output_format == "npy":
+                start = chunk_idx*self.chunk_size
+                self.arrays[name][start:start+len(representations[name])] = representations[name]
+            else:
+                np.save(self.array_path(name, chunk_idx), representations[name])
+
+    def close(self):
+        if self.output_format == "npy":
+            for name in self.names:
+                self.arrays[name].flush()
+            del self.arrays
+
+
+def quantize_model_dynamic_int8(model):
+    """Applies dynamic int8 quantization to all the linear layers of the model in place. This covers the attention projections, the feed forward layers and the lm_head. The weights are stored in int8 and the activations are quantized on the fly so this only works on the CPU. Since the swap happens inside the layer objects, recurrently stacked (tied) layers stay tied."""
+    torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def get_model_size_in_mb(model):
+    """Returns the size of the serialized parameters and buffers of the model in MB. For quantized models this includes the packed int8 weights."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes/(1024*1024)
+
+
+def get_peak_cpu_memory_in_mb():
+    """Returns the peak resident memory of the current process in MB. On linux ru_maxrss is in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
 
 def plot_attention(data, X_label=None, Y_label=None, num_layers=None, num_heads=None, file_name=None, plot_title=None):
     '''
@@ -1370,6 +3162,100 @@ def plot_attention(data, X_label=None, Y_label=None, num_layers=None, num_heads=
     plt.close(fig)  # close the figure
 
 
+class AttentionStore:
+    """Writes the encoder self attention, decoder self attention and cross attention of every sentence pair to disk. Every chunk of sentences becomes a shard which is a zip of compressed .npy arrays of shape (layers, heads, query length, key length) named SENTENCE.enc_enc, SENTENCE.dec_dec and SENTENCE.enc_dec along with a .json file with the tokens of each sentence. Sentences are written to the shard as soon as their batch is done so memory use does not depend on the shard size. A shard can be read with numpy.load(path) once its .json file exists. prefix.attention.index.json describes the store."""
+    def __init__(self, args, layers, heads, num_sentences, rank):
+        self.prefix = args.test_tgt + ".attention"
+        self.dtype = np.float16 if args.attention_dtype == "float16" else np.float32
+        if rank == 0:
+            num_shards = (num_sentences + args.attention_shard_size - 1) // args.attention_shard_size
+            index = {"dtype": args.attention_dtype, "layers": layers, "heads": heads, "num_sentences": num_sentences, "shard_size": args.attention_shard_size, "shards": [os.path.basename(self.shard_path(shard_idx)) for shard_idx in range(num_shards)]}
+            with open(self.prefix + ".index.json", "w") as index_file:
+                json.dump(index, index_file, indent=2)
+        self.shard = None
+
+    def shard_path(self, shard_idx):
+        return self.prefix + ".shard-%05d.npz" % shard_idx
+
+    def open_shard(self, shard_idx):
+        self.shard_idx = shard_idx
+        self.shard = zipfile.ZipFile(self.shard_path(shard_idx), "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.records = []
+
+    def write(self, sentence_id, source_tokens, target_tokens, attentions):
+        """Adds a sentence pair to the current shard. attentions is a dict from the attention type to its array."""
+        for attention_type, attention in attentions.items():
+            with self.shard.open(str(sentence_id) + "." + attention_type + ".npy", "w", force_zip64=True) as array_file:
+                np.lib.format.write_array(array_file, attention.astype(self.dtype))
+        self.records.append({"sentence": sentence_id, "source_tokens": source_tokens, "target_tokens": target_tokens})
+
+    def close_shard(self):
+        self.shard.close()
+        with open(self.shard_path(self.shard_idx)[:-len(".npz")] + ".json", "w") as records_file: ## Written last so that its existence means the shard is complete.
+            json.dump(sorted(self.records, key=lambda record: record["sentence"]), records_file)
+        self.shard = None
+
+
+def extract_attentions_chunk(model, tok, args, chunk_idx, pairs, layers, heads, store, device):
+    """Runs the sentence pairs of a chunk through the model in length sorted batches and writes the attentions of the selected layers and heads of every pair, without padding, to a new shard of the store. The target tokens are the decoder inputs."""
+    pad_id = tok.pad_token_id
+    eos_id = tok(["</s>"], add_special_tokens=False).input_ids[0][0]
+    tlang_id = tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0]
+    src_ids, tgt_ids = tokenize_parallel_pairs(tok, args, pairs, args.slang)
+    store.open_shard(chunk_idx)
+    for batch in make_length_sorted_batches([max(len(src), len(tgt)+1) for src, tgt in zip(src_ids, tgt_ids)], args.attention_batch_tokens):
+        input_ids, input_masks, decoder_input_ids, _ = make_pair_batch_tensors(src_ids, tgt_ids, batch, tlang_id, eos_id, pad_id)
+        with torch.no_grad():
+            mod_compute = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device), output_attentions=True, use_cache=False)
+            batch_attentions = {attention_type: torch.stack([attentions[layer_id] for layer_id in layers], dim=1)[:, :, heads].to(torch.float16 if args.attention_dtype == "float16" else torch.float32).cpu().numpy() for attention_type, attentions in [("enc_enc", mod_compute.encoder_attentions), ("dec_dec", mod_compute.decoder_attentions), ("enc_dec", mod_compute.cross_attentions)]} ## batch x layers x heads x query length x key length. Converted before moving to the CPU so that float16 halves the transfer.
+        for row, idx in enumerate(batch):
+            src_length = len(src_ids[idx])
+            tgt_length = len(tgt_ids[idx]) + 1
+            store.write(chunk_idx*args.attention_shard_size + idx, tok.convert_ids_to_tokens(src_ids[idx]), tok.convert_ids_to_tokens([tlang_id] + tgt_ids[idx]), {"enc_enc": batch_attentions["enc_enc"][row, :, :, :src_length, :src_length], "dec_dec": batch_attentions["dec_dec"][row, :, :, :tgt_length, :tgt_length], "enc_dec": batch_attentions["enc_dec"][row, :, :, :tgt_length, :src_length]})
+    store.close_shard()
+
+
+def render_attention_plot(task):
+    """Plots one type of attention of one sentence pair. With a single layer and head this is a plain heatmap. Otherwise the layers and heads are laid out in a grid where each query token has one row per layer and each head has its own block of key token columns. This runs in the plotting processes."""
+    shard_path, sentence_id, attention_type, source_tokens, target_tokens, layers, heads, file_prefix = task
+    with np.load(shard_path) as shard:
+        data = shard[str(sentence_id) + "." + attention_type].astype(np.float32)
+    num_layers, num_heads, query_length, key_length = data.shape
+    query_tokens = source_tokens if attention_type == "enc_enc" else target_tokens
+    key_tokens = target_tokens if attention_type == "dec_dec" else source_tokens
+    title = {"enc_enc": "Encoder Encoder Attention", "dec_dec": "Decoder Decoder Attention", "enc_dec": "Encoder Decoder Attention"}[attention_type]
+    if num_layers == 1 and num_heads == 1:
+        plot_attention(data[0, 0], key_tokens, query_tokens, 1, 1, file_prefix+".sentence-"+str(sentence_id)+".layer-"+str(layers[0])+".head-"+str(heads[0])+"."+attention_type+".png", title)
+    else:
+        query_labels = [label for token in query_tokens for label in [token+" L-"+str(layers[0])] + ["L-"+str(layer_id) for layer_id in layers[1:]]]
+        plot_attention(data.transpose(2, 0, 1, 3).reshape(query_length*num_layers, num_heads*key_length), key_tokens*num_heads, query_labels, num_layers, num_heads, file_prefix+".sentence-"+str(sentence_id)+"."+attention_type+".png", title)
+
+
+def render_attention_plots(prefix, num_workers=0, sentence_ids=None, attention_types=("enc_enc", "dec_dec", "enc_dec")):
+    """Renders the plots of the attentions saved by the get_attention decode type with the output prefix prefix. The plots are rendered in parallel by num_workers processes (in this process if 0) and saved with the same prefix. Only the shards which are complete are used."""
+    with open(prefix + ".attention.index.json") as index_file:
+        index = json.load(index_file)
+    tasks = []
+    for shard_name in index["shards"]:
+        shard_path = os.path.join(os.path.dirname(prefix + ".attention.index.json"), shard_name)
+        if not os.path.exists(shard_path[:-len(".npz")] + ".json"):
+            print("Skipping the incomplete shard", shard_path)
+            continue
+        with open(shard_path[:-len(".npz")] + ".json") as records_file:
+            records = json.load(records_file)
+        for record in records:
+            if sentence_ids is None or record["sentence"] in sentence_ids:
+                for attention_type in attention_types:
+                    tasks.append((shard_path, record["sentence"], attention_type, record["source_tokens"], record["target_tokens"], index["layers"], index["heads"], prefix))
+    print("Rendering", len(tasks), "plots with", num_workers, "processes.")
+    if num_workers > 0:
+        with mp.get_context("spawn").Pool(num_workers) as pool:
+            pool.map(render_attention_plot, tasks, chunksize=max(1, len(tasks)//(4*num_workers)))
+    else:
+        for task in tasks:
+            render_attention_plot(task)
+
+
 def generate_batches_monolingual_masked_or_bilingual(tok, args, rank, files, train_files):
     """This will return masked monolingual or bilingual batches according to a fixed ratio."""
     bilingual_generator = generate_batches_bilingual(tok, args, train_files, rank)
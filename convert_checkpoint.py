@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import time
+##
+
+## Pytorch imports
+import torch
+##
+
+## Our imports
+from common_utils import *
+##
+
+
+def convert_checkpoint(args):
+    """Converts a regular checkpoint to a flat one which can be memory mapped or a flat one back to a regular one. Optionally only the model is kept and the model parameters are stored in half precision."""
+    start = time.time()
+    checkpoint_dict = load_checkpoint(args.input, map_location="cpu")
+    print("Loaded", args.input, "in", time.time()-start, "seconds.")
+    if args.model_only and type(checkpoint_dict) == dict:
+        checkpoint_dict = checkpoint_dict["model"]
+    
+    start = time.time()
+    if args.to == "flat":
+        save_flat_checkpoint(checkpoint_dict, args.output, storage_dtype={"fp32": None, "fp16": "float16", "bf16": "bfloat16"}[args.storage_dtype])
+    else:
+        if type(checkpoint_dict) == dict and "model" in checkpoint_dict:
+            checkpoint_dict["model"] = collections.OrderedDict(checkpoint_dict["model"].items())
+        else:
+            checkpoint_dict = collections.OrderedDict(checkpoint_dict.items())
+        torch.save(checkpoint_dict, args.output)
+    print("Saved", args.output, "in", time.time()-start, "seconds. The input was", os.path.getsize(args.input)/(1024*1024), "MB and the output is", os.path.getsize(args.output)/(1024*1024), "MB.")
+
+
+def benchmark_checkpoint_loading(args):
+    """Compares how long it takes to get the model parameters out of the regular and the flat checkpoint. For the flat checkpoint we also report how long it takes to touch the first tensor and all the tensors since nothing is read from the disk before that. Drop the page cache before running this if you want cold start numbers."""
+    regular_checkpoint, flat_checkpoint = (args.input, args.output) if args.to == "flat" else (args.output, args.input)
+    start = time.time()
+    checkpoint_dict = torch.load(regular_checkpoint, map_location="cpu")
+    print("torch.load took", time.time()-start, "seconds.")
+    del checkpoint_dict
+    
+    start = time.time()
+    checkpoint_dict = load_checkpoint(flat_checkpoint, map_location="cpu")
+    print("Memory mapping the flat checkpoint took", time.time()-start, "seconds.")
+    model_dict = checkpoint_dict["model"] if type(checkpoint_dict) == dict else checkpoint_dict
+    first_key = next(iter(model_dict.keys()))
+    model_dict[first_key].sum()
+    print("Time to the first tensor", first_key, "was", time.time()-start, "seconds.")
+    total = 0.0
+    for key in model_dict.keys():
+        total += model_dict[key].float().sum().item() ## Makes sure every page is actually read.
+    print("Touching all", len(model_dict), "tensors took", time.time()-start, "seconds in total.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to convert checkpoints to and from the flat format which can be memory mapped for fast decoding and serving startup.",
+    )
+    parser.add_argument('--input', required=True, type=str,
+                        help='The checkpoint to convert. It can be a full checkpoint with the optimizer state or a pure model.')
+    parser.add_argument('--output', required=True, type=str,
+                        help='The converted checkpoint will be written here.')
+    parser.add_argument('--to', default='flat', type=str, choices=['flat', 'torch'],
+                        help='Should we convert to the flat format or back to the regular torch format? The flat format is a JSON header followed by the raw tensors. load_checkpoint in common_utils.py detects it automatically so train_nmt.py, decode_nmt.py and yanmtt_interface.py can use either format.')
+    parser.add_argument('--storage_dtype', default='fp32', type=str, choices=['fp32', 'fp16', 'bf16'],
+                        help='The precision in which the floating point model parameters are stored in the flat checkpoint. fp16 and bf16 halve the size of the file. fp16 tensors are used directly from the file whereas bf16 tensors are converted to fp32 when they are first used. bf16 keeps the range of fp32 and fp16 keeps more precision. The optimizer state is never converted.')
+    parser.add_argument('--model_only', action='store_true',
+                        help='Should we drop the optimizer and scheduler states and keep only the model? Useful for checkpoints meant for decoding.')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Should we compare the loading times of the regular and flat checkpoints after converting?')
+    args = parser.parse_args()
+    print(args)
+
+    convert_checkpoint(args)
+    if args.benchmark:
+        benchmark_checkpoint_loading(args)
+
+
+if __name__ == "__main__":
+    main()
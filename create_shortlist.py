@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import collections
+import time
+##
+
+## Huggingface imports
+from transformers import AutoTokenizer, MBartTokenizer, MBart50Tokenizer, BartTokenizer
+##
+
+## Pytorch imports
+import torch
+##
+
+
+def load_tokenizer(args):
+    """Loads the tokenizer the same way as the training and decoding scripts do so that the ids in the shortlist match the ids of the model."""
+    if args.use_official_pretrained:
+        if "mbart" in args.tokenizer_name_or_path:
+            if "50" in args.tokenizer_name_or_path:
+                return MBart50Tokenizer.from_pretrained(args.tokenizer_name_or_path)
+            return MBartTokenizer.from_pretrained(args.tokenizer_name_or_path)
+        return BartTokenizer.from_pretrained(args.tokenizer_name_or_path)
+    return AutoTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
+
+
+def count_cooccurrences(tok, args):
+    """Counts how often each source token and each target token appear in the same sentence pair. A token is counted once per sentence. Also returns the sentence level counts of the source and target tokens and the raw target token frequencies."""
+    cooccurrence_counts = collections.defaultdict(collections.Counter)
+    src_counts = collections.Counter()
+    tgt_counts = collections.Counter()
+    tgt_frequencies = collections.Counter()
+    num_lines = 0
+    start = time.time()
+    for src_line, tgt_line in zip(open(args.train_src), open(args.train_tgt)):
+        src_ids = tok(src_line.strip(), add_special_tokens=False).input_ids[:args.max_src_length]
+        tgt_ids = tok(tgt_line.strip(), add_special_tokens=False).input_ids[:args.max_tgt_length]
+        tgt_frequencies.update(tgt_ids)
+        src_ids = set(src_ids)
+        tgt_ids = set(tgt_ids)
+        src_counts.update(src_ids)
+        tgt_counts.update(tgt_ids)
+        for src_id in src_ids:
+            cooccurrence_counts[src_id].update(tgt_ids)
+        num_lines += 1
+        if num_lines % 100000 == 0:
+            print("Processed", num_lines, "lines in", time.time()-start, "seconds")
+        if num_lines == args.max_lines:
+            break
+    print("Processed a total of", num_lines, "lines in", time.time()-start, "seconds")
+    return cooccurrence_counts, src_counts, tgt_counts, tgt_frequencies
+
+
+def build_shortlist(tok, args):
+    """Builds a table of shape (vocab size, top_k_per_source) containing, for each source token id, the target token ids which it co-occurs with the most. Rows are padded with the pad token id which is always in the shortlist anyway. The dice score is the default since the raw co-occurrence count prefers frequent target tokens which are covered by the top frequent list anyway."""
+    cooccurrence_counts, src_counts, tgt_counts, tgt_frequencies = count_cooccurrences(tok, args)
+    shortlist = torch.full((len(tok), args.top_k_per_source), tok.pad_token_id, dtype=torch.int32)
+    for src_id, tgt_id_counts in cooccurrence_counts.items():
+        if args.scoring == "dice":
+            scored = [(2.0*count/(src_counts[src_id]+tgt_counts[tgt_id]), tgt_id) for tgt_id, count in tgt_id_counts.items() if count >= args.min_count]
+        else:
+            scored = [(count, tgt_id) for tgt_id, count in tgt_id_counts.items() if count >= args.min_count]
+        scored.sort(reverse=True)
+        tgt_ids = [tgt_id for _, tgt_id in scored[:args.top_k_per_source]]
+        if len(tgt_ids) > 0:
+            shortlist[src_id, :len(tgt_ids)] = torch.tensor(tgt_ids, dtype=torch.int32)
+    top_frequent = torch.tensor([tgt_id for tgt_id, _ in tgt_frequencies.most_common(args.top_frequent)], dtype=torch.int32)
+    return {"shortlist": shortlist, "top_frequent": top_frequent, "scoring": args.scoring, "vocab_size": len(tok)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to build a lexical shortlist of target tokens for each source token from a parallel corpus. "
+        "The shortlist is used by decode_nmt.py to restrict the output projection at decoding time.",
+    )
+    parser.add_argument('--train_src', required=True, type=str,
+                        help='Source language training sentences.')
+    parser.add_argument('--train_tgt', required=True, type=str,
+                        help='Target language training sentences. Should be line aligned with the source sentences.')
+    parser.add_argument('--output', required=True, metavar='FILE',
+                        help='Write the shortlist to this path.')
+    parser.add_argument('--tokenizer_name_or_path', default='ai4bharat/indic-bert', type=str,
+                        help='Name of or path to the tokenizer. This must be the same tokenizer as the one used by the model you will decode with.')
+    parser.add_argument('--use_official_pretrained', action='store_true',
+                        help='Use this flag if the tokenizer is that of an official pre-trained model.')
+    parser.add_argument('--top_k_per_source', default=100, type=int,
+                        help='The number of target tokens to keep for each source token.')
+    parser.add_argument('--top_frequent', default=1000, type=int,
+                        help='The number of most frequent target tokens to save. These are always added to the shortlist at decoding time. You can use fewer of them at decoding time but not more.')
+    parser.add_argument('--min_count', default=1, type=int,
+                        help='Source and target token pairs that co-occur fewer times than this are ignored.')
+    parser.add_argument('--scoring', default='dice', type=str, choices=['dice', 'cooccurrence'],
+                        help='How to rank the target tokens for a source token. dice uses the dice coefficient and cooccurrence uses the raw co-occurrence count.')
+    parser.add_argument('--max_lines', default=-1, type=int,
+                        help='Only use this many lines of the corpus. -1 means use the whole corpus.')
+    parser.add_argument('--max_src_length', default=256, type=int,
+                        help='Maximum token length for source language')
+    parser.add_argument('--max_tgt_length', default=256, type=int,
+                        help='Maximum token length for target language')
+    args = parser.parse_args()
+    print(args)
+
+    tok = load_tokenizer(args)
+    shortlist = build_shortlist(tok, args)
+    torch.save(shortlist, args.output)
+    print("Finished writing shortlist to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ import os
 import sys
 import argparse
 import time
+import copy
 os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"   # see issue #152
 ##
 
@@ -70,10 +71,20 @@ rcParams['font.sans-serif'] = ['Source Han Sans TW',
 ##
 
 
-def model_create_load_decode(gpu, args):
+def translate_batch(model, tok, args, device, input_ids, input_masks, input_ids_parent=None, input_masks_parent=None):
+    """Translates a batch of source sentences with beam search. The model should be the underlying model and not the DDP wrapper. The parent inputs are only used for multi-source NMT."""
+    with torch.no_grad():
+        translations = model.generate(input_ids.to(device), use_cache=True, num_beams=args.beam_size, max_length=int((len(input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=input_masks.to(device), pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, num_return_sequences=args.beam_size if args.return_all_sequences else 1, additional_input_ids=input_ids_parent.to(device) if args.multi_source else None, additional_input_ids_mask=input_masks_parent.to(device) if args.multi_source else None) ## We translate the batch.
+    return translations
+
+
+def model_create_load_decode(gpu, args, shared_checkpoint_dicts=None):
     """The main function which does the overall decoding, visualization etc. Should be split into multiple parts in the future. Currently monolithc intentionally."""
     rank = args.nr * args.gpus + gpu ## The rank of the current process out of the total number of processes indicated by world_size. This need not be done using DDP but I am leaving it as is for consistency with my other code. In the future, I plan to support sharding the decoding data into multiple shards which will then be decoded in a distributed fashion.
-    dist.init_process_group(backend='nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    dist.init_process_group(backend='gloo' if args.cpu else 'nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    device = "cpu" if args.cpu else gpu ## Everything that goes to the model goes to this device.
+    if args.cpu and args.num_cpu_threads > 0:
+        torch.set_num_threads(args.num_cpu_threads)
     
     if args.use_official_pretrained:
         if "mbart" in args.model_path:
@@ -105,215 +116,256 @@ def model_create_load_decode(gpu, args):
             model = BartForConditionalGeneration.from_pretrained(args.model_path, force_bos_token_to_be_generated=True) ## This is only to avoid having to specify the hyperparams manually assuming you fine-tuned an official model. If you know the hyperparams then dont use this.
     else:
         config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings) ## Configuration.
-        model = MBartForConditionalGeneration(config)
+        with skip_weight_initialization(args.fast_checkpoint_loading and checkpoint_overwrites_all_parameters(args)): ## The checkpoint will overwrite the random initialization anyway.
+            model = MBartForConditionalGeneration(config)
     model.eval()
-    torch.cuda.set_device(gpu)
-    
-    model.cuda(gpu)
-    model = DistributedDataParallel(model, device_ids=[gpu])
+    if args.cpu: ## DDP works with CPU modules via gloo. We keep the wrapper so that the checkpoint loading logic stays the same.
+        model = DistributedDataParallel(model)
+    else:
+        torch.cuda.set_device(gpu)
+        model.cuda(gpu)
+        model = DistributedDataParallel(model, device_ids=[gpu])
     
+    if args.quantize_dynamic_int8:
+        assert args.cpu, "Dynamic int8 quantization is only supported for CPU decoding. Use the --cpu flag."
+    load_quantized_model_from_cache = args.quantize_dynamic_int8 and args.quantized_model_cache is not None and os.path.exists(args.quantized_model_cache) and not args.quantization_compare_with_fp32
     
-    if args.use_official_pretrained and args.locally_fine_tuned_model_path is None: ## If we want to directly decode an official model.
+    if load_quantized_model_from_cache: ## We have already quantized this model before so we skip loading the fp32 checkpoint. We first quantize the randomly initialized model so that its structure matches the cached model.
+        print("Loading the cached quantized model from", args.quantized_model_cache)
+        quantize_model_dynamic_int8(model.module)
+        model.module.load_state_dict(torch.load(args.quantized_model_cache, map_location="cpu"))
+    elif args.use_official_pretrained and args.locally_fine_tuned_model_path is None: ## If we want to directly decode an official model.
         pass
     else:
         if args.use_official_pretrained and args.locally_fine_tuned_model_path is not None: ## If we want to decode a locally fine-tuned version of an official model.
             args.model_path = args.locally_fine_tuned_model_path
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
-        checkpoint_dict = torch.load(args.model_path, map_location=map_location)
+        map_location = "cpu" if args.cpu else {'cuda:%d' % 0: 'cuda:%d' % gpu}
+        checkpoint_dict = load_checkpoint(args.model_path, map_location, shared_checkpoint_dicts)
         if type(checkpoint_dict) == dict:
             model.load_state_dict(remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), remap_layers(checkpoint_dict['model'], 4, args), args), strict=True if (args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization) else False) ## Modification needed if we want to load a partial model trained using multilayer softmaxing.
         else:
             model.module.load_state_dict(remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), remap_layers(checkpoint_dict, 3, args), args), strict=True if (args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization) else False) ## Modification needed if we want to load a partial model trained using multilayer softmaxing.
+    if args.quantize_dynamic_int8 and not load_quantized_model_from_cache:
+        print("Size of the fp32 model is", get_model_size_in_mb(model.module), "MB.")
+        if args.quantization_compare_with_fp32:
+            fp32_model = copy.deepcopy(model.module)
+        quantize_model_dynamic_int8(model.module)
+        if args.quantized_model_cache is not None and rank == 0:
+            print("Saving the quantized model to", args.quantized_model_cache)
+            torch.save(model.module.state_dict(), args.quantized_model_cache)
+    if args.quantize_dynamic_int8:
+        print("Size of the int8 quantized model is", get_model_size_in_mb(model.module), "MB.")
     model.eval()        
     ctr = 0
     outf = open(args.test_tgt, 'w')
     if args.decode_type == "decode": ## Standard NMT decoding.
         print("Decoding file")
-        hyp = []
+        detokenizer = DetokenizationPipeline(tok, args.no_skip_special_tokens, args.detokenization_workers, outf) ## Detokenizes and writes the translations in the background while the next batch is being decoded.
         if args.test_ref is not None:
             refs = [[refline.strip() for refline in open(args.test_ref)]]
-        for input_ids, input_masks in generate_batches_for_decoding(tok, args): #infinite_same_sentence(10000):
+        decoding_time = 0.0
+        if args.quantization_compare_with_fp32:
+            hyp_fp32 = []
+            decoding_time_fp32 = 0.0
+        if args.shortlist_path is not None: ## Restrict the output projection to a lexical shortlist computed for each batch.
+            shortlist = load_output_shortlist(args, tok)
+            shortlist_sizes = []
+            if args.shortlist_compare_with_full_vocab:
+                hyp_full_vocab = []
+                decoding_time_full_vocab = 0.0
+        profiler = StepProfiler(args, rank, not args.cpu, args.profile_dir if args.profile_dir is not None else args.test_tgt+".profile") ## Profiles a range of batches if asked to.
+        for input_ids, input_masks in profiler.spanned_batches(generate_batches_for_decoding(tok, args)): #infinite_same_sentence(10000):
             start = time.time()
             print("Processing batch:", ctr)
+            input_ids_parent = None
+            input_masks_parent = None
             if args.multi_source:
                 input_ids_parent = input_ids[1]
                 input_ids = input_ids[0]
                 input_masks_parent = input_masks[1]
                 input_masks = input_masks[0]
-            with torch.no_grad():
-                translations = model.module.generate(input_ids.to(gpu), use_cache=True, num_beams=args.beam_size, max_length=int((len(input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=input_masks.to(gpu), pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, num_return_sequences=args.beam_size if args.return_all_sequences else 1, additional_input_ids=input_ids_parent.to(gpu) if args.multi_source else None, additional_input_ids_mask=input_masks_parent.to(gpu) if args.multi_source else None) ## We translate the batch.
+            if args.shortlist_path is not None:
+                shortlist_ids = get_output_shortlist_ids(input_ids, shortlist, tok)
+                shortlist_sizes.append(len(shortlist_ids))
+                if args.shortlist_compare_with_full_vocab: ## Decode the batch with the full vocabulary as well so that we can report the speedup and the BLEU delta.
+                    model.module.set_output_shortlist(None)
+                    if not args.cpu:
+                        torch.cuda.synchronize()
+                    full_vocab_start = time.time()
+                    translations = translate_batch(model.module, tok, args, device, input_ids, input_masks, input_ids_parent, input_masks_parent)
+                    if not args.cpu:
+                        torch.cuda.synchronize()
+                    decoding_time_full_vocab += time.time() - full_vocab_start
+                    for translation in translations:
+                        hyp_full_vocab.append(tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False))
+                model.module.set_output_shortlist(shortlist_ids)
+            if args.quantization_compare_with_fp32: ## Decode the batch with the unquantized model as well so that we can report the speedup and the BLEU delta.
+                fp32_start = time.time()
+                translations = translate_batch(fp32_model, tok, args, device, input_ids, input_masks, input_ids_parent, input_masks_parent)
+                decoding_time_fp32 += time.time() - fp32_start
+                for translation in translations:
+                    hyp_fp32.append(tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False))
+            if not args.cpu:
+                torch.cuda.synchronize()
+            decoding_start = time.time()
+            with profiler.span("generate"):
+                translations = translate_batch(model.module, tok, args, device, input_ids, input_masks, input_ids_parent, input_masks_parent)
+            if not args.cpu:
+                torch.cuda.synchronize()
+            decoding_time += time.time() - decoding_start
+            if args.shortlist_path is not None:
+                model.module.set_output_shortlist(None)
             print(len(input_ids), "in and", len(translations), "out")
-            if args.return_all_sequences:
-                input_ids = input_ids.repeat(args.beam_size,1)
-            for input_id, translation in zip(input_ids, translations):
-                translation  = tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) 
-                input_id  = tok.decode(input_id, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) ### Get the raw sentences.
-#                 print(input_id, " ### ", translation)
-                outf.write(translation+"\n")
-                outf.flush()
-                hyp.append(translation)
+            profiler.begin("detokenize")
+            detokenizer.submit(translations)
+            profiler.end("detokenize")
             ctr += 1
+            profiler.step()
+        profiler.close()
+        hyp = detokenizer.collect()
+        detokenizer.close()
+        print("Decoding took", decoding_time, "seconds.")
+        if args.cpu:
+            print("Peak CPU memory usage was", get_peak_cpu_memory_in_mb(), "MB.")
+        if args.quantization_compare_with_fp32:
+            print("Decoding with the fp32 model took", decoding_time_fp32, "seconds. The speedup due to quantization is", decoding_time_fp32/decoding_time)
+            print("Number of translations that changed due to quantization:", sum([1 for hyp_quantized, hyp_unquantized in zip(hyp, hyp_fp32) if hyp_quantized != hyp_unquantized]))
+        if args.shortlist_path is not None:
+            print("Average shortlist size was", sum(shortlist_sizes)/max(len(shortlist_sizes), 1), "out of a vocabulary of", len(tok))
+            if args.shortlist_compare_with_full_vocab:
+                print("Decoding with the full vocabulary took", decoding_time_full_vocab, "seconds. The speedup is", decoding_time_full_vocab/decoding_time)
+                print("Number of translations that changed due to the shortlist:", sum([1 for hyp_shortlist, hyp_full in zip(hyp, hyp_full_vocab) if hyp_shortlist != hyp_full]))
         if args.test_ref is not None:
             sbleu = get_sacrebleu(refs, hyp)
             print("BLEU score is:", sbleu)
+            if args.shortlist_path is not None and args.shortlist_compare_with_full_vocab:
+                sbleu_full_vocab = get_sacrebleu(refs, hyp_full_vocab)
+                print("BLEU score with the full vocabulary is:", sbleu_full_vocab)
+                print("BLEU delta due to the shortlist is:", sbleu - sbleu_full_vocab)
+            if args.quantization_compare_with_fp32:
+                sbleu_fp32 = get_sacrebleu(refs, hyp_fp32)
+                print("BLEU score with the fp32 model is:", sbleu_fp32)
+                print("BLEU delta due to quantization is:", sbleu - sbleu_fp32)
+    elif args.decode_type == "bulk_score": ## High throughput scoring of large parallel corpora, for example for filtering crawled data. The corpus is split into chunks which are distributed across the processes. Use multiple GPUs or multiple CPU processes (--cpu) to score faster.
+        assert args.test_ref is not None, "The targets to be scored must be given via --test_ref."
+        if args.score_precision != "fp32":
+            assert not args.cpu, "Half precision scoring is only supported on GPUs. Use --quantize_dynamic_int8 to speed up CPU scoring."
+            model.module.to(torch.float16 if args.score_precision == "fp16" else torch.bfloat16) ## bf16 needs a GPU and a pytorch version that support it.
+        outf.close()
+        dist.barrier() ## Every process has truncated the output file by now so rank 0 can safely write to it.
+        if rank == 0:
+            print("Scoring the corpus. Every line of the output will have the following columns:", ", ".join(get_scoring_columns(args)))
+        writer = OrderedChunkWriter(args.test_tgt, rank)
+        num_pairs = 0
+        scoring_start = time.time()
+        for chunk_idx, pairs in read_corpus_chunks([args.test_src, args.test_ref], args.score_chunk_size, rank, args.world_size):
+            chunk_start = time.time()
+            scores = score_corpus_chunk(model.module, tok, args, pairs, device)
+            writer.write(chunk_idx, format_scores(args, scores))
+            num_pairs += len(pairs)
+            print("Rank", rank, "scored chunk", chunk_idx, "with", len(pairs), "pairs at", len(pairs)/(time.time() - chunk_start), "pairs per second.")
+        print("Rank", rank, "scored", num_pairs, "pairs in", time.time() - scoring_start, "seconds.")
+        dist.barrier()
+        writer.close((count_lines(args.test_src) + args.score_chunk_size - 1) // args.score_chunk_size)
+        if args.cpu:
+            print("Peak CPU memory usage was", get_peak_cpu_memory_in_mb(), "MB.")
     elif args.decode_type == "score" or args.decode_type == "teacher_forced_decoding": ## Here we will either score a sentence and its translation. The score will be the NLL loss. If not scoring then we will use the softmax to generate translations.
         print("Scoring translations or teacher forced decoding. Will print the log probability or (oracle) translations.")
-        hyp = []
+        if args.decode_type == "teacher_forced_decoding":
+            detokenizer = DetokenizationPipeline(tok, args.no_skip_special_tokens, args.detokenization_workers, outf)
         if args.test_ref is not None:
             refs = [[refline.strip() for refline in open(args.test_ref)]]
         for input_ids, input_masks, decoder_input_ids, decoder_masks, labels in generate_batches_pair(tok, args):
-            mod_compute = model(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu))
+            mod_compute = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device))
             logits = mod_compute.logits
             softmax = torch.nn.functional.log_softmax(logits, dim=-1)
             print(softmax.size())
             if args.decode_type == "teacher_forced_decoding": ## Use the softmax for prediction instead of computing NLL loss.
                 translations = torch.argmax(softmax, dim=-1)
-                tgt_masks = (labels != tok.pad_token_id).int().to(gpu)
+                tgt_masks = (labels != tok.pad_token_id).int().to(device)
                 translations = translations * tgt_masks
                 print(translations.size())
-                for input_id, translation in zip(input_ids, translations):
-                    translation  = tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) 
-                    input_id  = tok.decode(input_id, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) 
-                    outf.write(translation+"\n")
-                    outf.flush()
-                    hyp.append(translation)
+                detokenizer.submit(translations)
             else: ## Return the label smoothed loss.
-                logprobs = label_smoothed_nll_loss(softmax, labels.to(gpu), args.label_smoothing, ignore_index=tok.pad_token_id)
+                logprobs = label_smoothed_nll_loss(softmax, labels.to(device), args.label_smoothing, ignore_index=tok.pad_token_id)
                 for logprob in logprobs:
                     print(logprob)
                     outf.write(str(logprob)+"\n")
                     outf.flush()
         
+        if args.decode_type == "teacher_forced_decoding":
+            hyp = detokenizer.collect()
+            detokenizer.close()
         if args.decode_type == "teacher_forced_decoding" and args.test_ref is not None:
             print(len(refs[0]), len(hyp))
             sbleu = get_sacrebleu(refs, hyp)
             print("BLEU score is:", sbleu)
 
-    elif args.decode_type == "force_align": ## This is experimental. Source is A B C and target is X Y Z. If B and Z are aligned then the highest score should be for the source A MASK C and target X Y MASK. Works sometimes but not always. No detailed documentation yet.
-        print("Getting alignments. Will print alignments for each source subword to target subword.")
-        final_alignment_pos = ""
-        final_alignment_str = ""
-        final_src_str = ""
-        final_tgt_str = ""
-        for input_ids, input_masks, decoder_input_ids, tgt_masks, labels, src_sent_split, tgt_sent_split, enc_pos, dec_pos in generate_batches_pair_masked(tok, args):
-            if enc_pos == 0:
-                if final_alignment_pos != "":
-                    print(final_alignment_pos)
-                    print(final_alignment_str)
-                    outf.write(final_src_str + "\t" + final_tgt_str + "\t" + final_alignment_pos.strip() + "\t" + final_alignment_str + "\n")
-                    outf.flush()
-                final_alignment_pos = ""
-                final_alignment_str = ""
-            mod_compute = model(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu))
-            logits = mod_compute.logits
-            softmax = torch.nn.functional.log_softmax(logits, dim=-1)
-            logprobs = nll_loss(softmax, labels.to(gpu), ignore_index=tok.pad_token_id)
-            minprob = 1000
-            minpos = 0
-            for log_prob, dec_p in zip(logprobs, dec_pos):
-                if log_prob < minprob:
-                    minpos = dec_p
-                    minprob = log_prob
-            final_alignment_pos += str(enc_pos) + "-" + str(minpos) + " "
-            final_alignment_str += src_sent_split[enc_pos] + "-" + tgt_sent_split[minpos] + " "
-            final_src_str = " ".join(src_sent_split)
-            final_tgt_str = " ".join(tgt_sent_split)
-    elif args.decode_type == "get_enc_representations" or args.decode_type == "get_dec_representations": ## We want to extract the encoder or decoder representations for a given layer.
-        print("Getting encoder or decoder representations for layer", args.layer_id, ". Will save representations for each input line.")
-        for input_ids, input_masks, decoder_input_ids, decoder_masks, labels in generate_batches_pair(tok, args):
-            mod_compute = model(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu), output_hidden_states=True)
-            #print(input_masks)
-            if args.decode_type == "get_enc_representations":
-                pad_mask = input_ids.to(gpu).eq(tok.pad_token_id).unsqueeze(2)
-                hidden_state = mod_compute.encoder_hidden_states[args.layer_id]
+    elif args.decode_type == "force_align": ## Word alignment of sentence pairs, either by masking (source is A B C and target is X Y Z. If B and Z are aligned then the lowest loss should be for the source A MASK C and target X Y MASK.) or by cross attention. Works sometimes but not always. The corpus is split into chunks which are distributed across the processes and the alignments are written in the original order.
+        print("Getting alignments with the", args.alignment_method, "method. Will write the alignments of each sentence pair in the", args.alignment_output_format, "format.")
+        outf.close()
+        dist.barrier() ## Every process has truncated the output file by now so rank 0 can safely write to it.
+        writer = OrderedChunkWriter(args.test_tgt, rank)
+        alignment_start = time.time()
+        for chunk_idx, pairs in read_corpus_chunks([args.test_src, args.test_ref], args.alignment_chunk_size, rank, args.world_size):
+            chunk_start = time.time()
+            sentences = get_alignment_sentences(args, pairs)
+            if args.alignment_method == "masking":
+                alignments = align_pairs_by_masking(model.module, tok, args, sentences, device)
             else:
-                pad_mask = decoder_input_ids.to(gpu).eq(tok.pad_token_id).unsqueeze(2)
-                hidden_state = mod_compute.decoder_hidden_states[args.layer_id]
-            hidden_state.masked_fill_(pad_mask, 0.0)
-            print(hidden_state.size())
-            hidden_state = hidden_state.mean(dim=1)
-            for idx, hidden_state_individual in enumerate(hidden_state):
-                metadata=tok.decode(input_ids[idx] if args.decode_type == "get_enc_representations" else decoder_input_ids[idx], skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False)
-                outf.write("\t".join([str(elem) for elem in hidden_state_individual.tolist()])+"\n")
-                outf.flush()
-    elif args.decode_type == "get_attention": ## We want to extract and visualize the self attention and cross attentions for a particular layer and particular head. TODO make this work with all layers and all heads in a single plot. Currently my IQ is low so I am unable to achieve it.
-        sentence_id = 0
-        for input_ids, input_masks, decoder_input_ids, decoder_masks, labels in generate_batches_pair(tok, args): 
-            mod_compute = model(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu), output_attentions=True)
-            if args.layer_id != -1 and args.att_head_id != -1: ## We will be extracting attention info for specific layers and heads.
-                print("Getting attention for layer ", args.layer_id, " and head ", args.att_head_id)
-                encoder_attentions = mod_compute.encoder_attentions[args.layer_id]
-                decoder_attentions = mod_compute.decoder_attentions[args.layer_id]
-                cross_attentions = mod_compute.cross_attentions[args.layer_id]
-                for idx, (input_sent, tgt_sent) in enumerate(zip(input_ids, labels)):
-                    input_sent = tok.convert_ids_to_tokens(input_sent, skip_special_tokens=args.no_skip_special_tokens)
-                    input_len = len(input_sent)
-                    tgt_sent = tok.convert_ids_to_tokens(tgt_sent, skip_special_tokens=args.no_skip_special_tokens)
-                    tgt_len = len(tgt_sent)
-                    print("Processing for ", input_sent, tgt_sent)
-                    encoder_sizes = encoder_attentions[idx].size()
-                    decoder_sizes = decoder_attentions[idx].size()
-                    cross_sizes = cross_attentions[idx].size()
-                    print(encoder_sizes, decoder_sizes, cross_sizes)
-                    encoder_attention = encoder_attentions[args.att_head_id].view(-1, encoder_sizes[-1]).cpu().detach().numpy()
-                    encoder_attention = encoder_attention[0:input_len,0:input_len]
-                    decoder_attention = decoder_attentions[args.att_head_id].view(-1, decoder_sizes[-1]).cpu().detach().numpy()
-                    decoder_attention = decoder_attention[0:tgt_len,0:tgt_len]
-                    cross_attention = cross_attentions[args.att_head_id].view(-1, cross_sizes[-1]).cpu().detach().numpy()
-                    cross_attention = cross_attention[0:tgt_len,0:input_len]
-                    ## Enc Enc plot
-                    plot_attention(encoder_attention, input_sent, input_sent, 1, 1, args.test_tgt+".sentence-"+str(sentence_id)+".layer-"+str(args.layer_id)+".head-"+str(args.att_head_id)+".enc_enc.png", "Encoder Encoder Attention")
-                    ## Dec Dec plot
-                    plot_attention(decoder_attention, tgt_sent, tgt_sent, 1, 1, args.test_tgt+".sentence-"+str(sentence_id)+".layer-"+str(args.layer_id)+".head-"+str(args.att_head_id)+".dec_dec.png", "Decoder Decoder Attention")
-                    ## Enc Dec plot
-                    plot_attention(cross_attention, input_sent, tgt_sent, 1, 1, args.test_tgt+".sentence-"+str(sentence_id)+".layer-"+str(args.layer_id)+".head-"+str(args.att_head_id)+".enc_dec.png", "Encoder Decoder Attention")
-                    sentence_id += 1
-            elif args.layer_id == -1 and args.att_head_id == -1: ## We will be extracting attention info for all layers and heads.
-                encoder_attentions = mod_compute.encoder_attentions
-                decoder_attentions = mod_compute.decoder_attentions
-                cross_attentions = mod_compute.cross_attentions
-                for idx, (input_sent, tgt_sent) in enumerate(zip(input_ids, labels)):
-                    input_sent = tok.convert_ids_to_tokens(input_sent, skip_special_tokens=args.no_skip_special_tokens)
-                    input_len = len(input_sent)
-                    tgt_sent = tok.convert_ids_to_tokens(tgt_sent, skip_special_tokens=args.no_skip_special_tokens)
-                    tgt_len = len(tgt_sent)
-                    print("Processing for ", input_sent, tgt_sent)
-                    encenc_info = []
-                    decdec_info = []
-                    encdec_info = []
-                    input_sent_x = []
-                    input_sent_y = []
-                    tgt_sent_x = []
-                    tgt_sent_y = []
-                    for input_word in input_sent:
-                        input_sent_y.append(input_word+" L-"+str(0))
-                        for layer_id in range(1, model.module.config.encoder_layers):
-                            input_sent_y.append("L-"+str(layer_id))
-                    input_sent_x = input_sent*model.module.config.encoder_attention_heads
-                    for tgt_word in tgt_sent:
-                        tgt_sent_y.append(tgt_word+" L-"+str(0))
-                        for layer_id in range(1, model.module.config.encoder_layers):
-                            tgt_sent_y.append("L-"+str(layer_id))
-                    tgt_sent_x = tgt_sent*model.module.config.encoder_attention_heads
-
-                    for layer_id in range(model.module.config.encoder_layers):
-                        encenc_info.append(encoder_attentions[layer_id][idx].transpose(0,1).reshape(input_len,-1).unsqueeze(0))
-                        decdec_info.append(decoder_attentions[layer_id][idx].transpose(0,1).reshape(tgt_len,-1).unsqueeze(0))
-                        encdec_info.append(cross_attentions[layer_id][idx].transpose(0,1).reshape(tgt_len,-1).unsqueeze(0))
-                    encenc_info = torch.cat(encenc_info, 0).transpose(0,1).reshape(input_len*model.module.config.encoder_layers, -1)
-                    decdec_info = torch.cat(decdec_info, 0).transpose(0,1).reshape(tgt_len*model.module.config.encoder_layers, -1)
-                    encdec_info = torch.cat(encdec_info, 0).transpose(0,1).reshape(tgt_len*model.module.config.encoder_layers, -1)
-                    print(encenc_info.size(), decdec_info.size(), encdec_info.size())
-                    encenc_info = encenc_info.cpu().detach().numpy()
-                    decdec_info = decdec_info.cpu().detach().numpy()
-                    encdec_info = encdec_info.cpu().detach().numpy()
-                    ## Enc Enc plot
-                    plot_attention(encenc_info, input_sent_x, input_sent_y, model.module.config.encoder_layers, model.module.config.encoder_attention_heads, args.test_tgt+".sentence-"+str(sentence_id)+".enc_enc.png", "Encoder Encoder Attention")
-                    ## Dec Dec plot
-                    plot_attention(decdec_info, tgt_sent_x, tgt_sent_y, model.module.config.encoder_layers, model.module.config.encoder_attention_heads, args.test_tgt+".sentence-"+str(sentence_id)+".dec_dec.png", "Decoder Decoder Attention")
-                    ## Enc Dec plot
-                    plot_attention(encdec_info, input_sent_x, tgt_sent_y, model.module.config.encoder_layers, model.module.config.encoder_attention_heads, args.test_tgt+".sentence-"+str(sentence_id)+".enc_dec.png", "Encoder Decoder Attention")
-                    sentence_id += 1
+                alignments = align_pairs_by_attention(model.module, tok, args, sentences, device)
+            writer.write(chunk_idx, format_alignments(args, sentences, alignments))
+            print("Rank", rank, "aligned chunk", chunk_idx, "with", len(pairs), "pairs at", len(pairs)/(time.time() - chunk_start), "pairs per second.")
+        print("Rank", rank, "finished in", time.time() - alignment_start, "seconds.")
+        dist.barrier()
+        writer.close((count_lines(args.test_src) + args.alignment_chunk_size - 1) // args.alignment_chunk_size)
+    elif args.decode_type == "get_enc_representations" or args.decode_type == "get_dec_representations": ## We want to extract the encoder or decoder representations for a given layer.
+        if args.representation_output_format != "text": ## Binary output. The corpus is processed in chunks which are distributed across the processes and several layers and pooling methods are extracted in a single pass.
+            layers_and_poolings = [(layer_id, pooling) for layer_id in (args.representation_layers if args.representation_layers is not None else [args.layer_id]) for pooling in args.representation_pooling]
+            assert args.decode_type == "get_enc_representations" or args.test_ref is not None, "Decoder representations need the target sentences via --test_ref."
+            if rank == 0:
+                print("Getting representations named", ", ".join([get_representation_name(layer_id, pooling) for layer_id, pooling in layers_and_poolings]), "which will be saved with the prefix", args.test_tgt)
+            store = RepresentationStore(args, [get_representation_name(layer_id, pooling) for layer_id, pooling in layers_and_poolings], model.module.config.d_model, count_lines(args.test_src), rank)
+            extraction_start = time.time()
+            for chunk_idx, lines in read_corpus_chunks([args.test_src] if args.test_ref is None else [args.test_src, args.test_ref], args.representation_chunk_size, rank, args.world_size):
+                chunk_start = time.time()
+                store.write(chunk_idx, extract_representations_chunk(model.module, tok, args, lines, layers_and_poolings, device))
+                print("Rank", rank, "processed chunk", chunk_idx, "with", len(lines), "sentences at", len(lines)/(time.time() - chunk_start), "sentences per second.")
+            store.close()
+            print("Rank", rank, "finished in", time.time() - extraction_start, "seconds.")
+            dist.barrier()
+        else:
+            print("Getting encoder or decoder representations for layer", args.layer_id, ". Will save representations for each input line.")
+            for input_ids, input_masks, decoder_input_ids, decoder_masks, labels in generate_batches_pair(tok, args):
+                mod_compute = model(input_ids=input_ids.to(device), attention_mask=input_masks.to(device), decoder_input_ids=decoder_input_ids.to(device), output_hidden_states=True)
+                #print(input_masks)
+                if args.decode_type == "get_enc_representations":
+                    pad_mask = input_ids.to(device).eq(tok.pad_token_id).unsqueeze(2)
+                    hidden_state = mod_compute.encoder_hidden_states[args.layer_id]
+                else:
+                    pad_mask = decoder_input_ids.to(device).eq(tok.pad_token_id).unsqueeze(2)
+                    hidden_state = mod_compute.decoder_hidden_states[args.layer_id]
+                hidden_state.masked_fill_(pad_mask, 0.0)
+                print(hidden_state.size())
+                hidden_state = hidden_state.mean(dim=1)
+                for idx, hidden_state_individual in enumerate(hidden_state):
+                    metadata=tok.decode(input_ids[idx] if args.decode_type == "get_enc_representations" else decoder_input_ids[idx], skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False)
+                    outf.write("\t".join([str(elem) for elem in hidden_state_individual.tolist()])+"\n")
+                    outf.flush()
+    elif args.decode_type == "get_attention": ## We want to extract the self attentions and cross attentions of the layers and heads given by layer_id and att_head_id (-1 means all) and optionally visualize them. The attentions are saved as compressed shards and plotting is done afterwards by a pool of processes. You can also plot later with render_attention_plots.py.
+        layers = list(range(min(model.module.config.encoder_layers, model.module.config.decoder_layers))) if args.layer_id == -1 else [args.layer_id]
+        heads = list(range(min(model.module.config.encoder_attention_heads, model.module.config.decoder_attention_heads))) if args.att_head_id == -1 else [args.att_head_id]
+        print("Getting attention for layers", layers, "and heads", heads)
+        store = AttentionStore(args, layers, heads, count_lines(args.test_src), rank)
+        extraction_start = time.time()
+        for chunk_idx, pairs in read_corpus_chunks([args.test_src, args.test_ref], args.attention_shard_size, rank, args.world_size):
+            chunk_start = time.time()
+            extract_attentions_chunk(model.module, tok, args, chunk_idx, pairs, layers, heads, store, device)
+            print("Rank", rank, "saved the attentions of chunk", chunk_idx, "with", len(pairs), "sentence pairs at", len(pairs)/(time.time() - chunk_start), "pairs per second.")
+        print("Rank", rank, "finished in", time.time() - extraction_start, "seconds.")
+        dist.barrier()
+        if args.plot_attention and rank == 0:
+            render_attention_plots(args.test_tgt, args.attention_plot_workers)
                 
     outf.close()
     
@@ -358,7 +410,7 @@ def run_demo():
     parser.add_argument('--label_smoothing', default=0.1, type=float, help="The value for label smoothing")
     parser.add_argument('--dropout', default=0.1, type=float, help="The value for embedding dropout")
     parser.add_argument('--layer_id', default=6, type=int, help="The id of the layer from 0 to num_layers. Note that the implementation returns the embedding layer output at index 0 so the output of layer 1 is actually at index 1.")
-    parser.add_argument('--att_head_id', default=0, type=int, help="The id of the attention head from 0 to encoder_attention_heads-1 or decoder_attention_heads-1")
+    parser.add_argument('--att_head_id', default=0, type=int, help="The id of the attention head from 0 to encoder_attention_heads-1 or decoder_attention_heads-1. When getting attentions, -1 means all heads and a layer_id of -1 means all layers.")
     parser.add_argument('--attention_dropout', default=0.1, type=float, help="The value for attention dropout")
     parser.add_argument('--activation_dropout', default=0.1, type=float, help="The value for activation dropout")
     parser.add_argument('--encoder_attention_heads', default=8, type=int, help="The value for number of encoder attention heads")
@@ -405,7 +457,7 @@ def run_demo():
     parser.add_argument('--slang', default='en', type=str, 
                         help='Source language')
     parser.add_argument('--decode_type', default='decode', type=str, 
-                        help='One of decode, score, force_align, get_enc_representation, get_dec_representation, teacher_forced_decoding or get_attention. When getting representations or attentions you must specify the index of the layer which you are interested in. By default the last layer is considered.')
+                        help='One of decode, score, bulk_score, force_align, get_enc_representation, get_dec_representation, teacher_forced_decoding or get_attention. When getting representations or attentions you must specify the index of the layer which you are interested in. By default the last layer is considered.')
     parser.add_argument('--tokenizer_name_or_path', default='ai4bharat/indic-bert', type=str, 
                         help='Name of or path to the tokenizer')
     parser.add_argument('--pretrained_tokenizer_name_or_path', default=None, type=str, 
@@ -440,7 +492,89 @@ def run_demo():
                         help='Lets wipe out the decoder params from the pretrained model before we use it to initialize the current model. This means we have random decoder initialization.')
     parser.add_argument('--eliminate_embeddings_before_initialization', action='store_true', 
                         help='Lets wipe out the embedding params from the pretrained model before we use it to initialize the current model. This means we have random embedding initialization.')
+    parser.add_argument('--cpu', action='store_true', 
+                        help='Should we decode on the CPU? In this case the gloo backend is used and -g indicates the number of CPU processes instead of the number of GPUs.')
+    parser.add_argument('--num_cpu_threads', default=0, type=int, 
+                        help='The number of threads each CPU process should use. 0 means we leave it to pytorch.')
+    parser.add_argument('--quantize_dynamic_int8', action='store_true', 
+                        help='Should we apply dynamic int8 quantization to the linear layers (attention projections, feed forward layers and the lm_head) after loading the model? Only works with --cpu. This makes decoding faster and the model smaller at the cost of a small drop in quality.')
+    parser.add_argument('--quantized_model_cache', default=None, type=str, 
+                        help='Path where the quantized model will be saved. If the file exists then it will be loaded directly and the fp32 checkpoint will not be loaded. Remember to delete this file if the fp32 checkpoint changes.')
+    parser.add_argument('--quantization_compare_with_fp32', action='store_true', 
+                        help='Should we decode each batch with the fp32 model as well? This will report the speedup and the BLEU delta due to quantization. The translations written to the output file are the ones obtained using the quantized model. Only used when decode_type is decode.')
+    parser.add_argument('--shortlist_path', default=None, type=str, 
+                        help='Path to a lexical shortlist created by create_shortlist.py. If specified then, for each batch, the output projection will be restricted to the union of the shortlists of the source tokens, the most frequent target tokens and the special tokens. This speeds up decoding with large vocabularies. Only used when decode_type is decode.')
+    parser.add_argument('--shortlist_top_k_per_source', default=50, type=int, 
+                        help='The number of shortlisted target tokens to use for each source token. Cannot be larger than the value used when creating the shortlist.')
+    parser.add_argument('--shortlist_top_frequent', default=500, type=int, 
+                        help='The number of most frequent target tokens to always add to the shortlist. Cannot be larger than the value used when creating the shortlist.')
+    parser.add_argument('--shortlist_compare_with_full_vocab', action='store_true', 
+                        help='Should we decode each batch with the full vocabulary as well? This is slow but will report the speedup and the BLEU delta due to the shortlist. The translations written to the output file are the ones obtained using the shortlist.')
     
+    parser.add_argument('--fast_checkpoint_loading', action='store_true', 
+                        help='Should we load the checkpoint faster and with less memory? The checkpoint is loaded once on the CPU by the launching process and shared with all the local processes via shared memory instead of being loaded onto every GPU by every process. Furthermore, the random initialization of the model is skipped whenever the checkpoint overwrites all the parameters (no layer remapping, component elimination or embedding remapping).')
+    parser.add_argument('--profile_steps', default=0, type=int, 
+                        help='The number of batches to profile with the pytorch profiler when decoding. 0 means no profiling. The CPU and, if we decode on GPUs, the CUDA activity of these batches is saved as a chrome trace (open it in chrome://tracing or https://ui.perfetto.dev), as a tensorboard trace if the pytorch version supports it and as a table of the most expensive operators. The time spent in data generation, generation and detokenization shows up as labelled spans in the trace. Works with --cpu. Only used when decode_type is decode.')
+    parser.add_argument('--profile_start_step', default=2, type=int, 
+                        help='The batch at which profiling starts. The first batches are slow due to memory allocation so it makes sense to skip them.')
+    parser.add_argument('--profile_dir', default=None, type=str, 
+                        help='The directory where the traces will be saved. Defaults to test_tgt with the suffix .profile. Point tensorboard to this directory to see the traces.')
+    parser.add_argument('--profile_rank', default=0, type=int, 
+                        help='The rank of the process to profile. Only one process is profiled.')
+    parser.add_argument('--profile_memory', action='store_true', 
+                        help='Should the profiler record the memory allocated and freed by each operator?')
+    parser.add_argument('--profile_with_stack', action='store_true', 
+                        help='Should the profiler record the python stack of each operator? This makes the traces much larger but tells you which line of code launched what.')
+    parser.add_argument('--profile_record_shapes', action='store_true', 
+                        help='Should the profiler record the shapes of the inputs of each operator? The operator table will then be grouped by input shapes.')
+    parser.add_argument('--score_batch_tokens', default=8192, type=int, 
+                        help='The maximum number of tokens (padding included) in a batch when decode_type is bulk_score. The pairs are sorted by length before batching so there is very little padding. Increase this as much as the memory allows.')
+    parser.add_argument('--score_chunk_size', default=100000, type=int, 
+                        help='The number of pairs which are read, sorted and scored together when decode_type is bulk_score. Chunks are distributed across processes and the scores of a chunk are written to the output as soon as all the preceding chunks are done. Larger chunks give better batches but need more memory.')
+    parser.add_argument('--score_precision', default='fp32', type=str, choices=['fp32', 'fp16', 'bf16'], 
+                        help='The precision of the model when decode_type is bulk_score. fp16 and bf16 need a GPU. The log-softmax is always computed in fp32.')
+    parser.add_argument('--score_length_normalization_alpha', default=1.0, type=float, 
+                        help='The log probability of a target is divided by its length raised to this value to get the normalized score when decode_type is bulk_score. 1.0 gives the average log probability per token and 0.0 gives the plain log probability.')
+    parser.add_argument('--score_both_directions', action='store_true', 
+                        help='Should we also score the source given the target when decode_type is bulk_score? The model must be able to translate from tlang to slang. The output will then also contain the backward scores and the dual conditional cross-entropy, which is a good filtering criterion.')
+    parser.add_argument('--score_output_format', default='tsv', type=str, choices=['tsv', 'binary'], 
+                        help='The format of the output when decode_type is bulk_score. tsv gives one line of tab separated scores per pair. binary gives a flat array of little endian float32 values with one row per pair which can be loaded with numpy.fromfile(path, dtype="<f4").reshape(-1, num_columns). The columns are printed at the start of scoring.')
+    parser.add_argument('--representation_output_format', default='text', type=str, choices=['text', 'npy', 'sharded'], 
+                        help='How the representations are saved when decode_type is get_enc_representations or get_dec_representations. text writes the mean pooled representation of --layer_id as a line of tab separated values per sentence. npy writes one memory mapped .npy file per layer and pooling method named test_tgt.layer-L.POOLING.npy. sharded writes one .npy file per chunk of --representation_chunk_size sentences along with test_tgt.index.json. npy and sharded use length sorted batching, distribute the chunks across processes and do not need --test_ref for encoder representations.')
+    parser.add_argument('--representation_layers', nargs='+', type=int, default=None, 
+                        help='The indices of the layers whose representations we want when the output format is npy or sharded. 0 is the embedding layer and -1 is the last layer. Defaults to --layer_id.')
+    parser.add_argument('--representation_pooling', nargs='+', type=str, default=['mean'], choices=['mean', 'max', 'first', 'last'], 
+                        help='How the token representations are pooled into a sentence representation when the output format is npy or sharded. Padding is ignored. You can give several. For the encoder, last is the language token. For the decoder, first is the language token.')
+    parser.add_argument('--representation_dtype', default='float16', type=str, choices=['float16', 'float32'], 
+                        help='The data type of the saved representations when the output format is npy or sharded.')
+    parser.add_argument('--representation_batch_tokens', default=8192, type=int, 
+                        help='The maximum number of tokens (padding included) in a batch when the output format is npy or sharded.')
+    parser.add_argument('--representation_chunk_size', default=100000, type=int, 
+                        help='The number of sentences which are read, sorted and processed together when the output format is npy or sharded. This is also the number of sentences in a shard.')
+    parser.add_argument('--alignment_method', default='masking', type=str, choices=['masking', 'attention'], 
+                        help='How words are aligned when decode_type is force_align. masking masks every source word and every target word and aligns each source word to the target word whose masking gives the lowest loss. It needs one (batched) forward pass per source and target word combination. attention aligns each target word to the source word it attends to the most using the cross attention of a single forward pass per sentence pair. It is much faster.')
+    parser.add_argument('--alignment_layers', nargs='+', type=int, default=None, 
+                        help='The indices (0 is the first decoder layer) of the layers whose cross attention is averaged when the alignment method is attention. All the layers are averaged by default. The heads are always averaged. The penultimate layer often gives the best alignments.')
+    parser.add_argument('--alignment_batch_tokens', default=8192, type=int, 
+                        help='The maximum number of tokens (padding included) in a batch when decode_type is force_align. All the masked variants of the sentence pairs of a chunk are sorted by length and batched together.')
+    parser.add_argument('--alignment_chunk_size', default=1000, type=int, 
+                        help='The number of sentence pairs which are read and aligned together when decode_type is force_align. Chunks are distributed across processes.')
+    parser.add_argument('--alignment_max_masking_length', default=100, type=int, 
+                        help='Sentence pairs where the source or target has this many words or more are not aligned when the alignment method is masking because the number of forward passes grows with the product of the lengths. They get empty lines in the output.')
+    parser.add_argument('--alignment_output_format', default='pharaoh', type=str, choices=['pharaoh', 'verbose'], 
+                        help='The format of the alignments when decode_type is force_align. pharaoh gives lines of 0 indexed source-target word positions like 0-0 1-2 2-1. verbose gives the source, the target, the pharaoh alignment and the aligned words separated by tabs.')
+    parser.add_argument('--detokenization_workers', default=0, type=int, 
+                        help='The number of processes that detokenize the translations when decode_type is decode or teacher_forced_decoding. Detokenization and writing happen in the background while the next batch is being decoded and the translations are written in order. 0 means a background thread does it which is enough unless the batches are very large.')
+    parser.add_argument('--attention_shard_size', default=100, type=int, 
+                        help='The number of sentence pairs per shard when decode_type is get_attention. Shards are distributed across processes. The attentions of a shard are written as soon as their batch is done so this does not affect memory usage much.')
+    parser.add_argument('--attention_batch_tokens', default=4096, type=int, 
+                        help='The maximum number of tokens (padding included) in a batch when decode_type is get_attention. The attentions of all layers are kept in memory so this should be smaller than for decoding.')
+    parser.add_argument('--attention_dtype', default='float16', type=str, choices=['float16', 'float32'], 
+                        help='The data type of the saved attentions when decode_type is get_attention.')
+    parser.add_argument('--plot_attention', action='store_true', 
+                        help='Should we plot the attentions after extracting them when decode_type is get_attention? The plots are saved as test_tgt.sentence-N[.layer-L.head-H].TYPE.png. Plotting is slow so for large numbers of sentences use render_attention_plots.py on the sentences you care about instead.')
+    parser.add_argument('--attention_plot_workers', default=0, type=int, 
+                        help='The number of processes that render the attention plots. 0 means they are rendered by the decoding process.')
     args = parser.parse_args()
     assert len(args.token_masking_probs_range) <= 2
     print("IP address is", args.ipaddr)
@@ -448,7 +582,10 @@ def run_demo():
     args.world_size = args.gpus * args.nodes                #
     os.environ['MASTER_ADDR'] = args.ipaddr              #
     os.environ['MASTER_PORT'] = args.port                      #
-    mp.spawn(model_create_load_decode, nprocs=args.gpus, args=(args,))         #
+    shared_checkpoint_dicts = None
+    if args.fast_checkpoint_loading and not (args.use_official_pretrained and args.locally_fine_tuned_model_path is None) and not (args.quantize_dynamic_int8 and args.quantized_model_cache is not None and os.path.exists(args.quantized_model_cache) and not args.quantization_compare_with_fp32): ## Load the checkpoint once per node and share it with all the local processes. Not needed if we will load the cached quantized model.
+        shared_checkpoint_dicts = load_checkpoints_in_shared_memory([args.locally_fine_tuned_model_path if args.use_official_pretrained else args.model_path])
+    mp.spawn(model_create_load_decode, nprocs=args.gpus, args=(args,shared_checkpoint_dicts,))         #
     #########################################################
     
 if __name__ == "__main__":
@@ -0,0 +1,48 @@
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+#!/bin/bash
+# cd /path/to/this/toolkit
+# source <your python virtual environment>/bin/activate
+# export PYTHONPATH=$PYTHONPATH:/path/to/this/toolkit/transformers
+
+# usage: bash examples/convert_checkpoint.sh
+# Uncomment lines as applicable
+
+## Notes:
+# General: Look at the arguments in the script "convert_checkpoint.py" for a better understanding.
+# 1. Flat checkpoints can be passed wherever a checkpoint is expected, for example --model_path and --pretrained_model in decode_nmt.py and train_nmt.py.
+# 2. Use --model_only for checkpoints meant for decoding or serving since the optimizer state is twice the size of the model.
+# 3. Use --benchmark to compare the loading times of the regular and flat checkpoints.
+
+## Convert a model to a flat checkpoint with fp16 parameters and compare the loading times
+
+python convert_checkpoint.py --input examples/models/nmt_model --output examples/models/nmt_model.flat --model_only --storage_dtype fp16 --benchmark
+
+## Decode with the flat checkpoint
+
+python decode_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model.flat --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en
+
+## Convert it back to a regular checkpoint
+
+# python convert_checkpoint.py --input examples/models/nmt_model.flat --output examples/models/nmt_model.from_flat --to torch
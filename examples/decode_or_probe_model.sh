@@ -38,12 +38,22 @@ dec_mod=examples/models/nmt_model ## Replace this with the path to your NMT mode
 python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en
 
 
+## Beam search decode with large batches where detokenization and writing are done by 4 separate processes while the next batch is being decoded.
+
+# python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en --beam_size 4 --batch_size 256 --detokenization_workers 4
+
 ## Score source and translation using a trained NMT model on a single GPU for a translation direction.
 
 # dec_mod=examples/models/nmt_model ## Replace this with the path to your NMT model
 
 # python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en.score --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en --decode_type score
 
+## Score a large parallel corpus for filtering using length sorted token budget batches. Every GPU gets its own chunks of the corpus and the scores are written in the original order. Use --score_both_directions with a model which translates in both directions to get the dual conditional cross-entropy. Use --cpu with -g N to score with N CPU processes.
+
+# dec_mod=examples/models/nmt_model ## Replace this with the path to your NMT model
+
+# python decode_nmt.py -n 1  -nr 0 -g 2 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en.bulk_score --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en --decode_type bulk_score --score_batch_tokens 16384 --score_precision fp16 --score_output_format tsv
+
 ## Perform forced decoding of a source sentence and its translation using a trained NMT model on a single GPU for a translation direction.
 
 # dec_mod=examples/models/nmt_model ## Replace this with the path to your NMT model
@@ -58,10 +68,42 @@ python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang e
 
 # python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en.encoder_representations --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en --decode_type get_dec_representations --layer_id 1
 
+## Get encoder representations of several layers with mean and max pooling in a single pass and save them as memory mapped float16 .npy files (one per layer and pooling method, loadable with numpy.load(path, mmap_mode='r')). Use --representation_output_format sharded for very large corpora. --test_ref is not needed for encoder representations.
+
+# python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.hi.encoder_representations --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --decode_type get_enc_representations --representation_output_format npy --representation_layers 0 1 --representation_pooling mean max --representation_dtype float16
 
-## Get attention heatmaps from a trained NMT model on a single GPU for a translation direction. "layer_id" goes from 0 (1'st layer) to N-1 (N'th layer). "att_head_id" indicates the H'th attention head and goes from 0 (1'st head) to H-1 (H'th head). 
+
+## Word align sentence pairs using a trained NMT model and write the alignments in the pharaoh format (0-0 1-2 ...). The attention method needs one forward pass per sentence pair. Use --alignment_method masking for alignment by masking, which is slower but all the masked variants are batched together.
+
+# dec_mod=examples/models/nmt_model ## Replace this with the path to your NMT model
+
+# python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/alignments.hi-en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en --decode_type force_align --alignment_method attention --alignment_batch_tokens 16384
+
+## Get attention heatmaps from a trained NMT model on a single GPU for a translation direction. "layer_id" goes from 0 (1'st layer) to N-1 (N'th layer). "att_head_id" indicates the H'th attention head and goes from 0 (1'st head) to H-1 (H'th head). Use -1 for both to get all layers and heads. The attentions are saved as compressed shards (translation.en.encoder_representations.attention.*) and --plot_attention plots them with 4 processes. 
 
 # dec_mod=examples/models/nmt_model ## Replace this with the path to your NMT model
 
-# python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en.encoder_representations --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en --decode_type get_attention --layer_id 0 --att_head_id 0
+# python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en.encoder_representations --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en --decode_type get_attention --layer_id 0 --att_head_id 0 --plot_attention --attention_plot_workers 4
+
+## Plot only the cross attention of the first 10 sentence pairs from the attentions saved above using 4 processes.
+
+# python render_attention_plots.py --attention_prefix examples/translations/translation.en.encoder_representations --sentence_ids 0 1 2 3 4 5 6 7 8 9 --attention_types enc_dec --num_workers 4
+
+
+## Create a lexical shortlist from the training data and use it to restrict the output vocabulary while decoding. "shortlist_compare_with_full_vocab" additionally decodes with the full vocabulary and reports the speedup and the BLEU delta.
+
+# python create_shortlist.py --train_src examples/data/train.hi --train_tgt examples/data/train.en --output examples/models/shortlist.hi-en --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --top_k_per_source 100 --top_frequent 1000
+
+# dec_mod=examples/models/nmt_model ## Replace this with the path to your NMT model
+
+# python decode_nmt.py -n 1  -nr 0 -g 1 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en --shortlist_path examples/models/shortlist.hi-en --shortlist_top_k_per_source 50 --shortlist_top_frequent 500 --shortlist_compare_with_full_vocab
+
+## Decode on the CPU with a dynamic int8 quantized model. The quantized model is cached so that subsequent runs do not need to quantize again. "quantization_compare_with_fp32" additionally decodes with the fp32 model and reports the speedup and the BLEU delta. The model sizes and peak memory usage are always printed.
+
+# dec_mod=examples/models/nmt_model ## Replace this with the path to your NMT model
+
+# python decode_nmt.py -n 1  -nr 0 -g 1 --cpu --num_cpu_threads 4 --quantize_dynamic_int8 --quantized_model_cache $dec_mod.int8 --quantization_compare_with_fp32 --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --test_ref examples/data/test.en
+
+## Profile batches 2 to 4 while decoding on the CPU. The chrome trace, the tensorboard trace and a table of the most expensive operators are saved in examples/translations/translation.en.profile and the average time spent in data generation, generation and detokenization is printed at the end.
 
+# python decode_nmt.py -n 1  -nr 0 -g 1 --cpu --profile_steps 3 --profile_start_step 2 --profile_memory --model_path $dec_mod --slang hi --tlang en --test_src examples/data/test.hi --test_tgt examples/translations/translation.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k
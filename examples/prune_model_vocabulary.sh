@@ -0,0 +1,39 @@
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#!/bin/bash
+# cd /path/to/this/toolkit
+# source <your python virtual environment>/bin/activate
+# export PYTHONPATH=$PYTHONPATH:/path/to/this/toolkit/transformers
+
+# usage: bash examples/prune_model_vocabulary.sh
+# Uncomment lines as applicable
+
+## Notes:
+# General: Look at the arguments in the script "prune_vocabulary.py" for a better understanding.
+# 1. Use the corpora of all the languages you want to keep. Subwords not seen in them will be removed.
+# 2. Use --keep_all_characters to avoid unknown tokens on unseen text.
+# 3. Afterwards, pass the pruned tokenizer to --tokenizer_name_or_path when fine-tuning or decoding the pruned model.
+
+## Prune the vocabulary of a model to only Hindi and English
+
+# python prune_vocabulary.py --corpora examples/data/train.hi examples/data/train.en --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --model_path examples/models/nmt_model --output_tokenizer examples/tokenizers/albert-vienhi16k-pruned-hien --output_model_path examples/models/nmt_model.pruned-hien --keep_all_characters
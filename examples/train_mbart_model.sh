@@ -54,6 +54,13 @@ python pretrain_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/mbart_model
 # python pretrain_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/mbart_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --langs hi,en,vi --mono_src examples/data/train.hi,examples/data/train.en,examples/data/train.vi --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --pretrained_model examples/models/mbart_model --no_reload_optimizer_ctr_and_scheduler
 
 
+## Train a very small MBART model on a single GPU where several short masked examples are packed into each row of a batch so that less compute is wasted on padding. The batch size is then the number of actual tokens in a batch.
+
+# export CUDA_VISIBLE_DEVICES=0 # Change to the GPU ID corresponding to a GPU that is free.
+
+# python pretrain_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/mbart_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --langs hi,en,vi --mono_src examples/data/train.hi,examples/data/train.en,examples/data/train.vi --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --pack_sequences --packed_sequence_length 256
+
+
 ## Train a very small MBART model on multiple GPUs. Use --pretrained_model and --no_reload_optimizer_ctr_and_scheduler (as applicable) if you have a previously trained mbart model.
 
 # export CUDA_VISIBLE_DEVICES=0,1,2,3,4,5,6,7 # Change to the GPU IDs corresponding to GPUs that are free.
@@ -74,4 +81,18 @@ python pretrain_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/mbart_model
 
 # On the second machine aka the follower node:
 
-# python pretrain_nmt.py -n 2  -nr 1 -g 8 -a $ipaddr --model_path examples/models/mbart_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --langs hi,en,vi --mono_src examples/data/train.hi,examples/data/train.en,examples/data/train.vi --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files
\ No newline at end of file
+# python pretrain_nmt.py -n 2  -nr 1 -g 8 -a $ipaddr --model_path examples/models/mbart_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --langs hi,en,vi --mono_src examples/data/train.hi,examples/data/train.en,examples/data/train.vi --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files
+
+## Train a very small MBART model on multiple GPUs scattered across multiple machines on a slow network. The gradients are compressed with PowerSGD before they are all-reduced and larger gradient buckets are used. Use benchmark_ddp_comm_hooks.py to see how many bytes each option saves.
+
+# On the first machine aka the head node:
+
+# python pretrain_nmt.py -n 2  -nr 0 -g 8 -a $ipaddr --model_path examples/models/mbart_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --langs hi,en,vi --mono_src examples/data/train.hi,examples/data/train.en,examples/data/train.vi --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --ddp_comm_hook powersgd --powersgd_rank 2 --ddp_bucket_cap_mb 100
+
+# On the second machine aka the follower node:
+
+# python pretrain_nmt.py -n 2  -nr 1 -g 8 -a $ipaddr --model_path examples/models/mbart_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --langs hi,en,vi --mono_src examples/data/train.hi,examples/data/train.en,examples/data/train.vi --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --ddp_comm_hook powersgd --powersgd_rank 2 --ddp_bucket_cap_mb 100
+
+## Measure how many bytes are sent per step with each gradient compression option using 2 processes on the CPU.
+
+# python benchmark_ddp_comm_hooks.py --processes 2 --vocab_size 64000 --d_model 512 --ffn_dim 2048 --layers 2
@@ -82,4 +82,57 @@ python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model --to
 
 # On the second machine aka the follower node:
 
-# python train_nmt.py -n 2  -nr 1 -g 8 -a $ipaddr ---model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files
\ No newline at end of file
+# python train_nmt.py -n 2  -nr 1 -g 8 -a $ipaddr ---model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files
+## Train a very small NMT model on a single GPU for a translation direction with the memory efficient chunked cross entropy loss. This matters for large vocabularies where the logits are the biggest activations.
+
+# export CUDA_VISIBLE_DEVICES=0 # Change to the GPU ID corresponding to a GPU that is free.
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --chunked_cross_entropy --cross_entropy_chunk_size 1024
+
+## Distill a very small NMT model from a bigger one offline. First the outputs of the parent are cached with --dump_teacher_outputs and then the child is trained from the cache without loading the parent. Use the same data and number of GPUs in both phases.
+
+# export CUDA_VISIBLE_DEVICES=0 # Change to the GPU ID corresponding to a GPU that is free.
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model.distilled --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --distillation --parent_pretrained_model examples/models/nmt_model --parent_encoder_layers 1 --parent_decoder_layers 1 --parent_encoder_attention_heads=1 --parent_decoder_attention_heads=1 --parent_encoder_ffn_dim=128 --parent_decoder_ffn_dim=128 --parent_d_model=64 --teacher_cache_path examples/models/nmt_model.teacher_cache --dump_teacher_outputs
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model.distilled --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --distillation --teacher_cache_path examples/models/nmt_model.teacher_cache
+
+## Train a very small nmt model on multiple GPUs where each optimizer step sees at least 32,000 target tokens over all GPUs no matter how long the sentences in the batches are. Gradients are only all-reduced for the last batch of each optimizer step.
+
+# export CUDA_VISIBLE_DEVICES=0,1,2,3,4,5,6,7 # Change to the GPU IDs corresponding to GPUs that are free.
+
+# python train_nmt.py -n 1  -nr 0 -g 8 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --accumulation_target_tokens 32000
+
+## Train a very small nmt model on multiple GPUs where each GPU only keeps the AdamW state for its share of the parameters. The saved checkpoints contain the full optimizer state so training can be resumed with or without --shard_optimizer_state.
+
+# export CUDA_VISIBLE_DEVICES=0,1,2,3,4,5,6,7 # Change to the GPU IDs corresponding to GPUs that are free.
+
+# python train_nmt.py -n 1  -nr 0 -g 8 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --shard_optimizer_state
+
+## Train a very small NMT model on a single GPU where the activations of every second encoder and decoder layer are recomputed during the backward pass so that bigger batches fit in memory. First find the fastest setting that fits in 10GB.
+
+# python benchmark_activation_checkpointing.py --encoder_layers 6 --decoder_layers 6 --batch_size 32 --sequence_length 128 --memory_budget_mb 10000
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --activation_checkpointing --activation_checkpointing_every_k 2
+
+## Train a very small NMT model on a single GPU and log the losses, tokens per second, padding ratio and the time spent in data loading, forward, backward and optimizer every 50 batches. The logging happens in a background thread so it never stalls the GPU.
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --log_every 50
+
+## Train a very small NMT model on a single GPU and profile optimizer steps 10 to 14. Look at the traces with "tensorboard --logdir examples/models/nmt_model.profile" or open the chrome trace in chrome://tracing.
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --profile_steps 5 --profile_start_step 10 --profile_memory
+
+## Train a very small NMT model on a single GPU with a batch size that adapts to the GPU memory. The largest batch size that fits is found at the start, batches that still do not fit are split into micro batches and the batch size is raised again when there is enough free memory.
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --adaptive_batch_size --batch_size 1024 --adaptive_batch_size_max 16384
+
+## Train a very small NMT model on the first GPU while a separate process evaluates snapshots of the model on the second GPU. Training never stops for evaluation and waits only if more than 2 evaluations are pending.
+
+# export CUDA_VISIBLE_DEVICES=0,1
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --async_evaluation --async_evaluation_device cuda:1 --async_evaluation_max_lag 2
+
+## Train a very small NMT model and use chrF for evaluation and early stopping. The dev set is tokenized and batched once at the start and the scores are computed by 2 separate processes. The translations are detokenized by 2 more processes while the next dev batch is being decoded.
+
+# python train_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/nmt_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --train_slang hi --train_tlang en --dev_slang hi --dev_tlang en --train_src examples/data/train.hi --train_tgt examples/data/train.en --dev_src examples/data/dev.hi --dev_tgt examples/data/dev.en --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --shard_files --use_chrf --eval_scoring_workers 2 --detokenization_workers 2
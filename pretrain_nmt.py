@@ -66,7 +66,7 @@ torch.manual_seed(621313)
 ##
 
 
-def model_create_load_run_save(gpu, args, files, train_files):
+def model_create_load_run_save(gpu, args, files, train_files, shared_checkpoint_dicts=None):
     """The main function which does the overall training. Should be split into multiple parts in the future. Currently monolithc intentionally."""
     rank = args.nr * args.gpus + gpu ## The rank of the current process out of the total number of processes indicated by world_size.
     dist.init_process_group(backend='nccl', init_method='env://', world_size=args.world_size, rank=rank)
@@ -127,7 +127,8 @@ def model_create_load_run_save(gpu, args, files, train_files):
             model = BartForConditionalGeneration.from_pretrained(args.pretrained_model, config=config, force_bos_token_to_be_generated=True) ## We may use FBs official model and fine-tune it for our purposes.
     else:
         config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, unidirectional_encoder=args.unidirectional_encoder, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, encoder_layerdrop=args.layerdrop, decoder_layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, num_domains_for_domain_classifier=args.num_domains_for_domain_classifier, gradient_reversal_for_domain_classifier=args.gradient_reversal_for_domain_classifier) ## Configuration. TODO: Save this configuration somehow.
-        model = MBartForConditionalGeneration(config)
+        with skip_weight_initialization(args.fast_checkpoint_loading and args.pretrained_model != "" and checkpoint_overwrites_all_parameters(args)): ## The checkpoint will overwrite the random initialization anyway.
+            model = MBartForConditionalGeneration(config)
     torch.cuda.set_device(gpu)
 
     model.cuda(gpu)
@@ -154,22 +155,37 @@ def model_create_load_run_save(gpu, args, files, train_files):
                 parent_model = BartForConditionalGeneration.from_pretrained(args.parent_pretrained_model, config=parent_config, force_bos_token_to_be_generated=True) ## We may use FBs official model and fine-tune it for our purposes.
         else:
             parent_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.parent_encoder_layers, decoder_layers=args.parent_decoder_layers, dropout=args.parent_dropout, attention_dropout=args.parent_attention_dropout, activation_dropout=args.parent_activation_dropout, encoder_attention_heads=args.parent_encoder_attention_heads, decoder_attention_heads=args.parent_decoder_attention_heads, encoder_ffn_dim=args.parent_encoder_ffn_dim, decoder_ffn_dim=args.parent_decoder_ffn_dim, d_model=args.parent_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, unidirectional_encoder=args.unidirectional_encoder, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, encoder_layerdrop=args.layerdrop, decoder_layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings)
-            parent_model = MBartForConditionalGeneration(config)
-        parent_model.cuda(gpu)
-        parent_model.train() ## We do this to enable dropout but we wont have an optimizer for this so we wont train this model. For now. Future implementations should ask if we want to do co-distill or not. By co-distillation I mean, the parent will learn together with the child.
-        parent_model = DistributedDataParallel(parent_model, device_ids=[gpu], output_device=gpu)
+            with skip_weight_initialization(args.fast_checkpoint_loading): ## The parent is always loaded without remapping.
+                parent_model = MBartForConditionalGeneration(parent_config)
         print("Loading a parent model from which distillation will be done.")
         dist.barrier()
-        # configure map_location properly
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
         if not args.use_official_parent_pretrained:
-            parent_checkpoint_dict = torch.load(args.parent_pretrained_model, map_location=map_location)
+            parent_checkpoint_dict = load_checkpoint(args.parent_pretrained_model, "cpu", shared_checkpoint_dicts) ## The parent is moved to the GPU in the precision it will run in afterwards.
             if type(parent_checkpoint_dict) == dict:
-                parent_model.load_state_dict(parent_checkpoint_dict['model']) # We never do any remapping of the parent. We always reuse it as it is.
-            else:
-                parent_model.module.load_state_dict(parent_checkpoint_dict) # We never do any remapping of the parent. We always reuse it as it is.
+                parent_checkpoint_dict = parent_checkpoint_dict['model']
+            parent_model.load_state_dict({key[len("module."):] if key.startswith("module.") else key: value for key, value in parent_checkpoint_dict.items()}) # We never do any remapping of the parent. We always reuse it as it is. The parent is not wrapped in DDP so we drop the prefix.
+        parent_model = FrozenTeacher(parent_model, args, gpu) ## No DDP, no gradients, no dropout and optionally lower precision.
+
+    if args.activation_checkpointing: ## Trade computation for memory by recomputing the activations of some layers during the backward pass.
+        checkpointed_encoder_layers = get_checkpointed_layer_indices(args.activation_checkpointing_encoder_layers, model.config.encoder_layers, args.activation_checkpointing_every_k)
+        checkpointed_decoder_layers = get_checkpointed_layer_indices(args.activation_checkpointing_decoder_layers, model.config.decoder_layers, args.activation_checkpointing_every_k)
+        print("Activation checkpointing for encoder layers", checkpointed_encoder_layers, "and decoder layers", checkpointed_decoder_layers, "with CPU offloading" if args.activation_checkpointing_offload else "")
+        configure_activation_checkpointing(model, checkpointed_encoder_layers, checkpointed_decoder_layers, args.activation_checkpointing_offload)
+
+    if args.chunked_cross_entropy: ## The full logits are still needed for entropy maximization, softmax distillation and averaging the softmaxes of multiple sources.
+        model.skip_lm_logits_in_training = args.max_ent_weight == -1 and not (args.distillation and "cross_entropy" in args.distillation_styles.split(",")) and model.config.multi_source_method != "average_softmaxes"
+        print("Computing the cross entropy loss in chunks of", args.cross_entropy_chunk_size, "tokens.", "The full logits will not be computed." if model.skip_lm_logits_in_training else "The full logits will still be computed.")
 
-    model = DistributedDataParallel(model, device_ids=[gpu], output_device=gpu) ## This wrapper around the model will enable distributed training.
+    governor = BatchSizeGovernor(args, gpu, enabled=args.adaptive_batch_size) ## Splits batches that do not fit in memory into micro batches and adapts the batch size if asked to.
+    if args.adaptive_batch_size: ## Find the largest batch size that fits before DDP is in the picture.
+        probe_length = args.adaptive_batch_size_probe_length if args.adaptive_batch_size_probe_length > 0 else (args.packed_sequence_length if args.pack_sequences else (args.hard_truncate_length if args.hard_truncate_length > 0 else max(args.max_length, args.max_src_length, args.max_tgt_length)))
+        print("Finding the largest batch size that fits in memory starting from", args.batch_size, "using batches of sentences of length", probe_length)
+        governor.probe(model, probe_length, len(tok), tok.pad_token_id)
+
+    model = DistributedDataParallel(model, device_ids=[gpu], output_device=gpu, bucket_cap_mb=args.ddp_bucket_cap_mb) ## This wrapper around the model will enable distributed training.
+    if args.ddp_comm_hook != "none":
+        print("Gradients will be compressed with the", args.ddp_comm_hook, "communication hook before being all-reduced.")
+        register_ddp_comm_hook(model, args)
     
     no_decay = ["bias", "LayerNorm.weight"]
     optimizer_grouped_parameters = [
@@ -182,7 +198,10 @@ def model_create_load_run_save(gpu, args, files, train_files):
             "weight_decay": 0.0,
         },
     ] ## We suppose that weight decay will be used except for biases and layer norm weights.
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.lr, eps=1e-09) ## Our glorious optimizer.
+    if args.shard_optimizer_state: ## Each process only keeps the AdamW state for its share of the parameters.
+        optimizer = ShardedAdamW(optimizer_grouped_parameters, rank=rank, world_size=args.world_size, lr=args.lr, eps=1e-09)
+    else:
+        optimizer = AdamW(optimizer_grouped_parameters, lr=args.lr, eps=1e-09) ## Our glorious optimizer.
     
     model.train()
     scheduler = get_linear_schedule_with_warmup(optimizer, args.warmup_steps, args.num_batches) ## A warmup and decay scheduler. We use the linear scheduler for now. TODO: Enable other schedulers with a flag.
@@ -194,7 +213,7 @@ def model_create_load_run_save(gpu, args, files, train_files):
         dist.barrier()
         map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
         sys.stdout.flush()
-        checkpoint_dict = torch.load(args.pretrained_model, map_location=map_location)
+        checkpoint_dict = load_checkpoint(args.pretrained_model, map_location, shared_checkpoint_dicts)
         if type(checkpoint_dict) == dict:
             model.load_state_dict(remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), remap_layers(checkpoint_dict['model'], 4, args), args), strict=True if (args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization) else False)
             if not args.no_reload_optimizer_ctr_and_scheduler and args.remap_encoder is '' and args.remap_decoder is '' and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization: ## Do not load optimizers, ctr and schedulers when remapping or resuming training.
@@ -218,6 +237,8 @@ def model_create_load_run_save(gpu, args, files, train_files):
         else:
             print("Training from scratch")
         CHECKPOINT_PATH = args.model_path
+        if args.shard_optimizer_state: ## Every process has to take part in gathering the sharded optimizer state before rank 0 saves it.
+            optimizer.consolidate_state_dict()
         if rank == 0:
             checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': 0}
             torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
@@ -238,18 +259,28 @@ def model_create_load_run_save(gpu, args, files, train_files):
         print("Doing entropy maximization during loss computation.")
     if args.multistep_optimizer_steps > 1:
         print("Using a multistep optimizer where gradients will be accumulated over", args.multistep_optimizer_steps, "batches.")
+    if args.accumulation_target_tokens > 0:
+        print("Gradients will be accumulated till there are at least", args.accumulation_target_tokens, "target tokens per optimizer step over all processes. The loss will be normalized by the number of target tokens.")
+    profiler = StepProfiler(args, rank, True, args.profile_dir if args.profile_dir is not None else args.model_path+".profile", writer if rank == 0 else None) ## Profiles a range of optimizer steps if asked to.
+    metrics = TrainingMetrics(writer if rank == 0 else None, args.log_every, gpu, enabled=rank % 8 == 0) ## Losses and throughput are logged every log_every steps by a background thread so that the GPU never waits for logging. Only the master/prime processes print.
     num_batches_this_optimizer_step = 0
+    target_tokens_this_optimizer_step = 0
+    global_target_tokens_this_optimizer_step = 0
     losses = 0
     
-    for (input_ids, input_masks, decoder_input_ids, labels), is_bilingual in generate_batches_monolingual_masked_or_bilingual(tok, args, rank, files, train_files): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked. Since this is pretraining we do not do any evaluations even if we train on parallel corpora.
+    for (input_ids, input_masks, decoder_input_ids, labels), is_bilingual in metrics.timed_batches(profiler.spanned_batches(governor.batches(generate_batches_monolingual_masked_or_bilingual(tok, args, rank, files, train_files)))): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked. Since this is pretraining we do not do any evaluations even if we train on parallel corpora.
         start = time.time()
-        optimizer.zero_grad() ## Empty the gradients before any computation.
+        if num_batches_this_optimizer_step == 0 and not governor.is_micro_batch: ## Empty the gradients before the first batch of an optimizer step. The remaining batches accumulate their gradients into them.
+            optimizer.zero_grad()
         
-        if ctr % args.eval_every == 0 and num_batches_this_optimizer_step == 0: ## We have to evaluate our model every eval_every steps. Since there is no evaluation data this means our model is saved every eval_every steps.
+        if ctr % args.eval_every == 0 and num_batches_this_optimizer_step == 0 and not governor.is_micro_batch: ## We have to evaluate our model every eval_every steps. Since there is no evaluation data this means our model is saved every eval_every steps.
             CHECKPOINT_PATH = args.model_path
+            if args.shard_optimizer_state: ## Every process has to take part in gathering the sharded optimizer state before rank 0 saves it.
+                optimizer.consolidate_state_dict()
             if rank == 0:
                 print("Saving the model")
                 sys.stdout.flush()
+                profiler.begin("checkpoint")
                 # All processes should see same parameters as they all start from same
                 # random parameters and gradients are synchronized in backward passes.
                 # Therefore, saving it in one process is sufficient.
@@ -261,6 +292,7 @@ def model_create_load_run_save(gpu, args, files, train_files):
                         print("Saving an intermediate checkpoint")
                         torch.save(checkpoint_dict, CHECKPOINT_PATH + "."+str(ctr)) 
                         torch.save(model.module.state_dict(), CHECKPOINT_PATH+ "."+str(ctr)+".pure_model")
+                profiler.end("checkpoint")
             # Use a barrier() to make sure that process 1 loads the model after process
             # 0 saves it.
             dist.barrier()
@@ -279,17 +311,112 @@ def model_create_load_run_save(gpu, args, files, train_files):
             domain_classifier_labels = torch.tensor(domain_classifier_labels, dtype=torch.int64).to(gpu) ## Move to gpu
             labels=labels[0]
             label_mask = labels.eq(tok.pad_token_id).unsqueeze(-1).to(gpu)
+        if args.pack_sequences and not is_bilingual: ## Packed monolingual batches come with segment ids for the encoder and decoder.
+            input_masks, encoder_segment_ids, decoder_segment_ids = input_masks
+            encoder_segment_ids = encoder_segment_ids.to(gpu) ## Move to gpu
+            decoder_segment_ids = decoder_segment_ids.to(gpu) ## Move to gpu
+        else:
+            encoder_segment_ids, decoder_segment_ids = None, None
         input_ids=input_ids.to(gpu) ## Move to gpu
         input_masks=input_masks.to(gpu) ## Move to gpu
         decoder_input_ids=decoder_input_ids.to(gpu) ## Move to gpu
         labels=labels.to(gpu) ## Move to gpu
+        if governor.is_micro_batch: ## Part of a batch that did not fit in memory. It belongs to the same optimizer step as that batch and its loss is weighed by its share of the target tokens.
+            micro_batch_weight = labels.ne(tok.pad_token_id).sum()/governor.split_batch_tokens
+            is_last_batch_of_optimizer_step = governor.is_last_micro_batch and governor.split_batch_was_last
+        elif args.accumulation_target_tokens > 0: ## Accumulate gradients until the number of target tokens over all processes reaches the target.
+            batch_target_tokens, global_batch_target_tokens = count_target_tokens(labels, tok.pad_token_id)
+            target_tokens_this_optimizer_step += batch_target_tokens
+            global_target_tokens_this_optimizer_step += global_batch_target_tokens
+            is_last_batch_of_optimizer_step = global_target_tokens_this_optimizer_step >= args.accumulation_target_tokens
+        else:
+            is_last_batch_of_optimizer_step = num_batches_this_optimizer_step + 1 >= args.multistep_optimizer_steps
+        set_gradient_synchronization(model, is_last_batch_of_optimizer_step and not args.adaptive_batch_size) ## Gradients are all-reduced only for the last batch of an optimizer step. The others skip the communication. With an adaptive batch size the backward pass never communicates so that running out of memory in one process does not leave the others waiting.
+        if not governor.is_micro_batch: ## Micro batches were already counted as part of their batch.
+            metrics.add_batch(input_ids, input_masks, labels, tok.pad_token_id) ## Token counts for the throughput and padding ratio. These stay on the GPU.
+        backward_started = False
+        try:
+            profiler.begin("forward")
         
-        if args.mixed_wait_k:
-            model.module.config.wait_k = random.randint(1, args.wait_k)
+            if args.mixed_wait_k:
+                model.module.config.wait_k = random.randint(1, args.wait_k)
 
         
-        if args.fp16: ## The difference between AMP and FP32 is the use of the autocast. The code below is duplicated and can be shrunk. TODO.
-            with torch.cuda.amp.autocast():
+            if args.fp16: ## The difference between AMP and FP32 is the use of the autocast. The code below is duplicated and can be shrunk. TODO.
+                with torch.cuda.amp.autocast():
+                    if is_bilingual and args.unify_encoder:
+                        source_hidden_state_encoder = model.module.get_encoder()(input_ids=input_ids, attention_mask=input_masks).last_hidden_state ## Run the encoder for source sentence.
+                        decoder_input_masks = (decoder_input_ids != tok.pad_token_id).int().to(gpu)
+                        target_hidden_state_encoder = model.module.get_encoder()(input_ids=decoder_input_ids, attention_mask=decoder_input_masks).last_hidden_state ## Run the encoder for source sentence.
+                        decoder_input_masks.to('cpu') ## Move to CPU. May not be needed but its a safety net. 
+                        pad_mask = input_ids.eq(tok.pad_token_id).unsqueeze(2)
+                        source_hidden_state_encoder.masked_fill_(pad_mask, 0.0)
+                        source_hidden_state_encoder = source_hidden_state_encoder.mean(dim=1)
+                        pad_mask = decoder_input_ids.eq(tok.pad_token_id).unsqueeze(2)
+                        target_hidden_state_encoder.masked_fill_(pad_mask, 0.0)
+                        target_hidden_state_encoder = target_hidden_state_encoder.mean(dim=1)
+                        loss = -cosine_similarity(source_hidden_state_encoder, target_hidden_state_encoder)
+                        if rank == 0:
+                            metrics.add("encoder unification loss", loss)
+                    else:
+                        mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None, encoder_segment_ids=encoder_segment_ids, decoder_segment_ids=decoder_segment_ids) ## Run the model and get logits.
+                        logits = mod_compute.logits
+                        with profiler.span("loss"):
+                            loss = compute_lm_loss(model, mod_compute, logits, mod_compute.lm_hidden_states, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss.
+                        loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1.
+                        if rank == 0:
+                            metrics.add("pure cross entropy loss", loss)
+                        if args.temperature_calibration: 
+                            loss = loss*mod_compute.softmax_temperature
+                            if rank == 0:
+                                metrics.add("calibrated temperature", mod_compute.softmax_temperature)
+                                metrics.add("calibrated temperature loss", loss)
+                        if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
+                            domain_classifier_logits = mod_compute.domain_classifier_logits
+                            domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
+                            domain_classifier_loss = label_smoothed_nll_loss(
+                                domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
+                            ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
+                            loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
+                            if rank == 0:
+                                metrics.add("domain classifier loss", domain_classifier_loss)
+                                metrics.add("loss with domain classifier loss", loss)
+                        ## We will do multilayer softmaxing without any consideration for distillation or domain classification.
+                        if mod_compute.additional_lm_logits is not None:
+                            for additional_logits, additional_hidden_states in zip(mod_compute.additional_lm_logits, mod_compute.additional_lm_hidden_states):
+                                loss_extra = compute_lm_loss(model, mod_compute, additional_logits, additional_hidden_states, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss.
+                                loss_extra = loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1. TODO: Perhaps log this too.
+                                if args.temperature_calibration: 
+                                    loss_extra = loss_extra*mod_compute.softmax_temperature
+                                loss += loss_extra ## Up scale loss in case of non unitary temperatures. TODO: Perhaps log this too.
+                        if args.max_ent_weight != -1: ## This deals with softmax entropy maximization. The logic is that we compute the softmax entropy of the predictions via -(P(Y/X)*log(P(Y/X))). We then add it to the cross entropy loss with a negative sign as we wish to maximize entropy. This should penalize overconfident predictions. 
+                            assert (args.max_ent_weight >= 0 and args.max_ent_weight <= 1)
+                            logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                            if args.temperature_calibration: 
+                                logits = logits*mod_compute.softmax_temperature
+                            lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
+                            entropy = -(torch.exp(lprobs)*lprobs).mean()
+                            if rank == 0:
+                                metrics.add("softmax entropy", entropy)
+                            if mod_compute.additional_lm_logits is not None:
+                                for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
+                                    additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                                    if args.temperature_calibration: 
+                                        additional_logits = additional_logits*mod_compute.softmax_temperature
+                                    lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
+                                    entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
+                                    entropy += entropy_extra
+                            loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
+                            if rank == 0:
+                                metrics.add("loss with entropy loss", loss)
+                        if args.distillation: ## Time to distill.
+                            parent_mod_compute = parent_model(input_ids, input_masks, decoder_input_ids)
+                            distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Get the parent model's computations.
+                            loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
+                            if rank == 0:
+                                metrics.add("distillation loss", distillation_loss)
+                                metrics.add("final loss", loss)
+            else:
                 if is_bilingual and args.unify_encoder:
                     source_hidden_state_encoder = model.module.get_encoder()(input_ids=input_ids, attention_mask=input_masks).last_hidden_state ## Run the encoder for source sentence.
                     decoder_input_masks = (decoder_input_ids != tok.pad_token_id).int().to(gpu)
@@ -303,39 +430,35 @@ def model_create_load_run_save(gpu, args, files, train_files):
                     target_hidden_state_encoder = target_hidden_state_encoder.mean(dim=1)
                     loss = -cosine_similarity(source_hidden_state_encoder, target_hidden_state_encoder)
                     if rank == 0:
-                        writer.add_scalar("encoder unification loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("encoder unification loss", loss)
                 else:
-                    mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
+                    mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None, encoder_segment_ids=encoder_segment_ids, decoder_segment_ids=decoder_segment_ids) ## Run the model and get logits.
                     logits = mod_compute.logits
-                    lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
-                    loss = label_smoothed_nll_loss(
-                        lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                    ) ## Label smoothed cross entropy loss.
-                    loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1.
+                    with profiler.span("loss"):
+                        loss = compute_lm_loss(model, mod_compute, logits, mod_compute.lm_hidden_states, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss.
+                    loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
                     if rank == 0:
-                        writer.add_scalar("pure cross entropy loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("pure cross entropy loss", loss)
                     if args.temperature_calibration: 
                         loss = loss*mod_compute.softmax_temperature
                         if rank == 0:
-                            writer.add_scalar("calibrated temperature", mod_compute.softmax_temperature.detach().cpu().numpy(), ctr)
-                            writer.add_scalar("calibrated temperature loss", loss.detach().cpu().numpy(), ctr)
+                            metrics.add("calibrated temperature", mod_compute.softmax_temperature)
+                            metrics.add("calibrated temperature loss", loss)
                     if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
                         domain_classifier_logits = mod_compute.domain_classifier_logits
                         domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
+    #                     print(domain_classifier_labels, domain_classifier_labels.size(), domain_classifier_lprobs, domain_classifier_lprobs.size(), labels, labels.size())
                         domain_classifier_loss = label_smoothed_nll_loss(
                             domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
                         ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
                         loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
                         if rank == 0:
-                            writer.add_scalar("domain classifier loss", domain_classifier_loss.detach().cpu().numpy(), ctr)
-                            writer.add_scalar("loss with domain classifier loss", loss.detach().cpu().numpy(), ctr)
-                    ## We will do multilayer softmaxing without any consideration for distillation or domain classification.
+                            metrics.add("domain classifier loss", domain_classifier_loss)
+                            metrics.add("loss with domain classifier loss", loss)
+                    ## We will do multilayer softmaxing without any consideration for entropy maximization or distillation.
                     if mod_compute.additional_lm_logits is not None:
-                        for additional_logits in mod_compute.additional_lm_logits:
-                            lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## Softmax tempering of logits if needed.
-                            loss_extra = label_smoothed_nll_loss(
-                                lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                            ) ## Label smoothed cross entropy loss.
+                        for additional_logits, additional_hidden_states in zip(mod_compute.additional_lm_logits, mod_compute.additional_lm_hidden_states):
+                            loss_extra = compute_lm_loss(model, mod_compute, additional_logits, additional_hidden_states, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss.
                             loss_extra = loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1. TODO: Perhaps log this too.
                             if args.temperature_calibration: 
                                 loss_extra = loss_extra*mod_compute.softmax_temperature
@@ -348,7 +471,7 @@ def model_create_load_run_save(gpu, args, files, train_files):
                         lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
                         entropy = -(torch.exp(lprobs)*lprobs).mean()
                         if rank == 0:
-                            writer.add_scalar("softmax entropy", entropy.detach().cpu().numpy(), ctr)
+                            metrics.add("softmax entropy", entropy)
                         if mod_compute.additional_lm_logits is not None:
                             for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
                                 additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
@@ -359,134 +482,87 @@ def model_create_load_run_save(gpu, args, files, train_files):
                                 entropy += entropy_extra
                         loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
                         if rank == 0:
-                            writer.add_scalar("loss with entropy loss", loss.detach().cpu().numpy(), ctr)
+                            metrics.add("loss with entropy loss", loss)
                     if args.distillation: ## Time to distill.
-                        with torch.no_grad(): ## No gradient to avoid memory allocation.
-                            parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation)
-                        distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Get the parent model's computations.
+                        parent_mod_compute = parent_model(input_ids, input_masks, decoder_input_ids) ## Get the parent model's computations.
+                        distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
                         loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
                         if rank == 0:
-                            writer.add_scalar("distillation loss", distillation_loss.detach().cpu().numpy(), ctr)
-                            writer.add_scalar("final loss", loss.detach().cpu().numpy(), ctr)
-        else:
-            if is_bilingual and args.unify_encoder:
-                source_hidden_state_encoder = model.module.get_encoder()(input_ids=input_ids, attention_mask=input_masks).last_hidden_state ## Run the encoder for source sentence.
-                decoder_input_masks = (decoder_input_ids != tok.pad_token_id).int().to(gpu)
-                target_hidden_state_encoder = model.module.get_encoder()(input_ids=decoder_input_ids, attention_mask=decoder_input_masks).last_hidden_state ## Run the encoder for source sentence.
-                decoder_input_masks.to('cpu') ## Move to CPU. May not be needed but its a safety net. 
-                pad_mask = input_ids.eq(tok.pad_token_id).unsqueeze(2)
-                source_hidden_state_encoder.masked_fill_(pad_mask, 0.0)
-                source_hidden_state_encoder = source_hidden_state_encoder.mean(dim=1)
-                pad_mask = decoder_input_ids.eq(tok.pad_token_id).unsqueeze(2)
-                target_hidden_state_encoder.masked_fill_(pad_mask, 0.0)
-                target_hidden_state_encoder = target_hidden_state_encoder.mean(dim=1)
-                loss = -cosine_similarity(source_hidden_state_encoder, target_hidden_state_encoder)
-                if rank == 0:
-                    writer.add_scalar("encoder unification loss", loss.detach().cpu().numpy(), ctr)
-            else:
-                mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
-                logits = mod_compute.logits
-                lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
-                loss = label_smoothed_nll_loss(
-                    lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                ) ## Label smoothed cross entropy loss.
-                loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
-                if rank == 0:
-                    writer.add_scalar("pure cross entropy loss", loss.detach().cpu().numpy(), ctr)
-                if args.temperature_calibration: 
-                    loss = loss*mod_compute.softmax_temperature
-                    if rank == 0:
-                        writer.add_scalar("calibrated temperature", mod_compute.softmax_temperature.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("calibrated temperature loss", loss.detach().cpu().numpy(), ctr)
-                if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
-                    domain_classifier_logits = mod_compute.domain_classifier_logits
-                    domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
-#                     print(domain_classifier_labels, domain_classifier_labels.size(), domain_classifier_lprobs, domain_classifier_lprobs.size(), labels, labels.size())
-                    domain_classifier_loss = label_smoothed_nll_loss(
-                        domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
-                    ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
-                    loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
-                    if rank == 0:
-                        writer.add_scalar("domain classifier loss", domain_classifier_loss.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("loss with domain classifier loss", loss.detach().cpu().numpy(), ctr)
-                ## We will do multilayer softmaxing without any consideration for entropy maximization or distillation.
-                if mod_compute.additional_lm_logits is not None:
-                    for additional_logits in mod_compute.additional_lm_logits:
-                        lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## Softmax tempering of logits if needed.
-                        loss_extra = label_smoothed_nll_loss(
-                            lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                        ) ## Label smoothed cross entropy loss.
-                        loss_extra = loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1. TODO: Perhaps log this too.
-                        if args.temperature_calibration: 
-                            loss_extra = loss_extra*mod_compute.softmax_temperature
-                        loss += loss_extra ## Up scale loss in case of non unitary temperatures. TODO: Perhaps log this too.
-                if args.max_ent_weight != -1: ## This deals with softmax entropy maximization. The logic is that we compute the softmax entropy of the predictions via -(P(Y/X)*log(P(Y/X))). We then add it to the cross entropy loss with a negative sign as we wish to maximize entropy. This should penalize overconfident predictions. 
-                    assert (args.max_ent_weight >= 0 and args.max_ent_weight <= 1)
-                    logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                    if args.temperature_calibration: 
-                        logits = logits*mod_compute.softmax_temperature
-                    lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
-                    entropy = -(torch.exp(lprobs)*lprobs).mean()
-                    if rank == 0:
-                        writer.add_scalar("softmax entropy", entropy.detach().cpu().numpy(), ctr)
-                    if mod_compute.additional_lm_logits is not None:
-                        for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
-                            additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                            if args.temperature_calibration: 
-                                additional_logits = additional_logits*mod_compute.softmax_temperature
-                            lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
-                            entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
-                            entropy += entropy_extra
-                    loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
-                    if rank == 0:
-                        writer.add_scalar("loss with entropy loss", loss.detach().cpu().numpy(), ctr)
-                if args.distillation: ## Time to distill.
-                    with torch.no_grad(): ## No gradient to avoid memory allocation.
-                        parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation) ## Get the parent model's computations.
-                    distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
-                    loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
-                    if rank == 0:
-                        writer.add_scalar("distillation loss", distillation_loss.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("final loss", loss.detach().cpu().numpy(), ctr)
+                            metrics.add("distillation loss", distillation_loss)
+                            metrics.add("final loss", loss)
 
-        input_ids=input_ids.to('cpu') ## Move to CPU. May not be needed but its a safety net. 
-        input_masks=input_masks.to('cpu') ## Move to CPU. May not be needed but its a safety net.
-        decoder_input_ids=decoder_input_ids.to('cpu') ## Move to CPU. May not be needed but its a safety net.
-        labels=labels.to('cpu') ## Move to CPU. May not be needed but its a safety net.
-        if args.num_domains_for_domain_classifier > 1:
-            domain_classifier_labels = domain_classifier_labels.to('cpu')
-            label_mask = label_mask.to('cpu')
+            input_ids=input_ids.to('cpu') ## Move to CPU. May not be needed but its a safety net. 
+            input_masks=input_masks.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+            decoder_input_ids=decoder_input_ids.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+            labels=labels.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+            if args.num_domains_for_domain_classifier > 1:
+                domain_classifier_labels = domain_classifier_labels.to('cpu')
+                label_mask = label_mask.to('cpu')
         
-        ## Optimization part of the model from this point forward.
-        if args.fp16: ## The gradient scaler needs to be invoked with FP16/AMP computation. ## With FP16/AMP computation we need to unscale gradients before clipping them. We then optimize and update the scaler.
-            loss = loss/args.multistep_optimizer_steps
-            scaler.scale(loss).backward()
+            metrics.add_time("forward", profiler.end("forward"))
+            ## Optimization part of the model from this point forward.
+            if governor.is_micro_batch:
+                loss = loss*micro_batch_weight
+            if args.accumulation_target_tokens > 0:
+                loss = loss*batch_target_tokens ## The per token loss is turned into a sum over tokens. The gradients are divided by the total number of tokens just before the optimizer step.
+            else:
+                loss = loss/args.multistep_optimizer_steps
+            profiler.begin("backward")
+            backward_started = True
+            if args.fp16: ## The gradient scaler needs to be invoked with FP16/AMP computation.
+                scaler.scale(loss).backward()
+            else:
+                loss.backward()
+            metrics.add_time("backward", profiler.end("backward"))
+        except RuntimeError as e: ## With an adaptive batch size, a batch that does not fit in memory is split into micro batches which are processed next.
+            if not args.adaptive_batch_size or not is_out_of_memory_error(e):
+                raise
+            mod_compute = logits = loss = lprobs = entropy = None ## Drop the references to the activations so that their memory can be freed.
+            profiler.close_open_spans()
+            governor.recover_from_oom(optimizer, labels, tok.pad_token_id, is_last_batch_of_optimizer_step, backward_started)
+            continue
+        if not governor.is_micro_batch or governor.is_last_micro_batch: ## A batch split into micro batches counts as one batch.
             num_batches_this_optimizer_step += 1
-            losses += loss
-            if num_batches_this_optimizer_step < args.multistep_optimizer_steps:
-                continue
+        losses += loss.detach()
+        if not is_last_batch_of_optimizer_step:
+            continue
+        if governor.skip_optimizer_step(): ## Some process lost gradients of this optimizer step by running out of memory in the backward pass so all processes throw the step away to stay in sync.
+            print("Skipping the optimizer step since a process ran out of memory in the backward pass.")
+            optimizer.zero_grad()
+            losses = 0
+            num_batches_this_optimizer_step = 0
+            target_tokens_this_optimizer_step = 0
+            global_target_tokens_this_optimizer_step = 0
+            continue
+        profiler.begin("optimizer")
+        if args.adaptive_batch_size: ## DDP did not all-reduce the gradients in the backward pass so we do it here.
+            allreduce_gradients(model, args.world_size, args.ddp_bucket_cap_mb)
+        if args.accumulation_target_tokens > 0: ## DDP averages the gradients over processes so we multiply by the world size to get the sum and then normalize by the number of tokens.
+            scale_gradients(model, args.world_size/global_target_tokens_this_optimizer_step)
+        if args.fp16: ## With FP16/AMP computation we need to unscale gradients before clipping them. We then optimize and update the scaler.
             if args.max_gradient_clip_value != 0.0:
                 scaler.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_gradient_clip_value)
             scaler.step(optimizer)
             scaler.update()
-        else: ## With FP32, we just do regular backpropagation, gradient clipping and then step the optimizer.
-            loss = loss/args.multistep_optimizer_steps
-            loss.backward()
-            num_batches_this_optimizer_step += 1
-            losses += loss
-            if num_batches_this_optimizer_step < args.multistep_optimizer_steps:
-                continue
+        else: ## With FP32, we just do regular gradient clipping and then step the optimizer.
             if args.max_gradient_clip_value != 0.0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_gradient_clip_value)
             optimizer.step()
         scheduler.step() ## Advance the scheduler to get to the next value of LR.
-        lv = losses.detach().cpu().numpy() ## Detach the loss in order to report it.
+        metrics.add_time("optimizer", profiler.end("optimizer"))
+        if args.accumulation_target_tokens > 0:
+            losses = losses/target_tokens_this_optimizer_step ## Report the per token loss for this process.
+        metrics.add("training loss", losses) ## This is printed by the metrics thread every log_every batches.
         losses = 0
         num_batches_this_optimizer_step = 0
-        if ctr % 10 == 0 and rank % 8 == 0: ## Print the current loss every 10 batches but only for the master/prime process.
-            print(ctr, lv)
-            sys.stdout.flush()
+        target_tokens_this_optimizer_step = 0
+        global_target_tokens_this_optimizer_step = 0
+        if args.adaptive_batch_size:
+            metrics.add("batch size", args.batch_size)
+            governor.step()
+        metrics.step(ctr)
+        profiler.step()
         if ctr % 1000 == 0 and rank == 0 and args.save_weights_and_gradeint_info: ## Save the model weight and gradient info every time this condition is triggered.
             for param_name, param_value in model.named_parameters():
                 if not ("embed_positions" in param_name and args.positional_encodings):
@@ -495,11 +571,15 @@ def model_create_load_run_save(gpu, args, files, train_files):
         end = time.time()
         ctr += 1
     
+    if args.shard_optimizer_state: ## Every process has to take part in gathering the sharded optimizer state before rank 0 saves it.
+        optimizer.consolidate_state_dict()
     if rank == 0:
         checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
         torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save one last time.
         torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model") ## We will distribute this model and/or use it for fine tuning.
 
+    metrics.close() ## Log whatever is still queued.
+    profiler.close()
     dist.destroy_process_group()
 
 def run_demo():
@@ -578,7 +658,7 @@ def run_demo():
                         help='The value of sentence piece regularization amount controlled via alpha or the amount of BPE dropout controlled by dropout.')
     parser.add_argument('--warmup_steps', default=16000, type=int,
                         help='Scheduler warmup steps')
-    parser.add_argument('--multistep_optimizer_steps', default=1, type=int, help="In case you want to simulate a larger batch you should set this to a higher value.")
+    parser.add_argument('--multistep_optimizer_steps', default=1, type=int, help="In case you want to simulate a larger batch you should set this to a higher value. Gradients are all-reduced across GPUs only for the last of these batches.")
     parser.add_argument('--encoder_layers', default=6, type=int, help="The value for number of encoder layers")
     parser.add_argument('--decoder_layers', default=6, type=int, help="The value for number of decoder layers")
     parser.add_argument('--max_length', default=128, type=int, 
@@ -676,8 +756,81 @@ def run_demo():
     parser.add_argument('--is_summarization', action='store_true', 
                         help='Should we use masking on source sentences when training on parallel corpora?')
     ###
+    parser.add_argument('--fast_checkpoint_loading', action='store_true', 
+                        help='Should we load checkpoints faster and with less memory? The checkpoints are loaded once on the CPU by the launching process and shared with all the local processes via shared memory instead of being loaded onto every GPU by every process. Furthermore, the random initialization of the model is skipped whenever the checkpoint overwrites all the parameters (no layer remapping, component elimination or embedding remapping).')
+    parser.add_argument('--chunked_cross_entropy', action='store_true', 
+                        help='Should we compute the label smoothed cross entropy loss from the decoder states and the lm_head weight a few tokens at a time? The [batch, target length, vocabulary] logits and log probabilities, which are the biggest activations when the vocabulary is large, are never materialized. The loss and gradients are the same as the regular loss. This applies to the multilayer softmaxes too. If entropy maximization or cross entropy distillation is used then the logits are still computed for those but the loss is computed in chunks.')
+    parser.add_argument('--cross_entropy_chunk_size', type=int, default=1024, 
+                        help='The number of target tokens processed at a time by --chunked_cross_entropy. The memory needed is roughly this times the vocabulary size times 8 bytes. Smaller values save memory but may be slower.')
+    parser.add_argument('--chunked_distillation', action='store_true', 
+                        help='Should we compute the cross_entropy distillation loss a few tokens at a time? The regular implementation holds several [batch, target length, vocabulary] tensors at once which makes distillation batches much smaller than regular training batches. The loss and gradients are the same as the regular loss. See benchmark_distillation_memory.py for the maximum batch sizes with and without it.')
+    parser.add_argument('--distillation_chunk_size', type=int, default=1024, 
+                        help='The number of target tokens processed at a time by --chunked_distillation.')
+    parser.add_argument('--distillation_top_k', type=int, default=0, 
+                        help='If more than 0 then the cross_entropy distillation loss only uses the top-k tokens of the parent distribution which is renormalized over them. Implies --chunked_distillation. The default of 0 uses the whole vocabulary.')
+    parser.add_argument('--parent_precision', default='fp32', type=str, choices=['fp32', 'fp16', 'bf16', 'int8'], 
+                        help='The precision in which the parent model runs during distillation. fp16 and bf16 halve the memory and time needed for the parent. bf16 needs a GPU and a version of pytorch that support it. int8 uses dynamic quantization which only works on the CPU so the parent runs on the CPU. This saves GPU memory but is slow.')
+    parser.add_argument('--pack_sequences', action='store_true', 
+                        help='Should we pack several masked monolingual examples into each row of a batch? Short sentences waste most of a padded batch on pad tokens. With packing, examples are concatenated into rows of up to --packed_sequence_length tokens and the encoder self attention, decoder self attention and cross attention are masked so that examples dont see each other. Positions restart for each example. The loss is the same per token loss as without packing. The batch size is then the number of actual tokens in a batch. Bilingual batches are not packed. Not compatible with domain classifiers, distillation, wait-k, unidirectional encoders or multi-source models.')
+    parser.add_argument('--packed_sequence_length', default=512, type=int, 
+                        help='The maximum number of tokens in a packed row. This should not be more than the maximum number of positions of the model. If --hard_truncate_length is set then the smaller of the two is used.')
+    parser.add_argument('--accumulation_target_tokens', default=0, type=int, 
+                        help='If more than 0 then gradients are accumulated over as many batches as needed to reach this many (non padding) target tokens over all GPUs before the optimizer is stepped. This gives optimizer steps of the same size irrespective of the sentence lengths in the batches. The loss is summed over tokens and the gradients are divided by the total number of target tokens. This overrides --multistep_optimizer_steps. Note that the number of tokens has to be all-reduced after each batch but this is a single number.')
+    parser.add_argument('--ddp_comm_hook', default='none', type=str, choices=['none', 'fp16', 'bf16', 'powersgd', 'batched_powersgd'], 
+                        help='How should gradients be compressed before they are all-reduced across GPUs? This matters for multi-node training over slow networks where the all-reduce of the fp32 gradients, especially those of the big embedding and feed forward layers, takes most of the time. fp16 and bf16 halve the bytes sent. powersgd sends low rank approximations of each gradient matrix and uses error feedback to make up for the approximation error. powersgd and batched_powersgd cannot be used with --fp16. batched_powersgd compresses each whole gradient bucket as one square matrix which is faster but less accurate. fp16 needs pytorch 1.7, powersgd needs 1.8 and bf16 needs 1.10 with NCCL 2.10. See benchmark_ddp_comm_hooks.py.')
+    parser.add_argument('--powersgd_rank', default=1, type=int, 
+                        help='The rank of the PowerSGD approximation. Higher values are more accurate but send more bytes. Usually 1 to 4 is enough.')
+    parser.add_argument('--powersgd_start_iteration', default=1000, type=int, 
+                        help='PowerSGD uses the regular all-reduce for these many iterations before it starts compressing. Compressing the gradients from the very beginning can hurt convergence.')
+    parser.add_argument('--ddp_bucket_cap_mb', default=25, type=int, 
+                        help='The size in MB of the buckets in which DDP groups gradients for all-reduce. Bigger buckets mean fewer and more efficient all-reduce calls but less overlap with the backward pass. For slow networks bigger buckets often help. For PowerSGD, larger buckets give more matrices to compress at once.')
+    parser.add_argument('--shard_optimizer_state', action='store_true', 
+                        help='Should the AdamW state be sharded across GPUs? Normally every GPU holds two fp32 moments for every parameter which is twice the memory of the model. With this flag each GPU only keeps the moments of and updates its share of the parameters after which the updated parameters are broadcast. This is ZeRO stage 1 and the memory saved can go into a bigger model or batch. Checkpoints still contain the full optimizer state in the usual format so they can be resumed with or without this flag and with a different number of GPUs.')
+    parser.add_argument('--activation_checkpointing', action='store_true', 
+                        help='Should the activations of some encoder and decoder layers be recomputed during the backward pass instead of being kept in memory? This costs roughly one extra forward pass of those layers but the memory saved can go into bigger batches. Which layers are checkpointed is decided by the next few flags. Use benchmark_activation_checkpointing.py to find the fastest setting that fits a given memory budget.')
+    parser.add_argument('--activation_checkpointing_encoder_layers', default='', type=str, 
+                        help='Comma separated indices (from 0) of the encoder layers to checkpoint or "none". If empty then every k-th layer is checkpointed where k is given by --activation_checkpointing_every_k.')
+    parser.add_argument('--activation_checkpointing_decoder_layers', default='', type=str, 
+                        help='Comma separated indices (from 0) of the decoder layers to checkpoint or "none". If empty then every k-th layer is checkpointed where k is given by --activation_checkpointing_every_k.')
+    parser.add_argument('--activation_checkpointing_every_k', default=1, type=int, 
+                        help='Checkpoint every k-th layer when the layers are not listed explicitly. 1 means all layers and 2 means every second layer which saves about half as much memory but costs half as much recomputation.')
+    parser.add_argument('--activation_checkpointing_offload', action='store_true', 
+                        help='Should the inputs of the checkpointed layers, which are the only activations they keep, be moved to pinned CPU memory till the backward pass? This saves a little more GPU memory at the cost of copies between the CPU and GPU.')
+    parser.add_argument('--log_every', default=10, type=int, 
+                        help='Losses, the learning rate and throughput statistics (tokens and sentences per second, padding ratio, time spent waiting for data and in the forward pass, backward pass and optimizer) are averaged over these many batches before they are written to tensorboard and printed. They are accumulated on the GPU and written by a background thread so the GPU never waits for logging. Setting this to 1 logs every batch.')
+    parser.add_argument('--profile_steps', default=0, type=int, 
+                        help='The number of optimizer steps to profile with the pytorch profiler. 0 means no profiling. The CPU and, if there are GPUs, the CUDA activity of these steps is saved as a chrome trace (open it in chrome://tracing or https://ui.perfetto.dev), as a tensorboard trace if the pytorch version supports it and as a table of the most expensive operators. The time spent in data generation, forward pass, loss, backward pass, optimizer, evaluation and checkpointing shows up as labelled spans in the trace. Keep this small since traces get big very quickly.')
+    parser.add_argument('--profile_start_step', default=10, type=int, 
+                        help='The optimizer step at which profiling starts. The first few steps are slow due to memory allocation and cudnn autotuning so it makes sense to skip them.')
+    parser.add_argument('--profile_dir', default=None, type=str, 
+                        help='The directory where the traces will be saved. Defaults to model_path with the suffix .profile. Point tensorboard to this directory to see the traces.')
+    parser.add_argument('--profile_rank', default=0, type=int, 
+                        help='The rank of the process to profile. Only one process is profiled.')
+    parser.add_argument('--profile_memory', action='store_true', 
+                        help='Should the profiler record the memory allocated and freed by each operator?')
+    parser.add_argument('--profile_with_stack', action='store_true', 
+                        help='Should the profiler record the python stack of each operator? This makes the traces much larger but tells you which line of code launched what.')
+    parser.add_argument('--profile_record_shapes', action='store_true', 
+                        help='Should the profiler record the shapes of the inputs of each operator? The operator table will then be grouped by input shapes.')
+    parser.add_argument('--adaptive_batch_size', action='store_true', 
+                        help='Should the batch size be adapted to the GPU memory? At the start, the largest batch size for which a batch where every sentence has the maximum length survives a forward and backward pass is found and used instead of --batch_size, which is where the search starts. If a batch still runs out of memory during training, it is split into micro batches whose gradients are accumulated, so the optimizer step stays the same, and the batch size is lowered a little. The batch size is raised again when the peak memory usage stays low. In this mode the gradients are all-reduced right before the optimizer step instead of during the backward pass so that running out of memory in one process never leaves the others waiting. This costs a bit of speed since communication no longer overlaps with the backward pass.')
+    parser.add_argument('--adaptive_batch_size_max', default=0, type=int, 
+                        help='The batch size will never be raised above this. 0 means 8 times --batch_size.')
+    parser.add_argument('--adaptive_batch_size_safety_margin', default=0.9, type=float, 
+                        help='The batch size found at the start is multiplied by this to leave some memory for fragmentation and things the probe does not account for.')
+    parser.add_argument('--adaptive_batch_size_probe_length', default=0, type=int, 
+                        help='The sentence length of the batches used to find the batch size at the start. 0 means the maximum length a batch can have given the length limits.')
+    parser.add_argument('--adaptive_batch_size_check_every', default=200, type=int, 
+                        help='Every these many optimizer steps we check if the batch size can be raised. It is raised by 10 percent if no batch ran out of memory and the peak memory usage was below --adaptive_batch_size_memory_target.')
+    parser.add_argument('--adaptive_batch_size_memory_target', default=0.8, type=float, 
+                        help='The fraction of the GPU memory below which the peak memory usage must stay for the batch size to be raised.')
     args = parser.parse_args()
+    if args.adaptive_batch_size:
+        assert args.ddp_comm_hook == "none", "Communication hooks only apply to the all-reduce in the backward pass which is not used with an adaptive batch size."
+    assert not (args.fp16 and "powersgd" in args.ddp_comm_hook), "PowerSGD cannot be used with --fp16. The gradients of steps which the GradScaler skips because of infs or NaNs would still end up in the PowerSGD error feedback and spoil all the later steps. Use --ddp_comm_hook fp16 or bf16 instead."
     assert len(args.token_masking_probs_range) <= 2
+    if args.pack_sequences:
+        assert args.num_domains_for_domain_classifier <= 1 and not args.distillation and args.wait_k == -1 and not args.unidirectional_encoder and not args.multi_source, "Sequence packing cannot be used with domain classifiers, distillation, wait-k, unidirectional encoders or multi-source models."
     print("IP address is", args.ipaddr)
 
     args.world_size = args.gpus * args.nodes                #
@@ -720,7 +873,15 @@ def run_demo():
         print("Number of unique domains are ", len(args.train_domains))
     os.environ['MASTER_ADDR'] = args.ipaddr              #
     os.environ['MASTER_PORT'] = '26023'                      #
-    mp.spawn(model_create_load_run_save, nprocs=args.gpus, args=(args,files,train_files,))         #
+    shared_checkpoint_dicts = None
+    if args.fast_checkpoint_loading: ## Load the checkpoints once per node and share them with all the local processes.
+        checkpoint_paths = []
+        if args.pretrained_model != "" and not args.use_official_pretrained:
+            checkpoint_paths.append(args.pretrained_model)
+        if args.distillation and not args.use_official_parent_pretrained:
+            checkpoint_paths.append(args.parent_pretrained_model)
+        shared_checkpoint_dicts = load_checkpoints_in_shared_memory(checkpoint_paths)
+    mp.spawn(model_create_load_run_save, nprocs=args.gpus, args=(args,files,train_files,shared_checkpoint_dicts,))         #
     
 if __name__ == "__main__":
     run_demo()
\ No newline at end of file
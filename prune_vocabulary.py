@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import collections
+import json
+import os
+import shutil
+##
+
+## Huggingface imports
+from transformers import AutoTokenizer, MBartTokenizer, MBart50Tokenizer, BartTokenizer
+##
+
+## Pytorch imports
+import torch
+##
+
+## Other imports
+from sentencepiece import sentencepiece_model_pb2
+##
+
+embedding_key_suffixes = ["model.shared.weight", "model.encoder.embed_tokens.weight", "model.decoder.embed_tokens.weight", "lm_head.weight"] ## Parameters whose rows correspond to vocabulary ids. The final_logits_bias is handled separately since its shape is (1, vocab size).
+
+
+def load_tokenizer(tokenizer_name_or_path, args):
+    """Loads the tokenizer the same way as the training and decoding scripts do."""
+    if args.use_official_pretrained:
+        if "mbart" in tokenizer_name_or_path:
+            if "50" in tokenizer_name_or_path:
+                return MBart50Tokenizer.from_pretrained(tokenizer_name_or_path)
+            return MBartTokenizer.from_pretrained(tokenizer_name_or_path)
+        return BartTokenizer.from_pretrained(tokenizer_name_or_path)
+    return AutoTokenizer.from_pretrained(tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
+
+
+def count_token_usage(tok, args):
+    """Tokenizes the corpora and counts how often each subword is used."""
+    token_counts = collections.Counter()
+    for corpus in args.corpora:
+        print("Counting tokens in", corpus)
+        num_lines = 0
+        for line in open(corpus):
+            token_counts.update(tok.tokenize(line.strip()))
+            num_lines += 1
+            if num_lines == args.max_lines_per_corpus:
+                break
+    print("Found", len(token_counts), "unique tokens out of", len(tok))
+    return token_counts
+
+
+def prune_sentencepiece_model(tok, token_counts, args):
+    """Removes the normal pieces which were used fewer than min_count times from the sentencepiece model of the tokenizer. Control, unknown, user defined and byte pieces are always kept. Single character pieces are kept if asked so that unseen words can still be segmented into characters instead of becoming unknown tokens. Returns the serialized pruned model."""
+    spm_model = sentencepiece_model_pb2.ModelProto()
+    spm_model.ParseFromString(open(tok.vocab_file, "rb").read())
+    if spm_model.trainer_spec.model_type == sentencepiece_model_pb2.TrainerSpec.BPE:
+        print("WARNING: This is a BPE sentencepiece model. Removing pieces may remove intermediate merges and change the segmentation. Check the verification statistics below.")
+    kept_pieces = []
+    for piece in spm_model.pieces:
+        if piece.type != sentencepiece_model_pb2.ModelProto.SentencePiece.NORMAL or token_counts[piece.piece] >= args.min_count or (args.keep_all_characters and len(piece.piece.replace("▁", "")) <= 1):
+            kept_pieces.append(piece)
+    print("Keeping", len(kept_pieces), "out of", len(spm_model.pieces), "sentencepiece pieces")
+    del spm_model.pieces[:]
+    spm_model.pieces.extend(kept_pieces)
+    return spm_model
+
+
+def save_pruned_tokenizer(tok, spm_model, args):
+    """Copies the original tokenizer directory and replaces the sentencepiece model (and its human readable vocab file if present). The added tokens, such as the language tokens, are retained but renumbered since their ids must directly follow the pruned sentencepiece vocabulary. The special tokens and config are untouched."""
+    shutil.copytree(args.tokenizer_name_or_path, args.output_tokenizer)
+    added_tokens_file = os.path.join(args.output_tokenizer, "added_tokens.json")
+    if os.path.exists(added_tokens_file): ## The tokenizer insists that the added token ids are consecutive and start at the sentencepiece vocabulary size.
+        with open(added_tokens_file, encoding="utf-8") as f:
+            added_tokens = json.load(f)
+        added_tokens = {token: len(spm_model.pieces) + new_idx for new_idx, token in enumerate(sorted(added_tokens, key=lambda token: added_tokens[token]))}
+        with open(added_tokens_file, "w", encoding="utf-8") as f:
+            json.dump(added_tokens, f, ensure_ascii=False)
+    spm_model_file = os.path.join(args.output_tokenizer, os.path.basename(tok.vocab_file))
+    with open(spm_model_file, "wb") as f:
+        f.write(spm_model.SerializeToString())
+    spm_vocab_file = spm_model_file[:-len(".model")] + ".vocab"
+    if spm_model_file.endswith(".model") and os.path.exists(spm_vocab_file):
+        with open(spm_vocab_file, "w") as f:
+            for piece in spm_model.pieces:
+                f.write(piece.piece + "\t" + str(int(piece.score) if piece.score == int(piece.score) else piece.score) + "\n")
+
+
+def verify_pruned_tokenizer(tok, new_tok, args):
+    """Compares the segmentations produced by the original and the pruned tokenizers on the first few lines of each corpus."""
+    num_lines = 0
+    num_changed = 0
+    num_unks = 0
+    for corpus in args.corpora:
+        for line_idx, line in enumerate(open(corpus)):
+            if line_idx == args.verify_lines_per_corpus:
+                break
+            tokens = tok.tokenize(line.strip())
+            new_tokens = new_tok.tokenize(line.strip())
+            num_changed += 1 if tokens != new_tokens else 0
+            num_unks += new_tokens.count(new_tok.unk_token)
+            num_lines += 1
+    print("Segmentation changed for", num_changed, "out of", num_lines, "lines. The pruned tokenizer produced", num_unks, "unknown tokens.")
+
+
+def prune_checkpoint(checkpoint_dict, new_to_old_ids):
+    """Keeps only the rows of the embeddings, lm_head and final_logits_bias which belong to the pruned vocabulary. Works for both the full checkpoints and the pure_model ones and for keys with or without the DDP module prefix. The optimizer and scheduler states have vocabulary sized tensors so they are dropped."""
+    if type(checkpoint_dict) == dict and "model" in checkpoint_dict:
+        print("This is a full checkpoint. Only the model will be kept since the optimizer state no longer matches the vocabulary.")
+        return {"model": prune_checkpoint(checkpoint_dict["model"], new_to_old_ids)}
+    for key in checkpoint_dict:
+        if any([key.endswith(suffix) for suffix in embedding_key_suffixes]):
+            print("Pruning", key, "from", checkpoint_dict[key].size(0), "to", len(new_to_old_ids), "rows")
+            checkpoint_dict[key] = checkpoint_dict[key].index_select(0, new_to_old_ids).clone()
+        elif key.endswith("final_logits_bias"):
+            print("Pruning", key, "from", checkpoint_dict[key].size(1), "to", len(new_to_old_ids), "columns")
+            checkpoint_dict[key] = checkpoint_dict[key].index_select(1, new_to_old_ids).clone()
+    return checkpoint_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to prune the vocabulary of a model to the subwords actually used in a given corpus. "
+        "Writes a new tokenizer whose sentencepiece model only contains the used subwords and a new checkpoint whose "
+        "embeddings, lm_head and final_logits_bias only contain the corresponding rows.",
+    )
+    parser.add_argument('--corpora', required=True, nargs='+',
+                        help='The corpora of the languages you want to keep. Use both source and target side corpora.')
+    parser.add_argument('--tokenizer_name_or_path', required=True, type=str,
+                        help='Path to the local directory of the original tokenizer.')
+    parser.add_argument('--use_official_pretrained', action='store_true',
+                        help='Use this flag if the tokenizer is that of an official pre-trained model. You should have saved it to a local directory first.')
+    parser.add_argument('--model_path', required=True, type=str,
+                        help='Path to the checkpoint to prune. This can be a full checkpoint or a pure_model one.')
+    parser.add_argument('--output_tokenizer', required=True, type=str,
+                        help='The directory where the pruned tokenizer will be saved. It should not already exist.')
+    parser.add_argument('--output_model_path', required=True, metavar='FILE',
+                        help='Write the pruned checkpoint to this path.')
+    parser.add_argument('--min_count', default=1, type=int,
+                        help='Subwords used fewer times than this in the corpora will be removed.')
+    parser.add_argument('--keep_all_characters', action='store_true',
+                        help='Should we keep all the single character pieces even if they are not used? This avoids unknown tokens on unseen text at the cost of a slightly larger vocabulary.')
+    parser.add_argument('--max_lines_per_corpus', default=-1, type=int,
+                        help='Only use this many lines of each corpus for counting. -1 means use the whole corpus.')
+    parser.add_argument('--verify_lines_per_corpus', default=1000, type=int,
+                        help='The number of lines of each corpus on which the segmentations of the original and pruned tokenizers are compared.')
+    args = parser.parse_args()
+    print(args)
+
+    tok = load_tokenizer(args.tokenizer_name_or_path, args)
+    assert getattr(tok, "sp_model", None) is not None and getattr(tok, "vocab_file", "").endswith(".model"), "Only tokenizers based on a sentencepiece model can be pruned. The tokenizer in %s is a %s which has no sentencepiece vocab_file (official BART tokenizers use GPT-2 BPE instead)." % (args.tokenizer_name_or_path, type(tok).__name__)
+    token_counts = count_token_usage(tok, args)
+    spm_model = prune_sentencepiece_model(tok, token_counts, args)
+    save_pruned_tokenizer(tok, spm_model, args)
+    new_tok = load_tokenizer(args.output_tokenizer, args)
+    expected_vocab_size = len(tok) - (len(tok.sp_model) - len(spm_model.pieces)) ## Only the sentencepiece pieces were removed. The rest, such as the fairseq offset and the language codes of the official MBART tokenizers, is unchanged.
+    assert len(new_tok) == expected_vocab_size, "The pruned tokenizer in %s has %d tokens instead of the expected %d." % (args.output_tokenizer, len(new_tok), expected_vocab_size)
+    print("The vocabulary size went from", len(tok), "to", len(new_tok))
+    verify_pruned_tokenizer(tok, new_tok, args)
+
+    new_to_old_ids = tok.convert_tokens_to_ids(new_tok.convert_ids_to_tokens(list(range(len(new_tok))))) ## Every token of the pruned tokenizer comes from the original tokenizer.
+    new_to_old_ids = torch.tensor(new_to_old_ids, dtype=torch.long)
+
+    checkpoint_dict = torch.load(args.model_path, map_location="cpu")
+    checkpoint_dict = prune_checkpoint(checkpoint_dict, new_to_old_ids)
+    torch.save(checkpoint_dict, args.output_model_path)
+    print("Finished writing the pruned checkpoint to {}. Use {} as the tokenizer from now on.".format(args.output_model_path, args.output_tokenizer))
+
+
+if __name__ == "__main__":
+    main()
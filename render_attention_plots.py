@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+##
+
+## Other imports
+import matplotlib
+matplotlib.use('Agg')  # Must be before importing matplotlib.pyplot or pylab!
+##
+
+## Our imports
+from common_utils import *
+##
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tool to plot the attentions saved by decode_nmt.py with --decode_type get_attention. "
+        "The plots are rendered in parallel by a pool of processes and can be restricted to the sentences and attention types you care about.",
+    )
+    parser.add_argument('--attention_prefix', required=True, type=str,
+                        help='The --test_tgt that was used when extracting the attentions. The attentions are read from attention_prefix.attention.* and the plots are saved as attention_prefix.sentence-N[.layer-L.head-H].TYPE.png.')
+    parser.add_argument('--num_workers', default=4, type=int,
+                        help='The number of processes that render the plots. 0 means the plots are rendered by this process.')
+    parser.add_argument('--sentence_ids', nargs='+', type=int, default=None,
+                        help='The 0 indexed line numbers of the sentence pairs to plot. All sentence pairs are plotted by default.')
+    parser.add_argument('--attention_types', nargs='+', type=str, default=['enc_enc', 'dec_dec', 'enc_dec'], choices=['enc_enc', 'dec_dec', 'enc_dec'],
+                        help='The attentions to plot. enc_enc is the encoder self attention, dec_dec is the decoder self attention and enc_dec is the cross attention.')
+    args = parser.parse_args()
+    print(args)
+
+    render_attention_plots(args.attention_prefix, args.num_workers, set(args.sentence_ids) if args.sentence_ids is not None else None, args.attention_types)
+    print("Finished rendering the plots")
+
+
+if __name__ == "__main__":
+    main()
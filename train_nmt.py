@@ -65,7 +65,7 @@ from prefetch_generator import BackgroundGenerator
 torch.manual_seed(621311)
 ##
 
-def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition):
+def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition, shared_checkpoint_dicts=None):
     """The main function which does the overall training. Should be split into multiple parts in the future. Currently monolithc intentionally."""
     
     rank = args.nr * args.gpus + gpu ## The rank of the current process out of the total number of processes indicated by world_size.
@@ -87,7 +87,6 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
             tok = BartTokenizer.from_pretrained(args.tokenizer_name_or_path)
     else:
         tok = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True) ## Fast tokenizers are not good because their behavior is weird. Accents should be kept or else the segmentation will be messed up on languages with accented characters. No lower case obviously because we want to train on the original case. Set to false if you are ok with the model not dealing with cases.
-    scorer = rouge_scorer.RougeScorer(['rouge1', 'rougeL'], use_stemmer=False) ## In case we do summarization.
 
     print("Tokenizer is:", tok)
     
@@ -129,10 +128,11 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
             model = BartForConditionalGeneration.from_pretrained(args.pretrained_model, config=config, force_bos_token_to_be_generated=True) ## We may use FBs official model and fine-tune it for our purposes.
     else:
         config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers, dropout=args.dropout, attention_dropout=args.attention_dropout, activation_dropout=args.activation_dropout, encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, encoder_layerdrop=args.layerdrop, decoder_layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, num_domains_for_domain_classifier=args.num_domains_for_domain_classifier, gradient_reversal_for_domain_classifier=args.gradient_reversal_for_domain_classifier) ## Configuration. TODO: Save this configuration somehow.
-        model = MBartForConditionalGeneration(config)
+        with skip_weight_initialization(args.fast_checkpoint_loading and args.pretrained_model != "" and checkpoint_overwrites_all_parameters(args)): ## The checkpoint will overwrite the random initialization anyway.
+            model = MBartForConditionalGeneration(config)
     model.train()
     
-    if args.distillation: ## When distilling we need a parent model. The creation of the model is in the same way as the child. This model is immediately loaded with some pretrained params and then loaded into the GPU.
+    if args.distillation and (args.teacher_cache_path is None or args.dump_teacher_outputs): ## When distilling we need a parent model unless its outputs were cached. The creation of the model is in the same way as the child. This model is immediately loaded with some pretrained params and then loaded into the GPU.
         print("We will do distillation from a parent model.")
         if args.use_official_parent_pretrained:
             if "mbart" in args.parent_pretrained_model:
@@ -153,22 +153,25 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                 parent_model = BartForConditionalGeneration.from_pretrained(args.parent_pretrained_model, config=parent_config, force_bos_token_to_be_generated=True) ## We may use FBs official model and fine-tune it for our purposes.
         else:
             parent_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.parent_encoder_layers, decoder_layers=args.parent_decoder_layers, dropout=args.parent_dropout, attention_dropout=args.parent_attention_dropout, activation_dropout=args.parent_activation_dropout, encoder_attention_heads=args.parent_encoder_attention_heads, decoder_attention_heads=args.parent_decoder_attention_heads, encoder_ffn_dim=args.parent_encoder_ffn_dim, decoder_ffn_dim=args.parent_decoder_ffn_dim, d_model=args.parent_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, encoder_layerdrop=args.layerdrop, decoder_layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings)
-            parent_model = MBartForConditionalGeneration(config)
-        parent_model.cuda(gpu)
-        parent_model.train() ## We do this to enable dropout but we wont have an optimizer for this so we wont train this model. For now. Future implementations should ask if we want to do co-distill or not. By co-distillation I mean, the parent will learn together with the child.
-        parent_model = DistributedDataParallel(parent_model, device_ids=[gpu], output_device=gpu)
+            with skip_weight_initialization(args.fast_checkpoint_loading): ## The parent is always loaded without remapping.
+                parent_model = MBartForConditionalGeneration(parent_config)
         print("Loading a parent model from which distillation will be done.")
         dist.barrier()
-        # configure map_location properly
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
         if not args.use_official_parent_pretrained:
-            parent_checkpoint_dict = torch.load(args.parent_pretrained_model, map_location=map_location)
+            parent_checkpoint_dict = load_checkpoint(args.parent_pretrained_model, "cpu", shared_checkpoint_dicts) ## The parent is moved to the GPU in the precision it will run in afterwards.
             if type(parent_checkpoint_dict) == dict:
-                parent_model.load_state_dict(parent_checkpoint_dict['model']) # We never do any remapping of the parent. We always reuse it as it is.
-            else:
-                parent_model.module.load_state_dict(parent_checkpoint_dict) # We never do any remapping of the parent. We always reuse it as it is.
-            
-        parent_model.train()
+                parent_checkpoint_dict = parent_checkpoint_dict['model']
+            parent_model.load_state_dict({key[len("module."):] if key.startswith("module.") else key: value for key, value in parent_checkpoint_dict.items()}) # We never do any remapping of the parent. We always reuse it as it is. The parent is not wrapped in DDP so we drop the prefix.
+        parent_model = FrozenTeacher(parent_model, args, gpu) ## No DDP, no gradients, no dropout and optionally lower precision.
+
+    teacher_cache = None
+    if args.distillation and args.teacher_cache_path is not None:
+        if args.dump_teacher_outputs: ## The first phase of offline distillation. We only run the parent and then quit.
+            dump_teacher_outputs(parent_model, tok, args, train_files, rank)
+            dist.barrier()
+            dist.destroy_process_group()
+            return
+        teacher_cache = TeacherOutputCache(args.teacher_cache_path, rank, tok.pad_token_id)
 
     torch.cuda.set_device(gpu) ## Set the device to the current GPU. This is different from the rank so keep this in mind.
     
@@ -182,7 +185,26 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
 
     model.cuda(gpu) ## Move the model to the GPU.
 
-    model = DistributedDataParallel(model, device_ids=[gpu], output_device=gpu) ## This wrapper around the model will enable distributed training.
+    if args.activation_checkpointing: ## Trade computation for memory by recomputing the activations of some layers during the backward pass.
+        checkpointed_encoder_layers = get_checkpointed_layer_indices(args.activation_checkpointing_encoder_layers, model.config.encoder_layers, args.activation_checkpointing_every_k)
+        checkpointed_decoder_layers = get_checkpointed_layer_indices(args.activation_checkpointing_decoder_layers, model.config.decoder_layers, args.activation_checkpointing_every_k)
+        print("Activation checkpointing for encoder layers", checkpointed_encoder_layers, "and decoder layers", checkpointed_decoder_layers, "with CPU offloading" if args.activation_checkpointing_offload else "")
+        configure_activation_checkpointing(model, checkpointed_encoder_layers, checkpointed_decoder_layers, args.activation_checkpointing_offload)
+
+    if args.chunked_cross_entropy: ## The full logits are still needed for entropy maximization, softmax distillation and averaging the softmaxes of multiple sources.
+        model.skip_lm_logits_in_training = args.max_ent_weight == -1 and not (args.distillation and "cross_entropy" in args.distillation_styles.split(",")) and model.config.multi_source_method != "average_softmaxes"
+        print("Computing the cross entropy loss in chunks of", args.cross_entropy_chunk_size, "tokens.", "The full logits will not be computed." if model.skip_lm_logits_in_training else "The full logits will still be computed.")
+
+    governor = BatchSizeGovernor(args, gpu, enabled=args.adaptive_batch_size) ## Splits batches that do not fit in memory into micro batches and adapts the batch size if asked to.
+    if args.adaptive_batch_size: ## Find the largest batch size that fits before DDP is in the picture.
+        probe_length = args.adaptive_batch_size_probe_length if args.adaptive_batch_size_probe_length > 0 else (args.hard_truncate_length if args.hard_truncate_length > 0 else max(args.max_src_length, args.max_tgt_length))
+        print("Finding the largest batch size that fits in memory starting from", args.batch_size, "using batches of sentences of length", probe_length)
+        governor.probe(model, probe_length, len(tok), tok.pad_token_id)
+
+    model = DistributedDataParallel(model, device_ids=[gpu], output_device=gpu, bucket_cap_mb=args.ddp_bucket_cap_mb) ## This wrapper around the model will enable distributed training.
+    if args.ddp_comm_hook != "none":
+        print("Gradients will be compressed with the", args.ddp_comm_hook, "communication hook before being all-reduced.")
+        register_ddp_comm_hook(model, args)
     
     no_decay = ["bias", "LayerNorm.weight"]
     optimizer_grouped_parameters = [
@@ -196,7 +218,10 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         },
     ] ## We suppose that weight decay will be used except for biases and layer norm weights.
     
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.lr, eps=1e-09) ## Our glorious optimizer.
+    if args.shard_optimizer_state: ## Each process only keeps the AdamW state for its share of the parameters.
+        optimizer = ShardedAdamW(optimizer_grouped_parameters, rank=rank, world_size=args.world_size, lr=args.lr, eps=1e-09)
+    else:
+        optimizer = AdamW(optimizer_grouped_parameters, lr=args.lr, eps=1e-09) ## Our glorious optimizer.
     
     model.train()
     scheduler = get_linear_schedule_with_warmup(optimizer, args.warmup_steps, args.num_batches) ## A warmup and decay scheduler. We use the linear scheduler for now. TODO: Enable other schedulers with a flag.
@@ -210,7 +235,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         dist.barrier()
         # configure map_location properly
         map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
-        checkpoint_dict = torch.load(args.pretrained_model, map_location=map_location)
+        checkpoint_dict = load_checkpoint(args.pretrained_model, map_location, shared_checkpoint_dicts)
         if type(checkpoint_dict) == dict:
             model.load_state_dict(remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), remap_layers(checkpoint_dict['model'], 4, args), args), strict=True if (args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization) else False)
             if not args.no_reload_optimizer_ctr_and_scheduler and args.remap_encoder is '' and args.remap_decoder is '' and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization: ## Do not load optimizers, ctr and schedulers when remapping or resuming training.
@@ -234,6 +259,8 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         else:
             print("Training from scratch")
         CHECKPOINT_PATH = args.model_path
+        if args.shard_optimizer_state: ## Every process has to take part in gathering the sharded optimizer state before rank 0 saves it.
+            optimizer.consolidate_state_dict()
         if rank == 0:
             checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': 0}
             torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
@@ -255,7 +282,13 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         print("Doing entropy maximization during loss computation.")
     if args.multistep_optimizer_steps > 1:
         print("Using a multistep optimizer where gradients will be accumulated over", args.multistep_optimizer_steps, "batches.")
+    if args.accumulation_target_tokens > 0:
+        print("Gradients will be accumulated till there are at least", args.accumulation_target_tokens, "target tokens per optimizer step over all processes. The loss will be normalized by the number of target tokens.")
+    profiler = StepProfiler(args, rank, True, args.profile_dir if args.profile_dir is not None else args.model_path+".profile", writer if rank == 0 else None) ## Profiles a range of optimizer steps if asked to.
+    metrics = TrainingMetrics(writer if rank == 0 else None, args.log_every, gpu, enabled=rank % 8 == 0) ## Losses and throughput are logged every log_every steps by a background thread so that the GPU never waits for logging. Only the master/prime processes print.
     num_batches_this_optimizer_step = 0
+    target_tokens_this_optimizer_step = 0
+    global_target_tokens_this_optimizer_step = 0
     losses = 0
     global_sbleu_history = [] ## To save the global evaluation metric history.
     max_global_sbleu = 0 ## Maximum global evaluation metric score.
@@ -266,116 +299,82 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
     curr_eval_step = 0
     annealing_attempt = 0 ## We use this to limit the number of times annealing will take place. When we anneal the LR is divided by a factor. How this is achieved will be explained below.
     inps = {dev_pair: [inpline.strip() for inpline in open(dev_files[dev_pair][0])][:args.max_eval_batches*args.dev_batch_size] for dev_pair in dev_files} ## Get all inputs for each pair. Select up to args.max_eval_batches*args.dev_batch_size examples.
-    if args.is_summarization: ## Slight data structure difference for summarization vs translation when computing the evaluation metric. For summarization the metric is Rouge.
-        refs = {dev_pair: [[refline.strip() for refline in open(dev_files[dev_pair][1])][:args.max_eval_batches*args.dev_batch_size]] for dev_pair in dev_files} ## Get all references for each input. Select up to args.max_eval_batches*args.dev_batch_size examples.
-        scores = {dev_pair: 0 for dev_pair in dev_files} ## The rouge scorer works at the sentence level so we have to add all individual scores per sentence and this dictionary keeps track of the score. This dictionary may not be needed.
-    else:
-        refs = {dev_pair: [[refline.strip() for refline in open(dev_files[dev_pair][1])][:args.max_eval_batches*args.dev_batch_size]] for dev_pair in dev_files} ## Get all references for each input. Select up to args.max_eval_batches*args.dev_batch_size examples.
+    refs = {dev_pair: [[refline.strip() for refline in open(dev_files[dev_pair][1])][:args.max_eval_batches*args.dev_batch_size]] for dev_pair in dev_files} ## Get all references for each input. Select up to args.max_eval_batches*args.dev_batch_size examples.
+    if rank == 0 and not args.no_eval: ## The dev sets are tokenized and batched once here instead of at every evaluation.
+        eval_batches = {dev_pair: cache_eval_batches(tok, args, inps[dev_pair], get_dev_pair_languages(dev_pair, args)[0]) for dev_pair in dev_files}
+        if args.async_evaluation: ## Evaluation is done by a separate process so that training does not have to wait for it.
+            print("Dev set(s) will be evaluated asynchronously on", args.async_evaluation_device)
+            evaluator = AsyncEvaluator(model.module, tok, args, dev_files, eval_batches, refs)
+        else:
+            scorer = DevSetScorer(args, args.eval_scoring_workers)
+            detokenizer = DetokenizationPipeline(tok, args.no_skip_special_tokens, args.detokenization_workers)
     
     start = time.time()
     
-    for input_ids, input_masks, decoder_input_ids, labels in generate_batches_bilingual(tok, args, train_files, rank): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked.
-        if ctr % args.eval_every == 0 and num_batches_this_optimizer_step == 0: ## We have to evaluate our model every eval_every steps.
+    for input_ids, input_masks, decoder_input_ids, labels in metrics.timed_batches(profiler.spanned_batches(governor.batches(generate_batches_bilingual(tok, args, train_files, rank)))): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked.
+        if ctr % args.eval_every == 0 and num_batches_this_optimizer_step == 0 and not governor.is_micro_batch: ## We have to evaluate our model every eval_every steps.
             CHECKPOINT_PATH = args.model_path
+            if args.shard_optimizer_state: ## Every process has to take part in gathering the sharded optimizer state before rank 0 saves it.
+                optimizer.consolidate_state_dict()
             if rank == 0: ## Evaluation will be done only on the prime/master process which is at rank 0. Other processes will sleep.
                 if not args.no_eval: ## If we dont care about early stopping and only on training for a bazillion batches then you can save time by skipping evaluation.
-                    print("Running eval on dev set(s)")
-                    if args.mixed_wait_k:
-                        model.module.config.wait_k = args.wait_k
-                    hyp = {dev_pair: [] for dev_pair in dev_files}
-                    sbleus = {}
-                    model.eval() ## We go to eval mode so that there will be no dropout.
+                    profiler.begin("eval")
                     checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr} ## This training state will be saved.
-                    for dev_pair in dev_files: ## For each evaluation pair we will decode and compute scores.
-                        slangtlang =dev_pair.strip().split("-")
-                        if args.multi_source: ## In case we do multisource NMT
-                            slang=slangtlang[0]+"-"+slangtlang[1] ## This will be split in the generate_batches_eval function as we expect a triplet. 
-                            tlang=slangtlang[2]
-                        else:
-                            slang=slangtlang[0]
-                            tlang=slangtlang[1]
-                        eval_batch_counter = 0
-                        for dev_input_ids, dev_input_masks in generate_batches_eval_bilingual(tok, args, inps[dev_pair], slang):
-                            if args.multi_source:
-                                dev_input_ids_parent = dev_input_ids[1]
-                                dev_input_ids = dev_input_ids[0]
-                                dev_input_masks_parent = dev_input_masks[1]
-                                dev_input_masks = dev_input_masks[0]
-                                dev_input_ids_parent = dev_input_ids_parent.to(gpu) ## Move to GPU.
-                                dev_input_masks_parent = dev_input_masks_parent.to(gpu) ## Move to GPU.
-                                
-                            start = time.time()
-                            dev_input_ids = dev_input_ids.to(gpu) ## Move to GPU.
-                            dev_input_masks = dev_input_masks.to(gpu) ## Move to GPU.
-                            if args.is_summarization: ## Things can be slow so best show progress
-                                print("Decoding batch from a pool of", len(inps[dev_pair]), "examples")
-                            with torch.no_grad(): ## torch.no_grad is apparently known to prevent the code from allocating memory for gradient computation in addition to making things faster. I have not verified this but have kept it as a safety measure to ensure that my model is not being directly tuned on the development set.
-                                translations = model.module.generate(dev_input_ids, use_cache=True, num_beams=1, max_length=int((len(dev_input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(dev_input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=dev_input_masks, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([tlang if args.use_official_pretrained else "<2"+tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, additional_input_ids=dev_input_ids_parent if args.multi_source else None, additional_input_ids_mask=dev_input_masks_parent if args.multi_source else None) ## We translate the batch.
-                            dev_input_ids = dev_input_ids.to('cpu') ## Move to cpu. Not needed but its a safe step.
-                            dev_input_masks = dev_input_masks.to('cpu') ## Move to cpu. Not needed but its a safe step.
-                            translations=translations.to('cpu') ## Move to cpu. Not needed but its a safe step.
-                            if args.multi_source:
-                                dev_input_ids_parent = dev_input_ids_parent.to('cpu') ## Move to cpu. Not needed but its a safe step.
-                                dev_input_masks_parent = dev_input_masks_parent.to('cpu') ## Move to cpu. Not needed but its a safe step.
-                            for translation in translations:
-                                translation  = tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) ### Get the raw sentences.
-                                hyp[dev_pair].append(translation)
-                        if args.use_rouge: ## Get the evaluation metric score.
-                            for curr_ref, curr_pred in zip(refs[dev_pair][0], hyp[dev_pair]):
-                                score = scorer.score(curr_ref, curr_pred)
-                                scores[dev_pair] += score['rougeL'].fmeasure
-                            sbleu = scores[dev_pair]/len(hyp[dev_pair])
-                            metric = 'Rouge'
-                        else:
-                            sbleu = get_sacrebleu(refs[dev_pair], hyp[dev_pair])
-                            metric = 'BLEU'
-                        individual_sbleu_history[dev_pair].append([sbleu, ctr]) ## Update the score history for this pair.
-                        sbleus[dev_pair] = sbleu
-                        print(metric, "score using sacrebleu after", ctr, "iterations is", sbleu, "for language pair", dev_pair)
-                        writer.add_scalar(dev_pair+" bleu/rouge", sbleu, ctr)
-                        if sbleu > max_individual_sbleu[dev_pair]: ## Update the best score and step number. If the score has improved then save a model copy for this pair. Although we will stop on the global score (average across scores over all pairs) we save these models if we want a model that performs the best on a single pair.
-                            max_individual_sbleu[dev_pair] = sbleu
-                            max_individual_sbleu_step[dev_pair] = curr_eval_step
-                            print("New peak reached for", dev_pair,". Saving.")
-                            if args.save_intermediate_checkpoints:
-                                torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr))
-                                torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr)+".pure_model") ## Pure model without any ddp markers or optimizer info.
-                            else:
-                                torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu."+dev_pair)
-                                torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+".pure_model") ## Pure model without any ddp markers or optimizer info.
-                    ## Global stats
-                    sbleu = sum(sbleus.values())/len(sbleus) ## The global score.
-                    global_sbleu_history.append([sbleu, ctr]) ## Update the global score history.
-                    print("Global", metric, "score using sacrebleu after", ctr, "iterations is:", sbleu)
-                    writer.add_scalar("global bleu/rouge", sbleu, ctr)
-                    if sbleu > max_global_sbleu: ## Update the best score and step number. If this has improved then save a copy for the model. Note that this model MAY NOT be the model that gives the best performance for all pairs.
-                        max_global_sbleu = sbleu
-                        max_global_sbleu_step = curr_eval_step
-                        print("New peak reached. Saving.")
-                        if args.save_intermediate_checkpoints:
-                            torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr))
-                            torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr)+".pure_model") ## Pure model without any ddp markers or optimizer info.
-                        else:
-                            torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu.global")
-                            torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu.global.pure_model") ## Pure model without any ddp markers or optimizer info.
-                    if curr_eval_step - max_global_sbleu_step > (args.early_stop_checkpoints + annealing_attempt*args.additional_early_stop_checkpoints_per_anneal_step): ## If the global scores have not improved for more than early_stop_checkpoints + some additional checkpoints to wait for till annealing is done then we stop training.
-                        if annealing_attempt < args.max_annealing_attempts: ## We will only downscale the LR a fixed number of times. Each time we downscale the number of checkpoints to wait for declaring convergence will increase by a fixed value.
-                            annealing_attempt += 1
-                            curr_lr = scheduler.get_lr()[0]
-                            print("LR before annealing is:", curr_lr)
-                            while scheduler.get_lr()[0] > (curr_lr/args.learning_rate_scaling): ## Currently we down scale the LR by advancing the scheduler by some steps. Now this is a bad idea because the scheduler may reach maximum number of steps where the LR is 0. However the training loop will continue and nothing will be updated. The loophole I have used is to set the maximum number of steps to a large value. Thus far I have not seen a case where this has a bad effect but users who do not trust this part of the code should not use annealing.
-                                scheduler.step()
-                            print("LR after annealing is:", scheduler.get_lr()[0])
-
-                        else: ## Convergence has been reached and we stop and report the final metrics.
-                            print("We have seemingly converged as", metric, "failed to increase for the following number of checkpoints:", args.early_stop_checkpoints+annealing_attempt*args.additional_early_stop_checkpoints_per_anneal_step, ". You may want to consider increasing the number of tolerance steps, doing additional annealing or having a lower peak learning rate or something else.")
-                            print("Terminating training")
-                            print("Global dev", metric, "history:", global_sbleu_history)
-                            print("Individual", metric, "history:", individual_sbleu_history )
-                            quit_condition[0] = -1 ## Since this is a shared variable it will be updated for all processes.
-                    curr_eval_step += 1
+                    if args.async_evaluation: ## Hand a snapshot of the model to the evaluator process and use whatever results have come back so far.
+                        snapshot_path = CHECKPOINT_PATH+".eval_snapshot."+str(ctr)
+                        torch.save(model.module.state_dict(), snapshot_path)
+                        evaluator.submit(ctr, snapshot_path)
+                        print("Handed the model after", ctr, "iterations to the evaluator.", evaluator.num_pending, "evaluations are pending.")
+                        evaluation_results = evaluator.results()
+                    else:
+                        print("Running eval on dev set(s)")
+                        if args.mixed_wait_k:
+                            model.module.config.wait_k = args.wait_k
+                        model.eval() ## We go to eval mode so that there will be no dropout.
+                        eval_start = time.time()
+                        sbleus, metric = decode_and_score_dev_sets(model.module, tok, args, dev_files, eval_batches, refs, gpu, scorer, detokenizer)
+                        evaluation_results = [(ctr, sbleus, metric, None, time.time()-eval_start)]
+                        model.train() ## Put the model back in training mode where dropout will be done.
+                    for eval_ctr, sbleus, metric, snapshot_path, eval_time in evaluation_results: ## With asynchronous evaluation these results may be for a model from a few evaluations ago.
+                        print("Evaluation of the model after", eval_ctr, "iterations took", eval_time, "seconds.")
+                        for dev_pair, sbleu in sbleus.items():
+                            individual_sbleu_history[dev_pair].append([sbleu, eval_ctr]) ## Update the score history for this pair.
+                            print(metric, "score using sacrebleu after", eval_ctr, "iterations is", sbleu, "for language pair", dev_pair)
+                            writer.add_scalar(dev_pair+" bleu/rouge", sbleu, eval_ctr)
+                            if sbleu > max_individual_sbleu[dev_pair]: ## Update the best score and step number. If the score has improved then save a model copy for this pair. Although we will stop on the global score (average across scores over all pairs) we save these models if we want a model that performs the best on a single pair.
+                                max_individual_sbleu[dev_pair] = sbleu
+                                max_individual_sbleu_step[dev_pair] = curr_eval_step
+                                print("New peak reached for", dev_pair,". Saving.")
+                                save_best_checkpoint(checkpoint_dict, model, snapshot_path, CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+("."+str(eval_ctr) if args.save_intermediate_checkpoints else ""))
+                        ## Global stats
+                        sbleu = sum(sbleus.values())/len(sbleus) ## The global score.
+                        global_sbleu_history.append([sbleu, eval_ctr]) ## Update the global score history.
+                        print("Global", metric, "score using sacrebleu after", eval_ctr, "iterations is:", sbleu)
+                        writer.add_scalar("global bleu/rouge", sbleu, eval_ctr)
+                        if sbleu > max_global_sbleu: ## Update the best score and step number. If this has improved then save a copy for the model. Note that this model MAY NOT be the model that gives the best performance for all pairs.
+                            max_global_sbleu = sbleu
+                            max_global_sbleu_step = curr_eval_step
+                            print("New peak reached. Saving.")
+                            save_best_checkpoint(checkpoint_dict, model, snapshot_path, CHECKPOINT_PATH+".best_dev_bleu.global"+("."+str(eval_ctr) if args.save_intermediate_checkpoints else ""))
+                        if snapshot_path is not None:
+                            os.remove(snapshot_path)
+                        if curr_eval_step - max_global_sbleu_step > (args.early_stop_checkpoints + annealing_attempt*args.additional_early_stop_checkpoints_per_anneal_step): ## If the global scores have not improved for more than early_stop_checkpoints + some additional checkpoints to wait for till annealing is done then we stop training.
+                            if annealing_attempt < args.max_annealing_attempts: ## We will only downscale the LR a fixed number of times. Each time we downscale the number of checkpoints to wait for declaring convergence will increase by a fixed value.
+                                annealing_attempt += 1
+                                curr_lr = scheduler.get_lr()[0]
+                                print("LR before annealing is:", curr_lr)
+                                while scheduler.get_lr()[0] > (curr_lr/args.learning_rate_scaling): ## Currently we down scale the LR by advancing the scheduler by some steps. Now this is a bad idea because the scheduler may reach maximum number of steps where the LR is 0. However the training loop will continue and nothing will be updated. The loophole I have used is to set the maximum number of steps to a large value. Thus far I have not seen a case where this has a bad effect but users who do not trust this part of the code should not use annealing.
+                                    scheduler.step()
+                                print("LR after annealing is:", scheduler.get_lr()[0])
 
-                    model.train() ## Put the model back in training mode where dropout will be done.
+                            else: ## Convergence has been reached and we stop and report the final metrics.
+                                print("We have seemingly converged as", metric, "failed to increase for the following number of checkpoints:", args.early_stop_checkpoints+annealing_attempt*args.additional_early_stop_checkpoints_per_anneal_step, ". You may want to consider increasing the number of tolerance steps, doing additional annealing or having a lower peak learning rate or something else.")
+                                print("Terminating training")
+                                print("Global dev", metric, "history:", global_sbleu_history)
+                                print("Individual", metric, "history:", individual_sbleu_history )
+                                quit_condition[0] = -1 ## Since this is a shared variable it will be updated for all processes.
+                        curr_eval_step += 1
+                    profiler.end("eval")
 
                 else: ## If no evaluation will be done then I consider it prudent to save the model every 10000 checkpoints by default. Change this to whatever value you want.
                     if ctr % args.no_eval_save_every == 0:
@@ -389,12 +388,14 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                             torch.save(model.state_dict(), CHECKPOINT_PATH+".pure_model")
                 print("Saving the model")
                 sys.stdout.flush()
+                profiler.begin("checkpoint")
                 # All processes should see same parameters as they all start from same
                 # random parameters and gradients are synchronized in backward passes.
                 # Therefore, saving it in one process is sufficient.
                 checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
                 torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
                 torch.save(model.state_dict(), CHECKPOINT_PATH+".pure_model")
+                profiler.end("checkpoint")
                 
 
             # Use a barrier() to make sure that process 1 loads the model after process
@@ -411,7 +412,8 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
             optimizer.load_state_dict(checkpoint_dict['optimizer'])
             scheduler.load_state_dict(checkpoint_dict['scheduler'])
         
-        dist.barrier()
+        if not governor.is_micro_batch: ## Every process calls this once per batch no matter how many micro batches it had to split a batch into.
+            dist.barrier()
         if args.cross_distillation or args.multi_source: ## The returned input ids and input masks are actually a list of two items each. The first item is to be fed to the parent model and the second item is to be fed to the child model.
             input_ids_parent=input_ids[1]
             input_ids=input_ids[0]
@@ -429,30 +431,109 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         input_masks=input_masks.to(gpu) ## Move to gpu
         decoder_input_ids=decoder_input_ids.to(gpu) ## Move to gpu
         labels=labels.to(gpu) ## Move to gpu
-        optimizer.zero_grad() ## Empty the gradients before any computation.
-        if rank == 0:
-            writer.add_scalar("learning rate", scheduler.get_lr()[0], ctr)
-        if args.mixed_wait_k:
-            model.module.config.wait_k = random.randint(1, args.wait_k)
+        if governor.is_micro_batch: ## Part of a batch that did not fit in memory. It belongs to the same optimizer step as that batch and its loss is weighed by its share of the target tokens.
+            micro_batch_weight = labels.ne(tok.pad_token_id).sum()/governor.split_batch_tokens
+            is_last_batch_of_optimizer_step = governor.is_last_micro_batch and governor.split_batch_was_last
+        elif args.accumulation_target_tokens > 0: ## Accumulate gradients until the number of target tokens over all processes reaches the target.
+            batch_target_tokens, global_batch_target_tokens = count_target_tokens(labels, tok.pad_token_id)
+            target_tokens_this_optimizer_step += batch_target_tokens
+            global_target_tokens_this_optimizer_step += global_batch_target_tokens
+            is_last_batch_of_optimizer_step = global_target_tokens_this_optimizer_step >= args.accumulation_target_tokens
+        else:
+            is_last_batch_of_optimizer_step = num_batches_this_optimizer_step + 1 >= args.multistep_optimizer_steps
+        set_gradient_synchronization(model, is_last_batch_of_optimizer_step and not args.adaptive_batch_size) ## Gradients are all-reduced only for the last batch of an optimizer step. The others skip the communication. With an adaptive batch size the backward pass never communicates so that running out of memory in one process does not leave the others waiting.
+        if not governor.is_micro_batch: ## Micro batches were already counted as part of their batch.
+            metrics.add_batch(input_ids, input_masks, labels, tok.pad_token_id) ## Token counts for the throughput and padding ratio. These stay on the GPU.
+        backward_started = False
+        try:
+            profiler.begin("forward")
+            if num_batches_this_optimizer_step == 0 and not governor.is_micro_batch: ## Empty the gradients before the first batch of an optimizer step. The remaining batches accumulate their gradients into them.
+                optimizer.zero_grad()
             if rank == 0:
-                writer.add_scalar("mixed wait k value", model.module.config.wait_k, ctr)
+                metrics.add("learning rate", scheduler.get_lr()[0])
+            if args.mixed_wait_k:
+                model.module.config.wait_k = random.randint(1, args.wait_k)
+                if rank == 0:
+                    metrics.add("mixed wait k value", model.module.config.wait_k)
 
-        if args.fp16: ## The difference between AMP and FP32 is the use of the autocast. The code below is duplicated and can be shrunk. TODO.
-            with torch.cuda.amp.autocast():
-                mod_compute = model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, additional_input_ids=input_ids_parent if args.multi_source else None, additional_input_ids_mask=input_masks_parent if args.multi_source else None, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
+            if args.fp16: ## The difference between AMP and FP32 is the use of the autocast. The code below is duplicated and can be shrunk. TODO.
+                with torch.cuda.amp.autocast():
+                    mod_compute = model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, additional_input_ids=input_ids_parent if args.multi_source else None, additional_input_ids_mask=input_masks_parent if args.multi_source else None, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
+                    logits = mod_compute.logits
+                    with profiler.span("loss"):
+                        loss = compute_lm_loss(model, mod_compute, logits, mod_compute.lm_hidden_states, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss.
+                    loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1.
+                    if rank == 0:
+                        metrics.add("pure cross entropy loss", loss)
+                    if args.temperature_calibration: 
+                        loss = loss*mod_compute.softmax_temperature
+                        if rank == 0:
+                            metrics.add("calibrated temperature", mod_compute.softmax_temperature)
+                            metrics.add("calibrated temperature loss", loss)
+                    if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
+                        domain_classifier_logits = mod_compute.domain_classifier_logits
+                        domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
+                        domain_classifier_loss = label_smoothed_nll_loss(
+                            domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
+                        ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
+                        loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
+                        if rank == 0:
+                            metrics.add("domain classifier loss", domain_classifier_loss)
+                            metrics.add("loss with domain classifier loss", loss)
+                    ## We will do multilayer softmaxing without any consideration for entropy maximization or distillation.
+                    if mod_compute.additional_lm_logits is not None:
+                        for additional_logits, additional_hidden_states in zip(mod_compute.additional_lm_logits, mod_compute.additional_lm_hidden_states):
+                            loss_extra = compute_lm_loss(model, mod_compute, additional_logits, additional_hidden_states, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss.
+                            loss_extra = loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1. TODO: Perhaps log this too.
+                            if args.temperature_calibration: 
+                                loss_extra = loss_extra*mod_compute.softmax_temperature
+                            loss += loss_extra ## Up scale loss in case of non unitary temperatures. TODO: Perhaps log this too.
+                    if args.max_ent_weight != -1: ## This deals with softmax entropy maximization. The logic is that we compute the softmax entropy of the predictions via -(P(Y/X)*log(P(Y/X))). We then add it to the cross entropy loss with a negative sign as we wish to maximize entropy. This should penalize overconfident predictions. 
+                        assert (args.max_ent_weight >= 0 and args.max_ent_weight <= 1)
+                        logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                        if args.temperature_calibration: 
+                            logits = logits*mod_compute.softmax_temperature
+                        lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
+                        entropy = -(torch.exp(lprobs)*lprobs).mean()
+                        if rank == 0:
+                            metrics.add("softmax entropy", entropy)
+                        if mod_compute.additional_lm_logits is not None:
+                            for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
+                                additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                                if args.temperature_calibration: 
+                                    additional_logits = additional_logits*mod_compute.softmax_temperature
+                                lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
+                                entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
+                                entropy += entropy_extra
+                        loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
+                        if rank == 0:
+                            metrics.add("loss with entropy loss", loss)
+                    if args.distillation: ## Time to distill.
+                        if args.cross_distillation: ## The input ids and masks should be replaced with those appropriate for the parent.
+                            input_ids = input_ids_parent
+                            input_masks = input_masks_parent
+                        if teacher_cache is not None: ## The parent outputs were cached beforehand so the parent is not needed.
+                            distillation_loss = compute_cached_distillation_losses(mod_compute, teacher_cache.lookup(input_ids, decoder_input_ids), labels, tok.pad_token_id, args)
+                        else:
+                            parent_mod_compute = parent_model(input_ids, input_masks, decoder_input_ids) ## Get the parent model's computations.
+                            distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
+                        loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
+                        if rank == 0:
+                            metrics.add("distillation loss", distillation_loss)
+                            metrics.add("final loss", loss)
+            else:
+                mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, additional_input_ids=input_ids_parent if args.multi_source else None, additional_input_ids_mask=input_masks_parent if args.multi_source else None, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
                 logits = mod_compute.logits
-                lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
-                loss = label_smoothed_nll_loss(
-                    lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                ) ## Label smoothed cross entropy loss.
-                loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1.
+                with profiler.span("loss"):
+                    loss = compute_lm_loss(model, mod_compute, logits, mod_compute.lm_hidden_states, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss.
+                loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
                 if rank == 0:
-                    writer.add_scalar("pure cross entropy loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("pure cross entropy loss", loss)
                 if args.temperature_calibration: 
                     loss = loss*mod_compute.softmax_temperature
                     if rank == 0:
-                        writer.add_scalar("calibrated temperature", mod_compute.softmax_temperature.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("calibrated temperature loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("calibrated temperature", mod_compute.softmax_temperature)
+                        metrics.add("calibrated temperature loss", loss)
                 if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
                     domain_classifier_logits = mod_compute.domain_classifier_logits
                     domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -461,15 +542,12 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                     ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
                     loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
                     if rank == 0:
-                        writer.add_scalar("domain classifier loss", domain_classifier_loss.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("loss with domain classifier loss", loss.detach().cpu().numpy(), ctr)
-                ## We will do multilayer softmaxing without any consideration for entropy maximization or distillation.
+                        metrics.add("domain classifier loss", domain_classifier_loss)
+                        metrics.add("loss with domain classifier loss", loss)
+                ## We will do multilayer softmaxing without any consideration for distillation or domain classification.
                 if mod_compute.additional_lm_logits is not None:
-                    for additional_logits in mod_compute.additional_lm_logits:
-                        lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## Softmax tempering of logits if needed.
-                        loss_extra = label_smoothed_nll_loss(
-                            lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                        ) ## Label smoothed cross entropy loss.
+                    for additional_logits, additional_hidden_states in zip(mod_compute.additional_lm_logits, mod_compute.additional_lm_hidden_states):
+                        loss_extra = compute_lm_loss(model, mod_compute, additional_logits, additional_hidden_states, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss.
                         loss_extra = loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1. TODO: Perhaps log this too.
                         if args.temperature_calibration: 
                             loss_extra = loss_extra*mod_compute.softmax_temperature
@@ -482,7 +560,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                     lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
                     entropy = -(torch.exp(lprobs)*lprobs).mean()
                     if rank == 0:
-                        writer.add_scalar("softmax entropy", entropy.detach().cpu().numpy(), ctr)
+                        metrics.add("softmax entropy", entropy)
                     if mod_compute.additional_lm_logits is not None:
                         for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
                             additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
@@ -493,127 +571,93 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                             entropy += entropy_extra
                     loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
                     if rank == 0:
-                        writer.add_scalar("loss with entropy loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("loss with entropy loss", loss)
                 if args.distillation: ## Time to distill.
                     if args.cross_distillation: ## The input ids and masks should be replaced with those appropriate for the parent.
                         input_ids = input_ids_parent
                         input_masks = input_masks_parent
-                    with torch.no_grad(): ## No gradient to avoid memory allocation.
-                        parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation) ## Get the parent model's computations.
-                    distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
+                    if teacher_cache is not None: ## The parent outputs were cached beforehand so the parent is not needed.
+                        distillation_loss = compute_cached_distillation_losses(mod_compute, teacher_cache.lookup(input_ids, decoder_input_ids), labels, tok.pad_token_id, args)
+                    else:
+                        parent_mod_compute = parent_model(input_ids, input_masks, decoder_input_ids) ## Get the parent model's computations.
+                        distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
                     loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
                     if rank == 0:
-                        writer.add_scalar("distillation loss", distillation_loss.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("final loss", loss.detach().cpu().numpy(), ctr)
-        else:
-            mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, additional_input_ids=input_ids_parent if args.multi_source else None, additional_input_ids_mask=input_masks_parent if args.multi_source else None, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
-            logits = mod_compute.logits
-            lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
-            loss = label_smoothed_nll_loss(
-                lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-            ) ## Label smoothed cross entropy loss.
-            loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
-            if rank == 0:
-                writer.add_scalar("pure cross entropy loss", loss.detach().cpu().numpy(), ctr)
-            if args.temperature_calibration: 
-                loss = loss*mod_compute.softmax_temperature
-                if rank == 0:
-                    writer.add_scalar("calibrated temperature", mod_compute.softmax_temperature.detach().cpu().numpy(), ctr)
-                    writer.add_scalar("calibrated temperature loss", loss.detach().cpu().numpy(), ctr)
-            if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
-                domain_classifier_logits = mod_compute.domain_classifier_logits
-                domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
-                domain_classifier_loss = label_smoothed_nll_loss(
-                    domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
-                ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
-                loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
-                if rank == 0:
-                    writer.add_scalar("domain classifier loss", domain_classifier_loss.detach().cpu().numpy(), ctr)
-                    writer.add_scalar("loss with domain classifier loss", loss.detach().cpu().numpy(), ctr)
-            ## We will do multilayer softmaxing without any consideration for distillation or domain classification.
-            if mod_compute.additional_lm_logits is not None:
-                for additional_logits in mod_compute.additional_lm_logits:
-                    lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## Softmax tempering of logits if needed.
-                    loss_extra = label_smoothed_nll_loss(
-                        lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                    ) ## Label smoothed cross entropy loss.
-                    loss_extra = loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1. TODO: Perhaps log this too.
-                    if args.temperature_calibration: 
-                        loss_extra = loss_extra*mod_compute.softmax_temperature
-                    loss += loss_extra ## Up scale loss in case of non unitary temperatures. TODO: Perhaps log this too.
-            if args.max_ent_weight != -1: ## This deals with softmax entropy maximization. The logic is that we compute the softmax entropy of the predictions via -(P(Y/X)*log(P(Y/X))). We then add it to the cross entropy loss with a negative sign as we wish to maximize entropy. This should penalize overconfident predictions. 
-                assert (args.max_ent_weight >= 0 and args.max_ent_weight <= 1)
-                logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                if args.temperature_calibration: 
-                    logits = logits*mod_compute.softmax_temperature
-                lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
-                entropy = -(torch.exp(lprobs)*lprobs).mean()
-                if rank == 0:
-                    writer.add_scalar("softmax entropy", entropy.detach().cpu().numpy(), ctr)
-                if mod_compute.additional_lm_logits is not None:
-                    for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
-                        additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                        if args.temperature_calibration: 
-                            additional_logits = additional_logits*mod_compute.softmax_temperature
-                        lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
-                        entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
-                        entropy += entropy_extra
-                loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
-                if rank == 0:
-                    writer.add_scalar("loss with entropy loss", loss.detach().cpu().numpy(), ctr)
-            if args.distillation: ## Time to distill.
-                if args.cross_distillation: ## The input ids and masks should be replaced with those appropriate for the parent.
-                    input_ids = input_ids_parent
-                    input_masks = input_masks_parent
-                with torch.no_grad(): ## No gradient to avoid memory allocation.
-                    parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation) ## Get the parent model's computations.
-                distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
-                loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
-                if rank == 0:
-                    writer.add_scalar("distillation loss", distillation_loss.detach().cpu().numpy(), ctr)
-                    writer.add_scalar("final loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("distillation loss", distillation_loss)
+                        metrics.add("final loss", loss)
 
-        input_ids=input_ids.to('cpu') ## Move to CPU. May not be needed but its a safety net.
-        input_masks=input_masks.to('cpu') ## Move to CPU. May not be needed but its a safety net.
-        decoder_input_ids=decoder_input_ids.to('cpu') ## Move to CPU. May not be needed but its a safety net.
-        labels=labels.to('cpu') ## Move to CPU. May not be needed but its a safety net.
-        if args.cross_distillation or args.multi_source:
-            input_ids_parent=input_ids_parent.to('cpu') ## Move to CPU. May not be needed but its a safety net.
-            input_masks_parent=input_masks_parent.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+            input_ids=input_ids.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+            input_masks=input_masks.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+            decoder_input_ids=decoder_input_ids.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+            labels=labels.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+            if args.cross_distillation or args.multi_source:
+                input_ids_parent=input_ids_parent.to('cpu') ## Move to CPU. May not be needed but its a safety net.
+                input_masks_parent=input_masks_parent.to('cpu') ## Move to CPU. May not be needed but its a safety net.
         
-        ## Optimization part of the model from this point forward.
-        if args.fp16: ## The gradient scaler needs to be invoked with FP16/AMP computation. ## With FP16/AMP computation we need to unscale gradients before clipping them. We then optimize and update the scaler.
-            loss = loss/args.multistep_optimizer_steps
-            scaler.scale(loss).backward()
+            metrics.add_time("forward", profiler.end("forward"))
+            ## Optimization part of the model from this point forward.
+            if governor.is_micro_batch:
+                loss = loss*micro_batch_weight
+            if args.accumulation_target_tokens > 0:
+                loss = loss*batch_target_tokens ## The per token loss is turned into a sum over tokens. The gradients are divided by the total number of tokens just before the optimizer step.
+            else:
+                loss = loss/args.multistep_optimizer_steps
+            profiler.begin("backward")
+            backward_started = True
+            if args.fp16: ## The gradient scaler needs to be invoked with FP16/AMP computation.
+                scaler.scale(loss).backward()
+            else:
+                loss.backward()
+            metrics.add_time("backward", profiler.end("backward"))
+        except RuntimeError as e: ## With an adaptive batch size, a batch that does not fit in memory is split into micro batches which are processed next.
+            if not args.adaptive_batch_size or not is_out_of_memory_error(e):
+                raise
+            mod_compute = logits = loss = lprobs = entropy = None ## Drop the references to the activations so that their memory can be freed.
+            profiler.close_open_spans()
+            governor.recover_from_oom(optimizer, labels, tok.pad_token_id, is_last_batch_of_optimizer_step, backward_started)
+            continue
+        if not governor.is_micro_batch or governor.is_last_micro_batch: ## A batch split into micro batches counts as one batch.
             num_batches_this_optimizer_step += 1
-            losses += loss
-            if num_batches_this_optimizer_step < args.multistep_optimizer_steps:
-                continue
+        losses += loss.detach()
+        if not is_last_batch_of_optimizer_step:
+            continue
+        if governor.skip_optimizer_step(): ## Some process lost gradients of this optimizer step by running out of memory in the backward pass so all processes throw the step away to stay in sync.
+            print("Skipping the optimizer step since a process ran out of memory in the backward pass.")
+            optimizer.zero_grad()
+            losses = 0
+            num_batches_this_optimizer_step = 0
+            target_tokens_this_optimizer_step = 0
+            global_target_tokens_this_optimizer_step = 0
+            continue
+        profiler.begin("optimizer")
+        if args.adaptive_batch_size: ## DDP did not all-reduce the gradients in the backward pass so we do it here.
+            allreduce_gradients(model, args.world_size, args.ddp_bucket_cap_mb)
+        if args.accumulation_target_tokens > 0: ## DDP averages the gradients over processes so we multiply by the world size to get the sum and then normalize by the number of tokens.
+            scale_gradients(model, args.world_size/global_target_tokens_this_optimizer_step)
+        if args.fp16: ## With FP16/AMP computation we need to unscale gradients before clipping them. We then optimize and update the scaler.
             if args.max_gradient_clip_value != 0.0:
                 scaler.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_gradient_clip_value)
             scaler.step(optimizer)
             scaler.update()
-        else: ## With FP32, we just do regular backpropagation, gradient clipping and then step the optimizer.
-            loss = loss/args.multistep_optimizer_steps
-            loss.backward()
-            num_batches_this_optimizer_step += 1
-            losses += loss
-            if num_batches_this_optimizer_step < args.multistep_optimizer_steps:
-                continue
+        else: ## With FP32, we just do regular gradient clipping and then step the optimizer.
             if args.max_gradient_clip_value != 0.0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_gradient_clip_value)
             optimizer.step()
         scheduler.step() ## Advance the scheduler to get to the next value of LR.
-        lv = losses.detach().cpu().numpy() ## Detach the loss in order to report it.
+        metrics.add_time("optimizer", profiler.end("optimizer"))
+        if args.accumulation_target_tokens > 0:
+            losses = losses/target_tokens_this_optimizer_step ## Report the per token loss for this process.
+        metrics.add("training loss", losses) ## This is printed by the metrics thread every log_every batches.
         losses = 0
         num_batches_this_optimizer_step = 0
-        if ctr % 100 == 0 and rank  % 8 == 0: ## Print the current loss every 10 batches but only for the master/prime process.
-            end = time.time()
-            print(ctr, lv, end-start, "seconds for 100 batches")
-            start = time.time()
-            sys.stdout.flush()
-        
+        target_tokens_this_optimizer_step = 0
+        global_target_tokens_this_optimizer_step = 0
+        if args.adaptive_batch_size:
+            metrics.add("batch size", args.batch_size)
+            governor.step()
+        metrics.step(ctr)
+        profiler.step()
         if ctr % args.eval_every == 0 and rank == 0 and args.save_weights_and_gradeint_info: ## Save the model weight and gradient info every time this condition is triggered.
             for param_name, param_value in model.named_parameters():
                 if not ("embed_positions" in param_name and args.positional_encodings):
@@ -622,6 +666,28 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
                 
         ctr += 1
     
+    if args.shard_optimizer_state: ## Every process has to take part in gathering the sharded optimizer state before rank 0 saves it.
+        optimizer.consolidate_state_dict()
+    if rank == 0 and not args.async_evaluation and not args.no_eval:
+        scorer.close()
+        detokenizer.close()
+    if rank == 0 and args.async_evaluation and not args.no_eval: ## Wait for the evaluations that are still pending. Training is over so they only matter for picking the best models.
+        for eval_ctr, sbleus, metric, snapshot_path, eval_time in evaluator.close():
+            sbleu = sum(sbleus.values())/len(sbleus) ## The global score.
+            global_sbleu_history.append([sbleu, eval_ctr])
+            print("Global", metric, "score using sacrebleu after", eval_ctr, "iterations is:", sbleu, "The scores for each pair are:", sbleus)
+            for dev_pair, pair_sbleu in sbleus.items():
+                individual_sbleu_history[dev_pair].append([pair_sbleu, eval_ctr])
+                if pair_sbleu > max_individual_sbleu[dev_pair]:
+                    max_individual_sbleu[dev_pair] = pair_sbleu
+                    max_individual_sbleu_step[dev_pair] = curr_eval_step
+                    save_best_checkpoint(None, None, snapshot_path, args.model_path+".best_dev_bleu."+dev_pair+("."+str(eval_ctr) if args.save_intermediate_checkpoints else ""))
+            if sbleu > max_global_sbleu:
+                max_global_sbleu = sbleu
+                max_global_sbleu_step = curr_eval_step
+                save_best_checkpoint(None, None, snapshot_path, args.model_path+".best_dev_bleu.global"+("."+str(eval_ctr) if args.save_intermediate_checkpoints else ""))
+            os.remove(snapshot_path)
+            curr_eval_step += 1
     if rank == 0:
         CHECKPOINT_PATH = args.model_path
         print("Saving the model after the final step")
@@ -634,6 +700,8 @@ def model_create_load_run_save(gpu, args, train_files, dev_files, quit_condition
         torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save one last time.
         torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model") ## Pure model without any ddp markers or optimizer info.
     dist.barrier() ## Wait till all processes reach this point so that the prime process saves the final checkpoint.
+    metrics.close() ## Log whatever is still queued.
+    profiler.close()
     dist.destroy_process_group() ## Everything that has a beginning has an end, Neo!
     
 
@@ -661,7 +729,7 @@ def run_demo():
                         help='Should we scale embeddings?')
     parser.add_argument('--no_scale_attention_embedding', action='store_true', 
                         help='Should we scale attention embeddings?')
-    parser.add_argument('--multistep_optimizer_steps', default=1, type=int, help="In case you want to simulate a larger batch you should set this to a higher value.")
+    parser.add_argument('--multistep_optimizer_steps', default=1, type=int, help="In case you want to simulate a larger batch you should set this to a higher value. Gradients are all-reduced across GPUs only for the last of these batches.")
     parser.add_argument('--encoder_layers', default=6, type=int, help="The value for number of encoder layers")
     parser.add_argument('--decoder_layers', default=6, type=int, help="The value for number of decoder layers")
     parser.add_argument('--label_smoothing', default=0.1, type=float, help="The value for label smoothing")
@@ -841,7 +909,96 @@ def run_demo():
     ### Placeholder flags to prevent code from breaking. These flags are not intended to be used for fine tuning. These flags are here because the common_utils.py methods assume the existence of these args for when joint mbart training and regular NMT training is done. TODO: Modify code to avoid the need for these flags in this script.
     parser.add_argument('--unify_encoder', action='store_true', 
                         help='Should we minimize the encoder representation distances instead of regular cross entropy minimization on the parallel corpus?')
+    parser.add_argument('--fast_checkpoint_loading', action='store_true', 
+                        help='Should we load checkpoints faster and with less memory? The checkpoints are loaded once on the CPU by the launching process and shared with all the local processes via shared memory instead of being loaded onto every GPU by every process. Furthermore, the random initialization of the model is skipped whenever the checkpoint overwrites all the parameters (no layer remapping, component elimination or embedding remapping).')
+    parser.add_argument('--chunked_cross_entropy', action='store_true', 
+                        help='Should we compute the label smoothed cross entropy loss from the decoder states and the lm_head weight a few tokens at a time? The [batch, target length, vocabulary] logits and log probabilities, which are the biggest activations when the vocabulary is large, are never materialized. The loss and gradients are the same as the regular loss. This applies to the multilayer softmaxes too. If entropy maximization or cross entropy distillation is used then the logits are still computed for those but the loss is computed in chunks.')
+    parser.add_argument('--cross_entropy_chunk_size', type=int, default=1024, 
+                        help='The number of target tokens processed at a time by --chunked_cross_entropy. The memory needed is roughly this times the vocabulary size times 8 bytes. Smaller values save memory but may be slower.')
+    parser.add_argument('--chunked_distillation', action='store_true', 
+                        help='Should we compute the cross_entropy distillation loss a few tokens at a time? The regular implementation holds several [batch, target length, vocabulary] tensors at once which makes distillation batches much smaller than regular training batches. The loss and gradients are the same as the regular loss. See benchmark_distillation_memory.py for the maximum batch sizes with and without it.')
+    parser.add_argument('--distillation_chunk_size', type=int, default=1024, 
+                        help='The number of target tokens processed at a time by --chunked_distillation.')
+    parser.add_argument('--distillation_top_k', type=int, default=0, 
+                        help='If more than 0 then the cross_entropy distillation loss only uses the top-k tokens of the parent distribution which is renormalized over them. Implies --chunked_distillation. The default of 0 uses the whole vocabulary.')
+    parser.add_argument('--teacher_cache_path', default=None, type=str, 
+                        help='Should we do offline distillation? If this is set along with --distillation then the parent outputs are read from the cache with this prefix instead of running the parent model for every batch. The cache must be created first by running with the same data, parent and number of processes as well as --dump_teacher_outputs. Only the cross_entropy (with the parent top-k tokens) and hidden_layer_regression (decoder only) styles are supported. Source masking and stochastic tokenization are not supported since they make the parent inputs random.')
+    parser.add_argument('--dump_teacher_outputs', action='store_true', 
+                        help='Should we only run the parent over the training data and save its outputs to --teacher_cache_path? Each process writes the outputs for its shard of the training data and then the script quits.')
+    parser.add_argument('--teacher_cache_top_k', default=32, type=int, 
+                        help='The number of the most likely tokens of the parent whose ids and log probabilities are cached for each target token.')
+    parser.add_argument('--teacher_cache_dump_batch_size', default=64, type=int, 
+                        help='The number of sentences per batch when dumping the parent outputs.')
+    parser.add_argument('--parent_precision', default='fp32', type=str, choices=['fp32', 'fp16', 'bf16', 'int8'], 
+                        help='The precision in which the parent model runs during distillation. fp16 and bf16 halve the memory and time needed for the parent. bf16 needs a GPU and a version of pytorch that support it. int8 uses dynamic quantization which only works on the CPU so the parent runs on the CPU. This saves GPU memory but is slow.')
+    parser.add_argument('--accumulation_target_tokens', default=0, type=int, 
+                        help='If more than 0 then gradients are accumulated over as many batches as needed to reach this many (non padding) target tokens over all GPUs before the optimizer is stepped. This gives optimizer steps of the same size irrespective of the sentence lengths in the batches. The loss is summed over tokens and the gradients are divided by the total number of target tokens. This overrides --multistep_optimizer_steps. Note that the number of tokens has to be all-reduced after each batch but this is a single number.')
+    parser.add_argument('--ddp_comm_hook', default='none', type=str, choices=['none', 'fp16', 'bf16', 'powersgd', 'batched_powersgd'], 
+                        help='How should gradients be compressed before they are all-reduced across GPUs? This matters for multi-node training over slow networks where the all-reduce of the fp32 gradients, especially those of the big embedding and feed forward layers, takes most of the time. fp16 and bf16 halve the bytes sent. powersgd sends low rank approximations of each gradient matrix and uses error feedback to make up for the approximation error. powersgd and batched_powersgd cannot be used with --fp16. batched_powersgd compresses each whole gradient bucket as one square matrix which is faster but less accurate. fp16 needs pytorch 1.7, powersgd needs 1.8 and bf16 needs 1.10 with NCCL 2.10. See benchmark_ddp_comm_hooks.py.')
+    parser.add_argument('--powersgd_rank', default=1, type=int, 
+                        help='The rank of the PowerSGD approximation. Higher values are more accurate but send more bytes. Usually 1 to 4 is enough.')
+    parser.add_argument('--powersgd_start_iteration', default=1000, type=int, 
+                        help='PowerSGD uses the regular all-reduce for these many iterations before it starts compressing. Compressing the gradients from the very beginning can hurt convergence.')
+    parser.add_argument('--ddp_bucket_cap_mb', default=25, type=int, 
+                        help='The size in MB of the buckets in which DDP groups gradients for all-reduce. Bigger buckets mean fewer and more efficient all-reduce calls but less overlap with the backward pass. For slow networks bigger buckets often help. For PowerSGD, larger buckets give more matrices to compress at once.')
+    parser.add_argument('--shard_optimizer_state', action='store_true', 
+                        help='Should the AdamW state be sharded across GPUs? Normally every GPU holds two fp32 moments for every parameter which is twice the memory of the model. With this flag each GPU only keeps the moments of and updates its share of the parameters after which the updated parameters are broadcast. This is ZeRO stage 1 and the memory saved can go into a bigger model or batch. Checkpoints still contain the full optimizer state in the usual format so they can be resumed with or without this flag and with a different number of GPUs.')
+    parser.add_argument('--activation_checkpointing', action='store_true', 
+                        help='Should the activations of some encoder and decoder layers be recomputed during the backward pass instead of being kept in memory? This costs roughly one extra forward pass of those layers but the memory saved can go into bigger batches. Which layers are checkpointed is decided by the next few flags. Use benchmark_activation_checkpointing.py to find the fastest setting that fits a given memory budget.')
+    parser.add_argument('--activation_checkpointing_encoder_layers', default='', type=str, 
+                        help='Comma separated indices (from 0) of the encoder layers to checkpoint or "none". If empty then every k-th layer is checkpointed where k is given by --activation_checkpointing_every_k.')
+    parser.add_argument('--activation_checkpointing_decoder_layers', default='', type=str, 
+                        help='Comma separated indices (from 0) of the decoder layers to checkpoint or "none". If empty then every k-th layer is checkpointed where k is given by --activation_checkpointing_every_k.')
+    parser.add_argument('--activation_checkpointing_every_k', default=1, type=int, 
+                        help='Checkpoint every k-th layer when the layers are not listed explicitly. 1 means all layers and 2 means every second layer which saves about half as much memory but costs half as much recomputation.')
+    parser.add_argument('--activation_checkpointing_offload', action='store_true', 
+                        help='Should the inputs of the checkpointed layers, which are the only activations they keep, be moved to pinned CPU memory till the backward pass? This saves a little more GPU memory at the cost of copies between the CPU and GPU.')
+    parser.add_argument('--log_every', default=100, type=int, 
+                        help='Losses, the learning rate and throughput statistics (tokens and sentences per second, padding ratio, time spent waiting for data and in the forward pass, backward pass and optimizer) are averaged over these many batches before they are written to tensorboard and printed. They are accumulated on the GPU and written by a background thread so the GPU never waits for logging. Setting this to 1 logs every batch.')
+    parser.add_argument('--profile_steps', default=0, type=int, 
+                        help='The number of optimizer steps to profile with the pytorch profiler. 0 means no profiling. The CPU and, if there are GPUs, the CUDA activity of these steps is saved as a chrome trace (open it in chrome://tracing or https://ui.perfetto.dev), as a tensorboard trace if the pytorch version supports it and as a table of the most expensive operators. The time spent in data generation, forward pass, loss, backward pass, optimizer, evaluation and checkpointing shows up as labelled spans in the trace. Keep this small since traces get big very quickly.')
+    parser.add_argument('--profile_start_step', default=10, type=int, 
+                        help='The optimizer step at which profiling starts. The first few steps are slow due to memory allocation and cudnn autotuning so it makes sense to skip them.')
+    parser.add_argument('--profile_dir', default=None, type=str, 
+                        help='The directory where the traces will be saved. Defaults to model_path with the suffix .profile. Point tensorboard to this directory to see the traces.')
+    parser.add_argument('--profile_rank', default=0, type=int, 
+                        help='The rank of the process to profile. Only one process is profiled.')
+    parser.add_argument('--profile_memory', action='store_true', 
+                        help='Should the profiler record the memory allocated and freed by each operator?')
+    parser.add_argument('--profile_with_stack', action='store_true', 
+                        help='Should the profiler record the python stack of each operator? This makes the traces much larger but tells you which line of code launched what.')
+    parser.add_argument('--profile_record_shapes', action='store_true', 
+                        help='Should the profiler record the shapes of the inputs of each operator? The operator table will then be grouped by input shapes.')
+    parser.add_argument('--adaptive_batch_size', action='store_true', 
+                        help='Should the batch size be adapted to the GPU memory? At the start, the largest batch size for which a batch where every sentence has the maximum length survives a forward and backward pass is found and used instead of --batch_size, which is where the search starts. If a batch still runs out of memory during training, it is split into micro batches whose gradients are accumulated, so the optimizer step stays the same, and the batch size is lowered a little. The batch size is raised again when the peak memory usage stays low. In this mode the gradients are all-reduced right before the optimizer step instead of during the backward pass so that running out of memory in one process never leaves the others waiting. This costs a bit of speed since communication no longer overlaps with the backward pass.')
+    parser.add_argument('--adaptive_batch_size_max', default=0, type=int, 
+                        help='The batch size will never be raised above this. 0 means 8 times --batch_size.')
+    parser.add_argument('--adaptive_batch_size_safety_margin', default=0.9, type=float, 
+                        help='The batch size found at the start is multiplied by this to leave some memory for fragmentation and things the probe does not account for.')
+    parser.add_argument('--adaptive_batch_size_probe_length', default=0, type=int, 
+                        help='The sentence length of the batches used to find the batch size at the start. 0 means the maximum length a batch can have given the length limits.')
+    parser.add_argument('--adaptive_batch_size_check_every', default=200, type=int, 
+                        help='Every these many optimizer steps we check if the batch size can be raised. It is raised by 10 percent if no batch ran out of memory and the peak memory usage was below --adaptive_batch_size_memory_target.')
+    parser.add_argument('--adaptive_batch_size_memory_target', default=0.8, type=float, 
+                        help='The fraction of the GPU memory below which the peak memory usage must stay for the batch size to be raised.')
+    parser.add_argument('--async_evaluation', action='store_true', 
+                        help='Should the dev set(s) be evaluated by a separate process so that training does not stop for evaluation? Every eval_every steps a snapshot of the model is saved and handed to the evaluator process which decodes and scores the dev set(s) and sends the scores back. Early stopping, annealing and saving the best models are then done with the scores that have come back so far, which may be for a model from a few evaluations ago. The best models are saved as pure models only since the optimizer state at the time of the snapshot is not kept.')
+    parser.add_argument('--async_evaluation_device', default='cpu', type=str, 
+                        help='The device the evaluator process uses. Use cpu or a spare GPU like cuda:7 that is not used for training.')
+    parser.add_argument('--async_evaluation_threads', default=0, type=int, 
+                        help='The number of CPU threads the evaluator process uses when evaluating on the CPU. 0 means the torch default. Leave enough cores for the training processes and the data loading.')
+    parser.add_argument('--async_evaluation_max_lag', default=2, type=int, 
+                        help='The maximum number of evaluations that may be pending. If the evaluator falls further behind then training waits for it so that early stopping and annealing decisions are never based on scores that are too old.')
+    parser.add_argument('--use_chrf', action='store_true', 
+                        help='Should we use chrF instead of BLEU for evaluation and early stopping? chrF is a character n-gram F-score which is more reliable than BLEU for morphologically rich languages.')
+    parser.add_argument('--eval_scoring_workers', default=0, type=int, 
+                        help='The number of processes that compute the evaluation metric. The dev pairs are scored in parallel and Rouge, which is computed sentence by sentence, is additionally split across the processes. 0 means scoring is done by the training process itself.')
+    parser.add_argument('--detokenization_workers', default=0, type=int, 
+                        help='The number of processes that detokenize the dev set translations during evaluation. Detokenization runs in the background while the next batch is being decoded. 0 means a background thread of the training process does it.')
     args = parser.parse_args()
+    if args.adaptive_batch_size:
+        assert args.ddp_comm_hook == "none", "Communication hooks only apply to the all-reduce in the backward pass which is not used with an adaptive batch size."
+    assert not (args.fp16 and "powersgd" in args.ddp_comm_hook), "PowerSGD cannot be used with --fp16. The gradients of steps which the GradScaler skips because of infs or NaNs would still end up in the PowerSGD error feedback and spoil all the later steps. Use --ddp_comm_hook fp16 or bf16 instead."
     assert len(args.token_masking_probs_range) <= 2
     print("IP address is", args.ipaddr)
     
@@ -878,7 +1035,15 @@ def run_demo():
     os.environ['MASTER_PORT'] = args.port                      #
     quit_condition = torch.ones(1) ## Create a variable to hold the quitting condition trigger
     quit_condition.share_memory_() ## Share this among all processes
-    mp.spawn(model_create_load_run_save, nprocs=args.gpus, args=(args,train_files, dev_files, quit_condition))         #
+    shared_checkpoint_dicts = None
+    if args.fast_checkpoint_loading: ## Load the checkpoints once per node and share them with all the local processes.
+        checkpoint_paths = []
+        if args.pretrained_model != "" and not args.use_official_pretrained:
+            checkpoint_paths.append(args.pretrained_model)
+        if args.distillation and not args.use_official_parent_pretrained and (args.teacher_cache_path is None or args.dump_teacher_outputs):
+            checkpoint_paths.append(args.parent_pretrained_model)
+        shared_checkpoint_dicts = load_checkpoints_in_shared_memory(checkpoint_paths)
+    mp.spawn(model_create_load_run_save, nprocs=args.gpus, args=(args,train_files, dev_files, quit_condition, shared_checkpoint_dicts))         #
     
 if __name__ == "__main__":
     run_demo()
\ No newline at end of file
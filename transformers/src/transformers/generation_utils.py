@@ -951,15 +951,27 @@ class GenerationMixin:
         # set model_kwargs
         model_kwargs["use_cache"] = use_cache
 
+        ## Modified by Raj Dabre. Start.
+        processor_encoder_input_ids, processor_bad_words_ids, processor_eos_token_id = encoder_input_ids, bad_words_ids, eos_token_id
+        if self._get_name() == "MBartForConditionalGeneration" and self.output_shortlist is not None: ## The logits are over the positions in the output shortlist so the ids which the logits processors use have to be mapped to those positions.
+            if not (is_greedy_gen_mode or is_beam_gen_mode) or prefix_allowed_tokens_fn is not None:
+                raise ValueError("An output shortlist can only be used with greedy or beam search and without prefix_allowed_tokens_fn.")
+            processor_bad_words_ids = bad_words_ids if bad_words_ids is not None else self.config.bad_words_ids
+            processor_eos_token_id = eos_token_id if eos_token_id is not None else self.config.eos_token_id
+            processor_encoder_input_ids = self.to_output_shortlist_positions(encoder_input_ids) if encoder_input_ids is not None else None
+            processor_bad_words_ids = [self.to_output_shortlist_positions(bad_word_ids).tolist() for bad_word_ids in processor_bad_words_ids] if processor_bad_words_ids is not None else None
+            processor_eos_token_id = self.to_output_shortlist_positions(processor_eos_token_id).item() if processor_eos_token_id is not None else None
+        ## Modified by Raj Dabre. End.
+
         # get distribution pre_processing samplers
         logits_processor = self._get_logits_processor( ## This should not be used for multisource models unless you modify it properly.
             repetition_penalty=repetition_penalty,
             no_repeat_ngram_size=no_repeat_ngram_size,
             encoder_no_repeat_ngram_size=encoder_no_repeat_ngram_size,
-            encoder_input_ids=encoder_input_ids,
-            bad_words_ids=bad_words_ids,
+            encoder_input_ids=processor_encoder_input_ids,
+            bad_words_ids=processor_bad_words_ids,
             min_length=min_length,
-            eos_token_id=eos_token_id,
+            eos_token_id=processor_eos_token_id,
             prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
             num_beams=num_beams,
             num_beam_groups=num_beam_groups,
@@ -1282,10 +1294,15 @@ class GenerationMixin:
                     )
 
             # pre-process distribution
-            next_tokens_scores = logits_processor(input_ids, next_token_logits)
+            ## Modified by Raj Dabre. Start.
+            output_shortlist_active = self._get_name() == "MBartForConditionalGeneration" and self.output_shortlist is not None
+            next_tokens_scores = logits_processor(self.to_output_shortlist_positions(input_ids) if output_shortlist_active else input_ids, next_token_logits) ## With an output shortlist the scores are over the shortlist positions.
+            ## Modified by Raj Dabre. End.
 
             # argmax
             next_tokens = torch.argmax(next_tokens_scores, dim=-1)
+            if output_shortlist_active: ## Modified by Raj Dabre.
+                next_tokens = self.from_output_shortlist_positions(next_tokens)
 
             # add code that transfomers next_tokens to tokens_to_add
             if eos_token_id is not None:
@@ -1735,7 +1752,10 @@ class GenerationMixin:
 
             next_token_scores = F.log_softmax(next_token_logits, dim=-1)  # (batch_size * num_beams, vocab_size)
 
-            next_token_scores = logits_processor(input_ids, next_token_scores)
+            ## Modified by Raj Dabre. Start.
+            output_shortlist_active = self._get_name() == "MBartForConditionalGeneration" and self.output_shortlist is not None
+            next_token_scores = logits_processor(self.to_output_shortlist_positions(input_ids) if output_shortlist_active else input_ids, next_token_scores) ## With an output shortlist the scores are over the shortlist positions.
+            ## Modified by Raj Dabre. End.
             next_token_scores = next_token_scores + beam_scores[:, None].expand_as(next_token_scores)
 
             # Store scores, attentions and hidden_states when required
@@ -1764,6 +1784,8 @@ class GenerationMixin:
 
             next_indices = next_tokens // vocab_size
             next_tokens = next_tokens % vocab_size
+            if output_shortlist_active: ## Modified by Raj Dabre.
+                next_tokens = self.from_output_shortlist_positions(next_tokens)
 
             # stateless
             beam_outputs = beam_scorer.process(
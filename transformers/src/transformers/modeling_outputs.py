@@ -559,6 +559,8 @@ class Seq2SeqLMOutput(ModelOutput):
     context_encoder_representations: torch.FloatTensor = None
     softmax_temperature: Optional[torch.FloatTensor] = None
     domain_classifier_logits: Optional[torch.FloatTensor] = None
+    lm_hidden_states: Optional[torch.FloatTensor] = None ## The decoder states fed to the lm_head. The chunked cross entropy loss computes the logits from these one chunk at a time.
+    additional_lm_hidden_states: Optional[Tuple[torch.FloatTensor]] = None ## The same for the multilayer softmaxing layers.
     ## Modified by Raj Dabre. End.
 
 @dataclass
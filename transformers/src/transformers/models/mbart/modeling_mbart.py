@@ -119,6 +119,34 @@ def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int]
     return inverted_mask.masked_fill(inverted_mask.bool(), -1e10) # torch.finfo(dtype).min
 
 
+def _make_segment_mask(query_segment_ids: torch.Tensor, key_segment_ids: torch.Tensor, dtype: torch.dtype, causal: bool = False):
+    """
+    Makes a `[bsz, 1, tgt_seq_len, src_seq_len]` mask for packed sequences from `[bsz, seq_len]` segment ids. A query
+    only looks at keys of its own segment and the segment id 0 is reserved for padding. Padding queries look at all
+    non padding keys just like they would with `_expand_mask` so that no row is fully masked.
+    """
+    key_is_token = key_segment_ids.ne(0)[:, None, :]
+    same_segment = query_segment_ids[:, :, None] == key_segment_ids[:, None, :]
+    allowed_mask = (same_segment | query_segment_ids.eq(0)[:, :, None]) & key_is_token
+    if causal: ## Block diagonal and lower triangular.
+        tgt_len, src_len = allowed_mask.size()[1:]
+        allowed_mask = allowed_mask & torch.ones(tgt_len, src_len, dtype=torch.bool, device=allowed_mask.device).tril()
+    inverted_mask = 1.0 - allowed_mask[:, None, :, :].to(dtype)
+
+    return inverted_mask.masked_fill(inverted_mask.bool(), -1e10)
+
+
+def _segment_position_ids(segment_ids: torch.Tensor):
+    """
+    Position ids that restart from 0 at the beginning of every packed segment. `[bsz, seq_len]` -> `[bsz, seq_len]`.
+    """
+    indices = torch.arange(segment_ids.size(1), device=segment_ids.device).unsqueeze(0).expand_as(segment_ids)
+    segment_starts = torch.ones_like(segment_ids, dtype=torch.bool)
+    segment_starts[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    start_indices = (indices * segment_starts.long()).cummax(dim=1)[0] ## The index where the current segment started.
+    return indices - start_indices
+
+
 class MBartSinusoidalPositionalEmbedding(nn.Embedding):
     """This module produces sinusoidal positional embeddings of any length."""
 
@@ -144,8 +172,10 @@ class MBartSinusoidalPositionalEmbedding(nn.Embedding):
         return out
 
     @torch.no_grad()
-    def forward(self, input_ids_shape: torch.Size, past_key_values_length: int = 0):
+    def forward(self, input_ids_shape: torch.Size, past_key_values_length: int = 0, position_ids: Optional[torch.Tensor] = None):
         """`input_ids_shape` is expected to be [bsz x seqlen]."""
+        if position_ids is not None: ## Packed sequences come with their own positions. This gives [bsz x seqlen x dim].
+            return super().forward(position_ids)
         bsz, seq_len = input_ids_shape[:2]
         positions = torch.arange(
             past_key_values_length, past_key_values_length + seq_len, dtype=torch.long, device=self.weight.device
@@ -167,8 +197,10 @@ class MBartLearnedPositionalEmbedding(nn.Embedding):
         self.offset = 2
         super().__init__(num_embeddings + self.offset, embedding_dim, padding_idx=padding_idx)
 
-    def forward(self, input_ids_shape: torch.Size, past_key_values_length: int = 0):
+    def forward(self, input_ids_shape: torch.Size, past_key_values_length: int = 0, position_ids: Optional[torch.Tensor] = None):
         """`input_ids_shape` is expected to be [bsz x seqlen]."""
+        if position_ids is not None: ## Packed sequences come with their own positions. This gives [bsz x seqlen x dim]. ## Modified by Raj Dabre.
+            return super().forward(position_ids + self.offset)
         bsz, seq_len = input_ids_shape[:2]
         positions = torch.arange(
             past_key_values_length, past_key_values_length + seq_len, dtype=torch.long, device=self.weight.device
@@ -842,6 +874,8 @@ class MBartEncoder(MBartPreTrainedModel):
 
         self.dropout = config.dropout
         self.layerdrop = config.encoder_layerdrop
+        self.checkpointed_layers = None ## With config.gradient_checkpointing, only these layer indices are checkpointed. None means all layers. ## Modified by Raj Dabre.
+        self.offload_checkpointed_activations = False ## Keep the inputs of checkpointed layers in pinned CPU memory till the backward pass. ## Modified by Raj Dabre.
 
         embed_dim = config.d_model
         self.padding_idx = config.pad_token_id
@@ -905,6 +939,7 @@ class MBartEncoder(MBartPreTrainedModel):
         features_ids=None, ### A tuple or list of feature ids. Each should have the same dimension as input_ids
         additional_input_ids=None, ## Placeholder argument. Wont be used.
         additional_input_ids_mask=None, ## Placeholder argument. Wont be used.
+        segment_ids=None, ## Segment ids of packed sequences. 0 is for padding.
     ):
         r"""
         Args:
@@ -924,6 +959,9 @@ class MBartEncoder(MBartPreTrainedModel):
                 - 0 for tokens that are **masked**.
 
                 `What are attention masks? <../glossary.html#attention-mask>`__
+            segment_ids (:obj:`torch.LongTensor` of shape :obj:`(batch_size, sequence_length)`, `optional`):
+                Segment ids when several sequences are packed into one row. Tokens only attend to tokens of the same
+                segment, positions restart for each segment and 0 indicates padding. Overrides :obj:`attention_mask`.
             head_mask (:obj:`torch.Tensor` of shape :obj:`(num_layers, num_heads)`, `optional`):
                 Mask to nullify selected heads of the attention modules. Mask values selected in ``[0, 1]``:
 
@@ -970,7 +1008,10 @@ class MBartEncoder(MBartPreTrainedModel):
             ## Modified by Raj Dabre. End.
             
 
-        embed_pos = self.embed_positions(input_shape)
+        if segment_ids is not None: ## Positions restart for each packed sequence. ## Modified by Raj Dabre.
+            embed_pos = self.embed_positions(input_shape, position_ids=_segment_position_ids(segment_ids))
+        else:
+            embed_pos = self.embed_positions(input_shape)
 
         hidden_states = inputs_embeds + embed_pos
         if not self.config.no_embed_norm:
@@ -979,7 +1020,9 @@ class MBartEncoder(MBartPreTrainedModel):
         
         ## Modified by Raj Dabre. Start.
         # expand attention_mask
-        if attention_mask is not None:
+        if segment_ids is not None: ## Block diagonal mask so that packed sequences dont see each other.
+            attention_mask = _make_segment_mask(segment_ids, segment_ids, inputs_embeds.dtype)
+        elif attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
             attention_mask = _expand_mask(attention_mask, inputs_embeds.dtype, wait_k=1 if self.config.wait_k!=-1 or self.config.unidirectional_encoder else -1) ## Raj: Just make the mask wait-k with a k=1 and we are good to go. We want to have a unidirectional encoder no matter what.
         ## Modified by Raj Dabre. End.
@@ -1000,7 +1043,7 @@ class MBartEncoder(MBartPreTrainedModel):
             if self.training and (dropout_probability < self.layerdrop):  # skip the layer
                 layer_outputs = (None, None)
             else:
-                if getattr(self.config, "gradient_checkpointing", False) and self.training:
+                if getattr(self.config, "gradient_checkpointing", False) and self.training and (self.checkpointed_layers is None or idx in self.checkpointed_layers): ## Modified by Raj Dabre. Selective checkpointing.
 
                     def create_custom_forward(module):
                         def custom_forward(*inputs):
@@ -1008,7 +1051,7 @@ class MBartEncoder(MBartPreTrainedModel):
 
                         return custom_forward
 
-                    layer_outputs = torch.utils.checkpoint.checkpoint(
+                    layer_outputs = (OffloadedCheckpointFunction.apply if self.offload_checkpointed_activations else torch.utils.checkpoint.checkpoint)(
                         create_custom_forward(encoder_layer),
                         hidden_states,
                         attention_mask,
@@ -1057,6 +1100,8 @@ class MBartDecoder(MBartPreTrainedModel):
         super().__init__(config)
         self.dropout = config.dropout
         self.layerdrop = config.decoder_layerdrop
+        self.checkpointed_layers = None ## With config.gradient_checkpointing, only these layer indices are checkpointed. None means all layers. ## Modified by Raj Dabre.
+        self.offload_checkpointed_activations = False ## Keep the inputs of checkpointed layers in pinned CPU memory till the backward pass. ## Modified by Raj Dabre.
         self.padding_idx = config.pad_token_id
         self.max_target_positions = config.max_position_embeddings
         self.embed_scale = math.sqrt(config.d_model) if config.scale_embedding else 1.0
@@ -1137,6 +1182,8 @@ class MBartDecoder(MBartPreTrainedModel):
         additional_encoder_hidden_states=None,
         additional_encoder_attention_mask=None,
         curr_decode_length=-1,
+        segment_ids=None, ## Segment ids of packed sequences. 0 is for padding.
+        encoder_segment_ids=None, ## Segment ids of the packed encoder sequences.
     ):
         r"""
         Args:
@@ -1225,13 +1272,18 @@ class MBartDecoder(MBartPreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids) * self.embed_scale
 
-        attention_mask = self._prepare_decoder_attention_mask(
-            attention_mask, input_shape, inputs_embeds, past_key_values_length
-        )
-        
         ## Modified by Raj Dabre. Start.
+        if segment_ids is not None: ## Packed sequences need a block diagonal causal mask. Packing is only meant for training so there is no past to deal with.
+            attention_mask = _make_segment_mask(segment_ids, segment_ids, inputs_embeds.dtype, causal=True)
+        else:
+            attention_mask = self._prepare_decoder_attention_mask(
+                attention_mask, input_shape, inputs_embeds, past_key_values_length
+            )
+        
         # expand encoder attention mask
-        if encoder_hidden_states is not None and encoder_attention_mask is not None:
+        if encoder_hidden_states is not None and segment_ids is not None and encoder_segment_ids is not None: ## The nth decoder segment only looks at the nth encoder segment.
+            encoder_attention_mask = _make_segment_mask(segment_ids, encoder_segment_ids, inputs_embeds.dtype)
+        elif encoder_hidden_states is not None and encoder_attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
             encoder_attention_mask = _expand_mask(encoder_attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1], wait_k=self.config.wait_k, curr_decode_length=curr_decode_length) ## Raj: Just make the mask wait-k and we are good to go.
             if self.config.multi_source:
@@ -1239,8 +1291,11 @@ class MBartDecoder(MBartPreTrainedModel):
                     additional_encoder_attention_mask = _expand_mask(additional_encoder_attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1], wait_k=self.config.additional_source_wait_k, curr_decode_length=curr_decode_length) ## Raj: Just make the mask wait-k and we are good to go.
         # embed positions
         #print(encoder_attention_mask.size() if encoder_attention_mask is not None else 1, additional_encoder_attention_mask.size() if additional_encoder_attention_mask is not None else 1)
+        if segment_ids is not None: ## Positions restart for each packed sequence.
+            positions = self.embed_positions(input_shape, position_ids=_segment_position_ids(segment_ids))
+        else:
+            positions = self.embed_positions(input_shape, past_key_values_length)
         ## Modified by Raj Dabre. End.
-        positions = self.embed_positions(input_shape, past_key_values_length)
 
         hidden_states = inputs_embeds + positions
         if not self.config.no_embed_norm:
@@ -1278,7 +1333,7 @@ class MBartDecoder(MBartPreTrainedModel):
 
             past_key_value = past_key_values[idx] if past_key_values is not None else None
 
-            if getattr(self.config, "gradient_checkpointing", False) and self.training:
+            if getattr(self.config, "gradient_checkpointing", False) and self.training and (self.checkpointed_layers is None or idx in self.checkpointed_layers): ## Modified by Raj Dabre. Selective checkpointing.
 
                 if use_cache:
                     logger.warn(
@@ -1294,7 +1349,7 @@ class MBartDecoder(MBartPreTrainedModel):
 
                     return custom_forward
 
-                layer_outputs = torch.utils.checkpoint.checkpoint(
+                layer_outputs = (OffloadedCheckpointFunction.apply if self.offload_checkpointed_activations else torch.utils.checkpoint.checkpoint)(
                     create_custom_forward(decoder_layer),
                     hidden_states,
                     attention_mask,
@@ -1434,6 +1489,8 @@ class MBartModel(MBartPreTrainedModel):
         additional_encoder_outputs=None,
         context_encoder_representations=None,
         curr_decode_length=-1,
+        encoder_segment_ids=None,
+        decoder_segment_ids=None,
     ):
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1456,6 +1513,7 @@ class MBartModel(MBartPreTrainedModel):
                 output_attentions=output_attentions,
                 output_hidden_states=output_hidden_states,
                 return_dict=return_dict,
+                segment_ids=encoder_segment_ids,
             )
         # If the user passed a tuple for encoder_outputs, we wrap it in a BaseModelOutput when return_dict=True
         elif return_dict and not isinstance(encoder_outputs, BaseModelOutput):
@@ -1529,6 +1587,8 @@ class MBartModel(MBartPreTrainedModel):
             additional_encoder_hidden_states=additional_encoder_outputs[0],
             additional_encoder_attention_mask=additional_input_ids_mask,
             curr_decode_length=curr_decode_length,
+            segment_ids=decoder_segment_ids,
+            encoder_segment_ids=encoder_segment_ids,
         )
 
         if not return_dict:
@@ -1573,6 +1633,57 @@ class GradientReversalFunction(Function): ## Glory be to the gradients in revers
         return dx, None
 
 
+class OffloadedCheckpointFunction(Function):
+    """
+    Same as torch.utils.checkpoint but the first input, which is the hidden states entering a layer and the only
+    activation that a checkpointed layer keeps, is moved to pinned CPU memory until the backward pass. The other inputs
+    such as masks and encoder states are shared by all layers so they stay where they are.
+    """
+
+    @staticmethod
+    def forward(ctx, run_function, hidden_states, *args):
+        ctx.run_function = run_function
+        ctx.device = hidden_states.device
+        ctx.hidden_states_requires_grad = hidden_states.requires_grad
+        ctx.had_autocast_in_fwd = torch.is_autocast_enabled()
+        ctx.fwd_cpu_state = torch.get_rng_state() ## Dropout has to give the same masks when recomputing.
+        if hidden_states.is_cuda:
+            ctx.fwd_cuda_state = torch.cuda.get_rng_state(hidden_states.device)
+        ctx.offloaded_hidden_states = torch.empty(hidden_states.size(), dtype=hidden_states.dtype, pin_memory=hidden_states.is_cuda)
+        ctx.offloaded_hidden_states.copy_(hidden_states, non_blocking=True)
+        ctx.is_tensor_arg = [torch.is_tensor(arg) for arg in args]
+        ctx.non_tensor_args = [arg for arg in args if not torch.is_tensor(arg)]
+        ctx.save_for_backward(*[arg for arg in args if torch.is_tensor(arg)])
+        with torch.no_grad():
+            outputs = run_function(hidden_states, *args)
+        return outputs
+
+    @staticmethod
+    def backward(ctx, *output_grads):
+        hidden_states = ctx.offloaded_hidden_states.to(ctx.device, non_blocking=True).requires_grad_(ctx.hidden_states_requires_grad)
+        tensor_args = iter(ctx.saved_tensors)
+        non_tensor_args = iter(ctx.non_tensor_args)
+        args = []
+        for is_tensor in ctx.is_tensor_arg:
+            if is_tensor:
+                arg = next(tensor_args)
+                args.append(arg.detach().requires_grad_(arg.requires_grad))
+            else:
+                args.append(next(non_tensor_args))
+        devices = [ctx.device] if ctx.device.type == "cuda" else []
+        with torch.random.fork_rng(devices=devices):
+            torch.set_rng_state(ctx.fwd_cpu_state)
+            if ctx.device.type == "cuda":
+                torch.cuda.set_rng_state(ctx.fwd_cuda_state, ctx.device)
+            with torch.enable_grad(), torch.cuda.amp.autocast(ctx.had_autocast_in_fwd):
+                outputs = ctx.run_function(hidden_states, *args)
+        if torch.is_tensor(outputs):
+            outputs = (outputs,)
+        outputs_with_grad = [(output, grad) for output, grad in zip(outputs, output_grads) if torch.is_tensor(output) and output.requires_grad and grad is not None]
+        torch.autograd.backward([output for output, _ in outputs_with_grad], [grad for _, grad in outputs_with_grad])
+        return (None, hidden_states.grad) + tuple(arg.grad if torch.is_tensor(arg) else None for arg in args)
+
+
 class GradientReversal(nn.Module):
     def __init__(self, lambda_=1):
         super(GradientReversal, self).__init__()
@@ -1614,7 +1725,48 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
             self.domain_classifer_head = nn.Linear(config.d_model, config.num_domains_for_domain_classifier, bias=False)
             if config.gradient_reversal_for_domain_classifier:
                 self.gradient_reversal_layer = GradientReversal()
+        
+        self.output_shortlist = None ## The subset of target vocabulary ids to which the output projection is restricted during decoding. None means the full vocabulary is used.
+        self.output_shortlist_weight = None
+        self.output_shortlist_bias = None
+        self.output_shortlist_positions = None
+        self.skip_lm_logits_in_training = False ## When the loss is computed from the lm hidden states in chunks we dont need the full logits during training.
             
+    ## Modified by Raj Dabre. Start.
+    def set_output_shortlist(self, shortlist_ids=None):
+        """Restrict the output projection to the given vocabulary ids. The rows of the lm_head and the final logits bias are gathered once here so that each decoding step only does a small matmul. An extra row whose logit is always -inf is appended and every id outside the shortlist is mapped to it. This way generate can apply its logits processors in the shortlist space without checking whether each id is shortlisted. Pass None to go back to the full vocabulary."""
+        if shortlist_ids is None:
+            self.output_shortlist = None
+            self.output_shortlist_weight = None
+            self.output_shortlist_bias = None
+            self.output_shortlist_positions = None
+            return
+        with torch.no_grad():
+            lm_head_weight = self.lm_head.weight() if callable(self.lm_head.weight) else self.lm_head.weight ## Dynamically quantized linear layers expose the weight as a method.
+            if lm_head_weight.is_quantized:
+                lm_head_weight = lm_head_weight.dequantize()
+            shortlist_ids = shortlist_ids.to(lm_head_weight.device)
+            self.output_shortlist = torch.cat([shortlist_ids, shortlist_ids.new_full((1,), self.config.pad_token_id)]) ## The extra position can never be chosen since its logit is -inf but it needs some id.
+            self.output_shortlist_weight = torch.cat([lm_head_weight.index_select(0, shortlist_ids), lm_head_weight.new_zeros((1, lm_head_weight.size(1)))])
+            self.output_shortlist_bias = torch.cat([self.final_logits_bias.index_select(1, shortlist_ids), self.final_logits_bias.new_full((1, 1), -float("inf"))], dim=1)
+            self.output_shortlist_positions = shortlist_ids.new_full((self.final_logits_bias.size(-1),), len(shortlist_ids))
+            self.output_shortlist_positions[shortlist_ids] = torch.arange(len(shortlist_ids), device=shortlist_ids.device)
+
+    def to_output_shortlist_positions(self, ids):
+        """Maps vocabulary ids to their positions in the shortlist. Ids outside the shortlist are mapped to the extra -inf position."""
+        return self.output_shortlist_positions[ids]
+
+    def from_output_shortlist_positions(self, positions):
+        """Maps positions in the shortlist back to vocabulary ids."""
+        return self.output_shortlist[positions]
+
+    def compute_lm_logits(self, hidden_states):
+        """Computes the output logits. If a shortlist is set and we are not training then the logits are computed only for the shortlisted ids (plus the extra -inf position) so the last dimension is the shortlist size and not the vocabulary size. generate does the softmax and beam search over these and maps the chosen positions back to vocabulary ids."""
+        if self.output_shortlist is None or self.training:
+            return self.lm_head(hidden_states) + self.final_logits_bias
+        return F.linear(hidden_states, self.output_shortlist_weight) + self.output_shortlist_bias
+    ## Modified by Raj Dabre. End.
+
     def get_encoder(self):
         return self.model.get_encoder()
 
@@ -1668,12 +1820,18 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
         curr_decode_length=-1,
         context_encoder_representations=None,
         label_mask=None,
+        encoder_segment_ids=None,
+        decoder_segment_ids=None,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size, sequence_length)`, `optional`):
             Labels for computing the masked language modeling loss. Indices should either be in ``[0, ...,
             config.vocab_size]`` or -100 (see ``input_ids`` docstring). Tokens with indices set to ``-100`` are ignored
             (masked), the loss is only computed for the tokens with labels in ``[0, ..., config.vocab_size]``.
+        encoder_segment_ids (:obj:`torch.LongTensor` of shape :obj:`(batch_size, sequence_length)`, `optional`):
+            Segment ids of the encoder input when several examples are packed into one row. 0 indicates padding.
+        decoder_segment_ids (:obj:`torch.LongTensor` of shape :obj:`(batch_size, target_sequence_length)`, `optional`):
+            Segment ids of the decoder input. The nth decoder segment attends only to the nth encoder segment.
 
         Returns:
 
@@ -1706,7 +1864,7 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
                 additional_encoder_outputs=None,
                 curr_decode_length=curr_decode_length,
             )
-            lm_logits = (self.lm_head(outputs[0]) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
+            lm_logits = self.compute_lm_logits(outputs[0])/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
             if self.config.temperature_calibration:
                 lm_logits = lm_logits/self.softmax_temperature ## The softmax_temperature config param should be 1.0
             additional_outputs = self.model(
@@ -1729,7 +1887,7 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
                 additional_encoder_outputs=None,
                 curr_decode_length=curr_decode_length,
             )
-            additional_source_lm_logits = (self.lm_head(additional_outputs[0]) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
+            additional_source_lm_logits = self.compute_lm_logits(additional_outputs[0])/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
             if self.config.temperature_calibration:
                 additional_source_lm_logits = additional_source_lm_logits/self.softmax_temperature ## The softmax_temperature config param should be 1.0
         else:
@@ -1753,16 +1911,26 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
                 additional_encoder_outputs=additional_encoder_outputs,
                 curr_decode_length=curr_decode_length,
                 context_encoder_representations=context_encoder_representations,
+                encoder_segment_ids=encoder_segment_ids,
+                decoder_segment_ids=decoder_segment_ids,
             )
-            lm_logits = (self.lm_head(outputs[0]) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
-            if self.config.temperature_calibration:
-                lm_logits = lm_logits/self.softmax_temperature
+            if self.skip_lm_logits_in_training and self.training: ## The loss will be computed from outputs[0] directly.
+                lm_logits = None
+            else:
+                lm_logits = self.compute_lm_logits(outputs[0])/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
+                if self.config.temperature_calibration:
+                    lm_logits = lm_logits/self.softmax_temperature
         
         additional_lm_logits = []
+        additional_lm_hidden_states = []
         if self.config.multilayer_softmaxing is not None:
             for layer_id in self.config.multilayer_softmaxing: ## We count the embedding layer too. Who knows what may happen? However we wont do anything for the final layer as its already dealt with.
                 lm_representation = outputs.decoder_hidden_states[layer_id]
-                additional_lm_logits.append((self.lm_head(lm_representation) + self.final_logits_bias)/self.config.softmax_temperature) ## The additional logits will be collected here and then returned to my main code. Divide the logits by a temperature to get a smoothed softmax.
+                additional_lm_hidden_states.append(lm_representation)
+                if self.skip_lm_logits_in_training and self.training:
+                    additional_lm_logits.append(None)
+                    continue
+                additional_lm_logits.append(self.compute_lm_logits(lm_representation)/self.config.softmax_temperature) ## The additional logits will be collected here and then returned to my main code. Divide the logits by a temperature to get a smoothed softmax.
                 if self.config.temperature_calibration:
                     additional_lm_logits[-1] = additional_lm_logits[-1]/self.softmax_temperature ## The softmax_temperature config param should be 1.0
         
@@ -1803,6 +1971,8 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
             context_encoder_representations = outputs.context_encoder_representations if self.config.multi_source and (self.config.multi_source_method == "additional_source_attention") else None,
             softmax_temperature = self.softmax_temperature if self.config.temperature_calibration else None,
             domain_classifier_logits = domain_classifier_logits if self.config.num_domains_for_domain_classifier > 1 else None,
+            lm_hidden_states = outputs[0],
+            additional_lm_hidden_states = additional_lm_hidden_states,
         )
 
     def prepare_inputs_for_generation(
@@ -1830,7 +2000,7 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
 
     def adjust_logits_during_generation(self, logits, cur_len, max_length):
         if cur_len == max_length - 1 and self.config.eos_token_id is not None:
-            self._force_token_id_to_be_generated(logits, self.config.eos_token_id)
+            self._force_token_id_to_be_generated(logits, self.config.eos_token_id if self.output_shortlist is None else self.output_shortlist_positions[self.config.eos_token_id].item()) ## With a shortlist the logits are over the shortlist positions.
         return logits
 
     @staticmethod
@@ -7,7 +7,9 @@ from transformers import MBartForConditionalGeneration, BartForConditionalGenera
 import torch
 import torch.nn as nn
 
-import sys, os
+from common_utils import quantize_model_dynamic_int8, get_model_size_in_mb, load_checkpoint
+
+import sys, os, time
 
 
 os.environ['MASTER_ADDR'] = "localhost"              #
@@ -17,13 +19,29 @@ tok = AutoTokenizer.from_pretrained("/share03/draj/data/monolingual_corpora/indi
 
 config = MBartConfig(vocab_size=len(tok), encoder_layers=6, decoder_layers=6, dropout=0.1, attention_dropout=0.1, activation_dropout=0.1, encoder_attention_heads=16, decoder_attention_heads=16, encoder_ffn_dim=4096, decoder_ffn_dim=4096, d_model=1024, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0]) ## Configuration.
 
+quantize_dynamic_int8 = True ## Should we apply dynamic int8 quantization to the linear layers? This makes CPU decoding faster and the model smaller.
+quantized_model_cache = "/share03/draj/data/monolingual_corpora/indic/fixed_vocab_model/ddpmodel.all.transformer_big.6-layer.64k.ls-0.1.drop-0.1.warmup-16k.gradclip-1.0.lr-1em3.wd-0.00001.750000.pure_model.int8" ## The quantized model is saved here the first time and loaded directly afterwards. Set to None to disable caching.
+
 model = MBartForConditionalGeneration(config)
 model = model.eval()
-checkpoint_dict = torch.load("/share03/draj/data/monolingual_corpora/indic/fixed_vocab_model/ddpmodel.all.transformer_big.6-layer.64k.ls-0.1.drop-0.1.warmup-16k.gradclip-1.0.lr-1em3.wd-0.00001.750000.pure_model")
-if type(checkpoint_dict) == dict:
-    model.load_state_dict(checkpoint_dict["model"])
+if quantize_dynamic_int8 and quantized_model_cache is not None and os.path.exists(quantized_model_cache):
+    quantize_model_dynamic_int8(model) ## Quantize the randomly initialized model first so that its structure matches the cached model.
+    model.load_state_dict(torch.load(quantized_model_cache, map_location="cpu"))
 else:
-    model.load_state_dict(checkpoint_dict)
+    load_start = time.time()
+    checkpoint_dict = load_checkpoint("/share03/draj/data/monolingual_corpora/indic/fixed_vocab_model/ddpmodel.all.transformer_big.6-layer.64k.ls-0.1.drop-0.1.warmup-16k.gradclip-1.0.lr-1em3.wd-0.00001.750000.pure_model", map_location="cpu") ## A flat checkpoint made with convert_checkpoint.py is memory mapped which makes the startup much faster.
+    if type(checkpoint_dict) == dict:
+        model.load_state_dict(checkpoint_dict["model"])
+    else:
+        model.load_state_dict(checkpoint_dict)
+    print("Loading the model took", time.time()-load_start, "seconds.")
+    if quantize_dynamic_int8:
+        print("Size of the fp32 model is", get_model_size_in_mb(model), "MB.")
+        quantize_model_dynamic_int8(model)
+        if quantized_model_cache is not None:
+            torch.save(model.state_dict(), quantized_model_cache)
+if quantize_dynamic_int8:
+    print("Size of the int8 quantized model is", get_model_size_in_mb(model), "MB.")
 
 render = web.template.render('templates/')
 
@@ -54,7 +72,10 @@ class index:
             input_sentence=input_sentence_tmp.input_ids
             input_mask=input_sentence_tmp.attention_mask
             print(input_sentence, input_mask)
-            output = model.generate(input_sentence, use_cache=True, num_beams=2, max_length=len(input_sentence[0])+100, min_length=1, early_stopping=True, attention_mask=input_mask, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok(["<2en>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=1.0) ## We translate the batch.
+            start = time.time()
+            with torch.no_grad():
+                output = model.generate(input_sentence, use_cache=True, num_beams=2, max_length=len(input_sentence[0])+100, min_length=1, early_stopping=True, attention_mask=input_mask, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok(["<2en>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=1.0) ## We translate the batch.
+            print("Translation took", time.time()-start, "seconds.")
             output = tok.decode(output[0], skip_special_tokens=True, clean_up_tokenization_spaces=False)
             return render.yanmtt_interface(form, output)
 